@@ -2,31 +2,360 @@
 Main module serving the pages for the IFTTT2YNAB appengine app
 """
 
+import atexit
 import base64
+import bisect
+import collections
+import collections.abc
+import contextlib
+import contextvars
+import csv
+import gzip
 import hashlib
+import hmac
+import importlib.util
+import io
+import itertools
 import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
 import secrets
+import sys
+import threading
+import time
 import traceback
+import urllib.parse
 import uuid
-
-import arrow
-import requests
+import zlib
 
 from flask import Flask, redirect, render_template, request, make_response
-from google.cloud import datastore
+
+def lazy_import(name):
+    """ Returns a module that is only loaded on first attribute access """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# These take most of the import time of a cold start, while a request like
+# the status check does not need all (or any) of them.
+arrow = lazy_import("arrow")
+requests = lazy_import("requests")
+datastore = lazy_import("google.cloud.datastore")
 
 app = Flask(__name__)
 
-DSCLIENT = datastore.Client()
+# The Datastore client is constructed on first use, see get_dsclient
+DSCLIENT = None
+DSCLIENT_LOCK = threading.Lock()
 
 IFTTT_SERVICE_KEY = None
-YNAB_ACCOUNT_KEY = None
-YNAB_DEFAULT_BUDGET = None
 WEB_SESSION_KEY = None
 
 YNAB_BASE = "https://api.youneedabudget.com/v1"
 
 
+###############################################################################
+# Logging                                                                     #
+###############################################################################
+
+# Log records are handed to a queue on the request path, and formatted and
+# written by a listener thread as one JSON object per line, which Cloud
+# Logging turns into structured entries. Each endpoint logs to its own logger,
+# so levels can be set per endpoint with LOG_LEVELS, e.g.
+# "transaction_updated=WARNING,cron=DEBUG". Request and response payloads
+# are logged for a sample of the calls only (all of them at DEBUG level, and
+# always for failed YNAB responses), truncated to LOG_PAYLOAD_MAX characters.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_PAYLOAD_SAMPLE = float(os.environ.get("LOG_PAYLOAD_SAMPLE", "0.01"))
+LOG_PAYLOAD_MAX = 1000
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a log record as a JSON line for Cloud Logging """
+
+    def format(self, record):
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name.split(".", 1)[-1],
+        }
+        return json.dumps(entry)
+
+def setup_logging():
+    """ Sets up the non-blocking logger of the app """
+    logger = logging.getLogger("ifttt2ynab")
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    for setting in LOG_LEVELS.split(","):
+        if "=" in setting:
+            name, level = setting.split("=", 1)
+            logging.getLogger("ifttt2ynab." + name.strip())\
+                   .setLevel(level.strip().upper())
+    records = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+
+def log(name):
+    """ Returns the logger of an endpoint or component """
+    return logging.getLogger("ifttt2ynab." + name)
+
+def log_payload(logger, label, payload, always=False):
+    """ Logs a sample of payloads, serialized and truncated """
+    if always:
+        level = logging.WARNING
+    elif logger.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    elif logger.isEnabledFor(logging.INFO) and \
+            random.random() < LOG_PAYLOAD_SAMPLE:
+        level = logging.INFO
+    else:
+        return
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    if len(payload) > LOG_PAYLOAD_MAX:
+        payload = "{}... ({} bytes)".format(payload[:LOG_PAYLOAD_MAX],
+                                            len(payload))
+    logger.log(level, "%s: %s", label, payload)
+
+
+###############################################################################
+# Tenants                                                                     #
+###############################################################################
+
+# One deployment serves several tenants, each with its own YNAB token, budget
+# list, triggers and caches. The data of a tenant is stored in the Datastore
+# namespace named after it, and its cached data in TENANT_STATE[tenant]
+# through the TenantDict caches. The tenant of a request is set from its
+# bearer token (or, for a sync task, from the task) in a context variable,
+# which ds_key and the caches use. Requests without a token belong to the
+# default tenant None in the default namespace, so a single-tenant
+# installation works as before. The IFTTT service key and the web interface
+# are shared by all tenants and stay in the default namespace.
+# A sync task names its tenant in the tenant query argument, which is only
+# trusted because App Engine strips the X-AppEngine-QueueName header from
+# requests that do not come from a task queue. Behind any other front end,
+# a caller could act on any tenant by setting that header.
+CURRENT_TENANT = contextvars.ContextVar("tenant", default=None)
+TENANT_STATE = {}
+TENANT_LOCK = threading.Lock()
+TENANT_TOKENS = {}
+TENANT_ENVIRON = "ifttt2ynab.tenant"
+
+class TenantDict(collections.abc.MutableMapping):
+    """ A cache dict of which every tenant has its own copy """
+
+    def __init__(self, name, default=dict):
+        self.name = name
+        self.default = default
+
+    def data(self):
+        with TENANT_LOCK:
+            state = TENANT_STATE.setdefault(CURRENT_TENANT.get(), {})
+            if self.name not in state:
+                state[self.name] = self.default()
+            return state[self.name]
+
+    def __getitem__(self, key):
+        return self.data()[key]
+
+    def __setitem__(self, key, value):
+        self.data()[key] = value
+
+    def __delitem__(self, key):
+        del self.data()[key]
+
+    def __iter__(self):
+        return iter(self.data())
+
+    def __len__(self):
+        return len(self.data())
+
+# The YNAB token, default budget and budget list of the tenant
+TENANT_CACHE = TenantDict("cache")
+
+@contextlib.contextmanager
+def tenant_context(tenant):
+    """ Runs the body of the with statement as the given tenant """
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        yield
+    finally:
+        CURRENT_TENANT.reset(token)
+
+def token_tenant(token):
+    """ Returns the tenant of a bearer token, False if unknown
+
+    Tokens of the default tenant, issued through OAuth, return None.
+    """
+    test = test_token()
+    if test is not None and hmac.compare_digest(token.encode("utf-8"),
+                                                test.encode("utf-8")):
+        return None
+    digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    if digest not in TENANT_TOKENS:
+        entity = ds_get(global_key("tenant_token", digest))
+        if entity is None:
+            return False
+        TENANT_TOKENS[digest] = entity["tenant"]
+    return TENANT_TOKENS[digest]
+
+def token_entity(token, tenant):
+    """ Returns the entity mapping a bearer token to its tenant """
+    entity = datastore.Entity(global_key(
+        "tenant_token", hashlib.sha256(token.encode("utf-8")).hexdigest()))
+    entity["tenant"] = tenant
+    return entity
+
+def list_tenants():
+    """ Returns the tenants created through the admin handler """
+    entity = ds_get(global_key("tenant", "tenants"))
+    if entity is None:
+        return []
+    return json.loads(entity["data"])
+
+def create_tenant(tenant, token):
+    """ Registers a new tenant and its bearer token """
+    key = global_key("tenant", "tenants")
+    mapping = token_entity(token, tenant)
+    def work(client):
+        entity = client.get(key)
+        if entity is None:
+            entity = datastore.Entity(key, exclude_from_indexes=["data"])
+        tenants = json.loads(entity.get("data", "[]"))
+        tenants.append(tenant)
+        entity["data"] = json.dumps(tenants)
+        client.put_multi([entity, mapping])
+    ds_transaction(work)
+
+
+###############################################################################
+# IFTTT OAuth2 authentication                                                 #
+###############################################################################
+
+# IFTTT only sends a bearer token to services with OAuth2 authentication. When
+# a user connects the service, IFTTT sends them to /oauth2/authorize. There
+# they enter the token of their tenant (from /admin/tenants), or, logged in to
+# the web interface, connect the default tenant. IFTTT then exchanges the
+# code it gets for an access token at /oauth2/token, authenticating with the
+# IFTTT service key as client secret, and sends that token with every
+# request. Codes are valid for OAUTH_CODE_TTL seconds and only once.
+OAUTH_CODE_TTL = 600
+OAUTH_REDIRECT_PREFIX = "https://ifttt.com/channels/"
+
+@app.route("/oauth2/authorize", methods=["GET", "POST"])
+def oauth_authorize():
+    """ Lets a user connect IFTTT to their tenant """
+    fields = request.values
+    redirect_uri = fields.get("redirect_uri", "")
+    if not redirect_uri.startswith(OAUTH_REDIRECT_PREFIX):
+        return render_template("message.html", msgtype="danger", msg=\
+            "Invalid request: unknown redirect_uri")
+    if request.method == "GET":
+        return render_template("authorize.html",
+                               redirect_uri=redirect_uri,
+                               state=fields.get("state", ""))
+
+    try:
+        token = fields.get("token", "").strip()
+        cookie = request.cookies.get('session')
+        if token:
+            tenant = token_tenant(token)
+            if tenant is False:
+                return render_template("message.html", msgtype="danger",
+                                       msg="Invalid token")
+        elif cookie is not None and cookie == get_session_key():
+            tenant = None
+        else:
+            return render_template("message.html", msgtype="danger", msg=\
+                "Enter the token of your account, or log in to the web "\
+                "interface first")
+
+        code = secrets.token_urlsafe(32)
+        entity = datastore.Entity(global_key(
+            "oauth_code", hashlib.sha256(code.encode("utf-8")).hexdigest()))
+        entity["tenant"] = tenant
+        entity["redirect_uri"] = redirect_uri
+        entity["expires"] = time.time() + OAUTH_CODE_TTL
+        ds_put_multi([entity])
+        log("oauth").info("Authorized tenant %s", tenant)
+        separator = "&" if "?" in redirect_uri else "?"
+        return redirect(redirect_uri + separator + urllib.parse.urlencode(
+            {"code": code, "state": fields.get("state", "")}))
+    except:
+        traceback.print_exc()
+        return render_template("message.html", msgtype="danger", msg=\
+            'An unknown exception occurred. See the logs.')
+
+@app.route("/oauth2/token", methods=["POST"])
+def oauth_token():
+    """ Exchanges an authorization code for an access token """
+    fields = request.values
+    if fields.get("client_secret") != get_ifttt_key() or \
+            get_ifttt_key() is None:
+        log("oauth").error("invalid client secret!")
+        return json.dumps({"error": "invalid_client"}), 401
+    if fields.get("grant_type") != "authorization_code":
+        return json.dumps({"error": "unsupported_grant_type"}), 400
+
+    try:
+        key = global_key("oauth_code", hashlib.sha256(
+            fields.get("code", "").encode("utf-8")).hexdigest())
+        def work(client):
+            entity = client.get(key)
+            if entity is not None:
+                client.delete(key)
+            return entity
+        entity = ds_transaction(work)
+        if entity is None or entity["expires"] < time.time() or \
+                entity["redirect_uri"] != fields.get("redirect_uri"):
+            log("oauth").error("invalid authorization code!")
+            return json.dumps({"error": "invalid_grant"}), 400
+
+        token = secrets.token_urlsafe(32)
+        ds_put_multi([token_entity(token, entity["tenant"])])
+        return json.dumps({"token_type": "Bearer", "access_token": token})
+    except:
+        traceback.print_exc()
+        return json.dumps({"error": "server_error"}), 500
+
+@app.route("/ifttt/v1/user/info")
+def ifttt_user_info():
+    """ Returns the tenant of the access token to IFTTT """
+    if not request.headers.get("Authorization", "").startswith("Bearer "):
+        return json.dumps({"errors": [{"message": "Invalid token"}]}), 401
+    tenant = CURRENT_TENANT.get()
+    return json.dumps({"data": {
+        "name": "YNAB" if tenant is None else "YNAB " + tenant,
+        "id": "default" if tenant is None else tenant,
+    }})
+
+def test_token():
+    """ Returns an access token of the default tenant for IFTTT's tests
+
+    It is derived from the IFTTT service key, so the test setup does not
+    need to store it. Returns None without a service key.
+    """
+    if get_ifttt_key() is None:
+        return None
+    return hmac.new(get_ifttt_key().encode("utf-8"), b"test_token",
+                    hashlib.sha256).hexdigest()
+
+
 ###############################################################################
 # IFTTT test methods                                                          #
 ###############################################################################
@@ -70,6 +399,12 @@ def ifttt_test_setup():
                     },
                     "ynab_transaction_updated": {
                         "budget": "TEST#TEST",
+                        "account": "",
+                        "payee": "",
+                        "category": "",
+                        "amount_min": "",
+                        "amount_max": "",
+                        "flag_color": "",
                     },
                 },
                 "actions": {
@@ -121,6 +456,23 @@ def ifttt_test_setup():
                         "approved": "x",
                         "flag_color": "x",
                     },
+                    "ynab_create_bulk": {
+                        "budget": "x",
+                        "account": "TEST#TEST#1",
+                        "transactions": "x",
+                        "cleared": "x",
+                        "approved": "x",
+                        "flag_color": "x",
+                        "import_id" : "x",
+                    },
+                    "ynab_create_bulk_default": {
+                        "account": "TEST#TEST#1",
+                        "transactions": "x",
+                        "cleared": "x",
+                        "approved": "x",
+                        "flag_color": "x",
+                        "import_id" : "x",
+                    },
                 },
                 "actionRecordSkipping": {
                     "ynab_create": {
@@ -171,8 +523,26 @@ def ifttt_test_setup():
                         "approved": "x",
                         "flag_color": "x",
                     },
+                    "ynab_create_bulk": {
+                        "budget": "x",
+                        "account": "TEST#TEST#2",
+                        "transactions": "x",
+                        "cleared": "x",
+                        "approved": "x",
+                        "flag_color": "x",
+                        "import_id" : "x",
+                    },
+                    "ynab_create_bulk_default": {
+                        "account": "TEST#TEST#2",
+                        "transactions": "x",
+                        "cleared": "x",
+                        "approved": "x",
+                        "flag_color": "x",
+                        "import_id" : "x",
+                    },
                 }
-            }
+            },
+            "accessToken": test_token(),
         }
     })
 
@@ -185,6 +555,8 @@ def ifttt_test_setup():
            "budget/options", methods=["POST"])
 @app.route("/ifttt/v1/actions/ynab_adjust_balance/fields/"\
            "budget/options", methods=["POST"])
+@app.route("/ifttt/v1/actions/ynab_create_bulk/fields/"\
+           "budget/options", methods=["POST"])
 @app.route("/ifttt/v1/triggers/ynab_account_updated/fields/"\
            "budget/options", methods=["POST"])
 @app.route("/ifttt/v1/triggers/ynab_category_updated/fields/"\
@@ -203,8 +575,8 @@ def ifttt_budget_options():
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
     try:
-        data = get_ynab_budgets()
-        return json.dumps({"data": data})
+        data = get_budget_options()
+        return json_response({"data": data})
     except:
         traceback.print_exc()
         return json.dumps({"data": [{"label": "ERROR retrieving YNAB data",
@@ -214,6 +586,8 @@ def ifttt_budget_options():
            "account/options", methods=["POST"])
 @app.route("/ifttt/v1/actions/ynab_adjust_balance_default/fields/"\
            "account/options", methods=["POST"])
+@app.route("/ifttt/v1/actions/ynab_create_bulk_default/fields/"\
+           "account/options", methods=["POST"])
 def ifttt_account_options():
     """ Option values for the account field """
     if "IFTTT-Service-Key" not in request.headers or \
@@ -223,8 +597,14 @@ def ifttt_account_options():
         if get_default_budget() is None:
             return json.dumps({"data": [{"label": "ERROR no default budget",
                                          "value": ""}]})
+        options = get_options_snapshot(get_default_budget())
+        if options is not None:
+            etag = options_etag(options)
+            if etag_matches(etag):
+                return json_response(None, etag)
+            return json_response({"data": options["accounts"]}, etag)
         data = get_ynab_accounts()
-        return json.dumps({"data": data})
+        return json_response({"data": data})
     except:
         traceback.print_exc()
         return json.dumps({"data": [{"label": "ERROR retrieving YNAB data",
@@ -251,8 +631,53 @@ def ifttt_category_options(trigger):
         if get_default_budget() is None:
             return json.dumps({"data": [{"label": "ERROR no default budget",
                                          "value": ""}]})
+        options = get_options_snapshot(get_default_budget())
+        if options is not None:
+            etag = options_etag(options)
+            if etag_matches(etag):
+                return json_response(None, etag)
+            data = category_options(options["categories"], trigger)
+            return json_response({"data": data}, etag)
         data = get_ynab_categories(None, trigger)
-        return json.dumps({"data": data})
+        return json_response({"data": data})
+    except:
+        traceback.print_exc()
+        return json.dumps({"data": [{"label": "ERROR retrieving YNAB data",
+                                     "value": ""}]})
+
+@app.route("/ifttt/v1/triggers/ynab_transaction_updated/fields/"\
+           "account/options", methods=["POST"])
+def ifttt_transaction_account_options():
+    return ifttt_transaction_filter_options("accounts")
+
+@app.route("/ifttt/v1/triggers/ynab_transaction_updated/fields/"\
+           "payee/options", methods=["POST"])
+def ifttt_transaction_payee_options():
+    return ifttt_transaction_filter_options("payees")
+
+@app.route("/ifttt/v1/triggers/ynab_transaction_updated/fields/"\
+           "category/options", methods=["POST"])
+def ifttt_transaction_category_options():
+    return ifttt_transaction_filter_options("categories")
+
+def ifttt_transaction_filter_options(field):
+    """ Option values for the filter fields of the transaction trigger
+
+    The budget is selected in another field, so the options of all synced
+    budgets are listed, grouped per budget.
+    """
+    if "IFTTT-Service-Key" not in request.headers or \
+            request.headers["IFTTT-Service-Key"] != get_ifttt_key():
+        return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
+    try:
+        data = [{"label": "(any)", "value": ""}]
+        for budget in get_budget_options():
+            options = get_options_snapshot(budget["value"])
+            if options is None:
+                continue
+            data.append({"label": budget["label"],
+                         "values": filter_options(options, field)})
+        return json_response({"data": data})
     except:
         traceback.print_exc()
         return json.dumps({"data": [{"label": "ERROR retrieving YNAB data",
@@ -275,24 +700,24 @@ def ifttt_create_action(default):
     """ Main endpoint to create a transaction in YNAB """
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[create_action] ERROR: invalid service key!")
+        log("create_action").error("invalid service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
     data = request.get_json()
     if "actionFields" not in data:
-        print("[create_action] ERROR: missing actionFields")
+        log("create_action").error("missing actionFields")
         return json.dumps({"errors": [{"status": "SKIP", \
             "message": "Invalid data: actionFields missing"}]}), 400
     fields = data["actionFields"]
     for x in ["account", "date", "amount", "payee", "category",
               "memo", "cleared", "approved", "flag_color", "import_id"]:
         if x not in fields:
-            print("[create_action] ERROR: missing field: "+x)
+            log("create_action").error("missing field: "+x)
             return json.dumps({"errors": [{"status": "SKIP", \
                 "message": "Invalid data: missing field: "+x}]}), 400
     if not default and "budget" not in fields:
-        print("[adjust_balance_action] ERROR: missing field: budget")
+        log("create_action").error("missing field: budget")
         return json.dumps({"errors": [{"status": "SKIP", \
-            "message": "Invalid data: missing field: "+x}]}), 400
+            "message": "Invalid data: missing field: budget"}]}), 400
 
     if default:
         budget = get_default_budget()
@@ -307,60 +732,53 @@ def ifttt_create_action(default):
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Test"}]}), 400
     if len(str(budget)) != 36:
-        print("[create_action] ERROR: incorrect budget (no uuid): "+budget)
+        log("create_action").error("incorrect budget (no uuid): "+budget)
         return json.dumps({"errors": [{"status": "SKIP", \
             "message": "Invalid data: incorrect budget: "+budget}]}), 400
 
-    r = requests.get(YNAB_BASE + "/budgets/{}/accounts".format(budget), \
-        headers={"Authorization": "Bearer {}".format(get_ynab_key())})
-    if "data" not in r.json():
-        print("[create_action] ERROR: retrieving accounts: ", r.text)
+    try:
+        accounts = get_ynab_accounts_raw(budget)
+    except YnabUnavailable:
+        log("create_action").error("YNAB unavailable")
+        return json.dumps({"errors": [{"message":
+                                       "YNAB unavailable"}]}), 503
+    except:
+        traceback.print_exc()
+        log("create_action").error("retrieving accounts")
         return "", 500
 
-    results = r.json()["data"]["accounts"]
     account_id = None
-    for a in results:
-        if a["id"] == account:
-            account_id = a["id"]
-        elif a["name"] == account:
-            account_id = a["id"]
+    found = find_ynab_account(accounts, account)
+    if found is not None:
+        account_id = found["id"]
     if account_id is None:
-        print("[create_action] ERROR: account not found")
+        log("create_action").error("account not found")
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Account not found"}]}), 400
 
     category = fields["category"]
     category_id = None
     if category != "":
-        r = requests.get(YNAB_BASE + "/budgets/{}/categories".format(budget), \
-            headers={"Authorization": "Bearer {}".format(get_ynab_key())})
-        results = r.json()["data"]["category_groups"]
-        for g in results:
-            for c in g["categories"]:
-                if c["id"] == category:
-                    category_id = c["id"]
-                elif c["name"] == category:
-                    category_id = c["id"]
+        try:
+            category_id = find_category_id(budget, category)
+        except YnabUnavailable:
+            log("create_action").error("YNAB unavailable")
+            return json.dumps({"errors": [{"message":
+                                           "YNAB unavailable"}]}), 503
         if category_id is None:
-            print("[create_action] WARNING: unknown category, ignored")
+            log("create_action").warning("unknown category, ignored")
 
     try:
-        if fields["date"] in ["", "today"]:
-            date = arrow.now(data["user"]["timezone"]).format("YYYY-MM-DD")
-        elif fields["date"] == "yesterday":
-            date = arrow.now(data["user"]["timezone"]).shift(days=-1)\
-                                                      .format("YYYY-MM-DD")
-        else:
-            date = arrow.get(fields["date"]).format("YYYY-MM-DD")
+        date = parse_action_date(fields["date"], data)
     except:
-        print("[create_action] ERROR: invalid date: "+fields["date"])
+        log("create_action").error("invalid date: "+fields["date"])
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Invalid date"}]}), 400
 
     try:
         amount = int(round(float(fields["amount"])*1000))
     except:
-        print("[create_action] ERROR: invalid amount: "+fields["amount"])
+        log("create_action").error("invalid amount: "+fields["amount"])
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Invalid amount"}]}), 400
 
@@ -386,23 +804,56 @@ def ifttt_create_action(default):
     if fields["import_id"] != "":
         body["transaction"]["import_id"] = fields["import_id"]
 
-    print(json.dumps(body))
-    r = requests.post(YNAB_BASE + "/budgets/{}/transactions".format(budget), \
-        headers={"Authorization": "Bearer {}".format(get_ynab_key())}, \
-        json=body)
-    print(r.status_code, r.text)
-    if r.status_code > 299:
+    log_payload(log("create_action"), "request", body)
+    with account_lease(budget, account_id) as held:
+        if not held:
+            return json.dumps({"errors": [{"message": "Account busy"}]}), 503
         try:
-            msg = "{} Bad request".format(r.status_code)
-            msg = r.json()["error"]["detail"]
-        except:
-            pass
-        return json.dumps({"errors": [{"status": "SKIP",
-                                       "message": msg}]}), 400
+            r = ynab_post("/budgets/{}/transactions".format(budget), body)
+        except YnabUnavailable as e:
+            if isinstance(e, YnabUncertain):
+                invalidate_balance(budget, account_id)
+                # without an import_id, YNAB cannot recognize a retry
+                if "import_id" not in body["transaction"]:
+                    log("create_action").error(
+                        "YNAB did not confirm the transaction")
+                    return json.dumps({"errors": [{"status": "SKIP", "message":
+                        "YNAB did not confirm the transaction"}]}), 400
+            log("create_action").error("YNAB unavailable")
+            return json.dumps({"errors": [{"message":
+                                           "YNAB unavailable"}]}), 503
+        log_payload(log("create_action"), "response {}".format(
+            r.status_code), r.text, r.status_code > 299)
+        if r.status_code > 299:
+            try:
+                msg = "{} Bad request".format(r.status_code)
+                msg = r.json()["error"]["detail"]
+            except:
+                pass
+            return json.dumps({"errors": [{"status": "SKIP",
+                                           "message": msg}]}), 400
+
+        apply_balance_change(budget, account_id, amount,
+                             response_knowledge(r))
+        publish_knowledge(budget, response_knowledge(r))
 
     return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
 
 
+def parse_action_date(value, data):
+    """ Converts the date field of an action to YYYY-MM-DD
+
+    Accepts "", "today", "yesterday" (in the timezone of the IFTTT user) or
+    anything arrow can parse. Raises an exception on an invalid date.
+    """
+    if value in ["", "today"]:
+        return arrow.now(data["user"]["timezone"]).format("YYYY-MM-DD")
+    if value == "yesterday":
+        return arrow.now(data["user"]["timezone"]).shift(days=-1)\
+                                                  .format("YYYY-MM-DD")
+    return arrow.get(value).format("YYYY-MM-DD")
+
+
 ###############################################################################
 # IFTTT adjust balance action                                                 #
 ###############################################################################
@@ -419,24 +870,24 @@ def ifttt_adjust_balance_action(default):
     """ Main endpoint to adjust a balance of an account in YNAB """
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[adjust_balance_action] ERROR: invalid service key!")
+        log("adjust_balance_action").error("invalid service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
     data = request.get_json()
     if "actionFields" not in data:
-        print("[adjust_balance_action] ERROR: missing actionFields")
+        log("adjust_balance_action").error("missing actionFields")
         return json.dumps({"errors": [{"status": "SKIP", \
             "message": "Invalid data: actionFields missing"}]}), 400
     fields = data["actionFields"]
     for x in ["account", "date", "new_balance", "payee", "category",
               "memo", "cleared", "approved", "flag_color"]:
         if x not in fields:
-            print("[adjust_balance_action] ERROR: missing field: "+x)
+            log("adjust_balance_action").error("missing field: "+x)
             return json.dumps({"errors": [{"status": "SKIP", \
                 "message": "Invalid data: missing field: "+x}]}), 400
     if not default and "budget" not in fields:
-        print("[adjust_balance_action] ERROR: missing field: budget")
+        log("adjust_balance_action").error("missing field: budget")
         return json.dumps({"errors": [{"status": "SKIP", \
-            "message": "Invalid data: missing field: "+x}]}), 400
+            "message": "Invalid data: missing field: budget"}]}), 400
 
     if default:
         budget = get_default_budget()
@@ -451,64 +902,53 @@ def ifttt_adjust_balance_action(default):
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Test"}]}), 400
     if len(str(budget)) != 36:
-        print("[adjust_balance_action] ERROR: incorrect budget (no uuid): "\
+        log("adjust_balance_action").error("incorrect budget (no uuid): "\
               +budget)
         return json.dumps({"errors": [{"status": "SKIP", \
             "message": "Invalid data: incorrect budget: "+budget}]}), 400
 
-    r = requests.get(YNAB_BASE + "/budgets/{}/accounts".format(budget), \
-        headers={"Authorization": "Bearer {}".format(get_ynab_key())})
-    if "data" not in r.json():
-        print("[adjust_balance_action] ERROR: retrieving accounts: ", r.text)
-        return "", 500
-
-    results = r.json()["data"]["accounts"]
-    account_id = None
-    for a in results:
-        if a["id"] == account:
-            account_id = a["id"]
-            old_balance = a["balance"]
-        elif a["name"] == account:
-            account_id = a["id"]
-            old_balance = a["balance"]
+    account_id = find_cached_account(budget, account)
     if account_id is None:
-        print("[adjust_balance_action] ERROR: account not found")
+        try:
+            found = find_ynab_account(get_ynab_accounts_raw(budget), account)
+        except YnabUnavailable:
+            log("adjust_balance_action").error("YNAB unavailable")
+            return json.dumps({"errors": [{"message":
+                                           "YNAB unavailable"}]}), 503
+        except:
+            traceback.print_exc()
+            log("adjust_balance_action").error("retrieving accounts")
+            return "", 500
+        if found is not None:
+            account_id = found["id"]
+    if account_id is None:
+        log("adjust_balance_action").error("account not found")
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Account not found"}]}), 400
 
     category = fields["category"]
     category_id = None
     if category != "":
-        r = requests.get(YNAB_BASE + "/budgets/{}/categories".format(budget), \
-            headers={"Authorization": "Bearer {}".format(get_ynab_key())})
-        results = r.json()["data"]["category_groups"]
-        for g in results:
-            for c in g["categories"]:
-                if c["id"] == category:
-                    category_id = c["id"]
-                elif c["name"] == category:
-                    category_id = c["id"]
+        try:
+            category_id = find_category_id(budget, category)
+        except YnabUnavailable:
+            log("adjust_balance_action").error("YNAB unavailable")
+            return json.dumps({"errors": [{"message":
+                                           "YNAB unavailable"}]}), 503
         if category_id is None:
-            print("[adjust_balance_action] WARNING: unknown category, ignored")
+            log("adjust_balance_action").warning("unknown category, ignored")
 
     try:
-        if fields["date"] in ["", "today"]:
-            date = arrow.now(data["user"]["timezone"]).format("YYYY-MM-DD")
-        elif fields["date"] == "yesterday":
-            date = arrow.now(data["user"]["timezone"]).shift(days=-1)\
-                                                      .format("YYYY-MM-DD")
-        else:
-            date = arrow.get(fields["date"]).format("YYYY-MM-DD")
+        date = parse_action_date(fields["date"], data)
     except:
-        print("[adjust_balance_action] ERROR: invalid date: "+fields["date"])
+        log("adjust_balance_action").error("invalid date: "+fields["date"])
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Invalid date"}]}), 400
 
     try:
         new_balance = int(round(float(fields["new_balance"])*1000))
-        amount = new_balance - old_balance
     except:
-        print("[adjust_balance_action] ERROR: invalid amount: "+\
+        log("adjust_balance_action").error("invalid amount: "+\
               fields["new_balance"])
         return json.dumps({"errors": [{"status": "SKIP",
                                        "message": "Invalid amount"}]}), 400
@@ -516,7 +956,6 @@ def ifttt_adjust_balance_action(default):
     body = {"transaction": {
         "account_id": account_id,
         "date": date,
-        "amount": amount,
     }}
     if fields["payee"] != "":
         body["transaction"]["payee_name"] = fields["payee"][:50]
@@ -533,19 +972,253 @@ def ifttt_adjust_balance_action(default):
     if fields["flag_color"] not in ["", "none"]:
         body["transaction"]["flag_color"] = fields["flag_color"]
 
-    print(json.dumps(body))
-    r = requests.post(YNAB_BASE + "/budgets/{}/transactions".format(budget), \
-        headers={"Authorization": "Bearer {}".format(get_ynab_key())}, \
-        json=body)
-    print(r.status_code, r.text)
-    if r.status_code > 299:
+    # Serialize adjustments per account, so a second adjustment sees the
+    # balance including the first one
+    with account_lease(budget, account_id) as held:
+        if not held:
+            return json.dumps({"errors": [{"message": "Account busy"}]}), 503
+        old_balance = get_cached_balance(budget, account_id)
+        if old_balance is None:
+            try:
+                get_ynab_accounts_raw(budget)
+            except YnabUnavailable:
+                log("adjust_balance_action").error("YNAB unavailable")
+                return json.dumps({"errors": [{"message":
+                                               "YNAB unavailable"}]}), 503
+            except:
+                traceback.print_exc()
+                log("adjust_balance_action").error("retrieving accounts")
+                return "", 500
+            old_balance = get_cached_balance(budget, account_id)
+        amount = new_balance - old_balance
+        body["transaction"]["amount"] = amount
+
+        log_payload(log("adjust_balance_action"), "request", body)
         try:
-            msg = "{} Bad request".format(r.status_code)
-            msg = r.json()["error"]["detail"]
-        except:
-            pass
+            r = ynab_post("/budgets/{}/transactions".format(budget), body)
+        except YnabUncertain:
+            # a retry would adjust the balance again
+            log("adjust_balance_action").error(
+                "YNAB did not confirm the adjustment")
+            invalidate_balance(budget, account_id)
+            return json.dumps({"errors": [{"status": "SKIP", "message":
+                               "YNAB did not confirm the adjustment"}]}), 400
+        except YnabUnavailable:
+            log("adjust_balance_action").error("YNAB unavailable")
+            return json.dumps({"errors": [{"message":
+                                           "YNAB unavailable"}]}), 503
+        log_payload(log("adjust_balance_action"), "response {}".format(
+            r.status_code), r.text, r.status_code > 299)
+        if r.status_code > 299:
+            try:
+                msg = "{} Bad request".format(r.status_code)
+                msg = r.json()["error"]["detail"]
+            except:
+                pass
+            return json.dumps({"errors": [{"status": "SKIP",
+                                           "message": msg}]}), 400
+
+        apply_balance_change(budget, account_id, amount,
+                             response_knowledge(r))
+        publish_knowledge(budget, response_knowledge(r))
+
+    return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
+
+
+###############################################################################
+# IFTTT bulk create transactions action                                       #
+###############################################################################
+
+BULK_MAX_TRANSACTIONS = 100
+BULK_COLUMNS = ["date", "amount", "payee", "category", "memo", "account"]
+
+@app.route("/ifttt/v1/actions/ynab_create_bulk", methods=["POST"])
+def ifttt_create_bulk_action_1():
+    return ifttt_create_bulk_action(False)
+
+@app.route("/ifttt/v1/actions/ynab_create_bulk_default", methods=["POST"])
+def ifttt_create_bulk_action_2():
+    return ifttt_create_bulk_action(True)
+
+def ifttt_create_bulk_action(default):
+    """ Endpoint to create multiple transactions in YNAB in one request
+
+    The transactions field contains one transaction per line, with the
+    comma separated columns date, amount, payee, category, memo and account.
+    Only the amount is required; the other columns fall back to the action
+    fields or are left empty.
+    """
+    if "IFTTT-Service-Key" not in request.headers or \
+            request.headers["IFTTT-Service-Key"] != get_ifttt_key():
+        log("create_bulk_action").error("invalid service key!")
+        return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
+    data = request.get_json()
+    if "actionFields" not in data:
+        log("create_bulk_action").error("missing actionFields")
+        return json.dumps({"errors": [{"status": "SKIP", \
+            "message": "Invalid data: actionFields missing"}]}), 400
+    fields = data["actionFields"]
+    for x in ["account", "transactions", "cleared", "approved", "flag_color",
+              "import_id"]:
+        if x not in fields:
+            log("create_bulk_action").error("missing field: "+x)
+            return json.dumps({"errors": [{"status": "SKIP", \
+                "message": "Invalid data: missing field: "+x}]}), 400
+    if not default and "budget" not in fields:
+        log("create_bulk_action").error("missing field: budget")
+        return json.dumps({"errors": [{"status": "SKIP", \
+            "message": "Invalid data: missing field: budget"}]}), 400
+
+    if default:
+        budget = get_default_budget()
+    else:
+        budget = fields["budget"]
+
+    if fields["account"] == "TEST#TEST#1":
+        return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
+    if fields["account"] == "TEST#TEST#2":
+        return json.dumps({"errors": [{"status": "SKIP",
+                                       "message": "Test"}]}), 400
+    if len(str(budget)) != 36:
+        log("create_bulk_action").error("incorrect budget (no uuid): "\
+              +budget)
+        return json.dumps({"errors": [{"status": "SKIP", \
+            "message": "Invalid data: incorrect budget: "+budget}]}), 400
+
+    lines = []
+    for row in csv.reader(io.StringIO(fields["transactions"])):
+        if [x for x in row if x.strip() != ""]:
+            line = dict(zip(BULK_COLUMNS, [x.strip() for x in row]))
+            for x in BULK_COLUMNS:
+                line.setdefault(x, "")
+            lines.append(line)
+    if not lines:
+        log("create_bulk_action").error("no transactions")
         return json.dumps({"errors": [{"status": "SKIP",
-                                       "message": msg}]}), 400
+                                       "message": "No transactions"}]}), 400
+    if len(lines) > BULK_MAX_TRANSACTIONS:
+        log("create_bulk_action").error("too many transactions: {}"
+              .format(len(lines)))
+        return json.dumps({"errors": [{"status": "SKIP",
+                                       "message": "Too many transactions"}]}),\
+               400
+
+    try:
+        accounts = get_ynab_accounts_raw(budget)
+    except YnabUnavailable:
+        log("create_bulk_action").error("YNAB unavailable")
+        return json.dumps({"errors": [{"message":
+                                       "YNAB unavailable"}]}), 503
+    except:
+        traceback.print_exc()
+        log("create_bulk_action").error("retrieving accounts")
+        return "", 500
+    category_ids = {}
+
+    transactions = []
+    for number, line in enumerate(lines, 1):
+        def skip(msg):
+            log("create_bulk_action").error("line {}: {}"
+                  .format(number, msg))
+            return json.dumps({"errors": [{"status": "SKIP", "message":
+                               "Line {}: {}".format(number, msg)}]}), 400
+
+        account = line["account"] or fields["account"]
+        found = find_ynab_account(accounts, account)
+        if found is None:
+            return skip("Account not found")
+
+        try:
+            date = parse_action_date(line["date"], data)
+        except:
+            return skip("Invalid date")
+
+        try:
+            amount = int(round(float(line["amount"])*1000))
+        except:
+            return skip("Invalid amount")
+
+        transaction = {
+            "account_id": found["id"],
+            "date": date,
+            "amount": amount,
+        }
+        if line["payee"] != "":
+            transaction["payee_name"] = line["payee"][:50]
+        if line["category"] != "":
+            if line["category"] not in category_ids:
+                try:
+                    category_ids[line["category"]] = \
+                        find_category_id(budget, line["category"])
+                except YnabUnavailable:
+                    log("create_bulk_action").error("YNAB unavailable")
+                    return json.dumps({"errors": [{"message":
+                                                   "YNAB unavailable"}]}), 503
+            category_id = category_ids[line["category"]]
+            if category_id is not None:
+                transaction["category_id"] = category_id
+            else:
+                log("create_bulk_action").warning("line {}: unknown "
+                      "category, ignored".format(number))
+        if line["memo"] != "":
+            transaction["memo"] = line["memo"][:200]
+        if fields["cleared"] != "":
+            transaction["cleared"] = fields["cleared"]
+        transaction["approved"] = (fields["approved"] == "true")
+        if fields["flag_color"] not in ["", "none"]:
+            transaction["flag_color"] = fields["flag_color"]
+        if fields["import_id"] != "":
+            transaction["import_id"] = "{}:{}".format(
+                fields["import_id"][:32], number)
+        transactions.append(transaction)
+
+    body = {"transactions": transactions}
+    log_payload(log("create_bulk_action"), "request", body)
+    # hold all accounts, so an adjustment does not compute from a balance
+    # without these amounts; in sorted order, so bulk actions cannot deadlock
+    with contextlib.ExitStack() as locks:
+        for account_id in sorted(set(t["account_id"] for t in transactions)):
+            if not locks.enter_context(account_lease(budget, account_id)):
+                return json.dumps({"errors": [{"message":
+                                               "Account busy"}]}), 503
+        try:
+            r = ynab_post("/budgets/{}/transactions".format(budget), body)
+        except YnabUnavailable as e:
+            if isinstance(e, YnabUncertain):
+                for account_id in set(t["account_id"] for t in transactions):
+                    invalidate_balance(budget, account_id)
+                # without import_ids, YNAB cannot recognize a retry
+                if fields["import_id"] == "":
+                    log("create_bulk_action").error(
+                        "YNAB did not confirm the transactions")
+                    return json.dumps({"errors": [{"status": "SKIP", "message":
+                        "YNAB did not confirm the transactions"}]}), 400
+            log("create_bulk_action").error("YNAB unavailable")
+            return json.dumps({"errors": [{"message":
+                                           "YNAB unavailable"}]}), 503
+        log_payload(log("create_bulk_action"), "response {}".format(
+            r.status_code), r.text, r.status_code > 299)
+        if r.status_code > 299:
+            try:
+                msg = "{} Bad request".format(r.status_code)
+                msg = r.json()["error"]["detail"]
+            except:
+                pass
+            return json.dumps({"errors": [{"status": "SKIP",
+                                           "message": msg}]}), 400
+
+        # only count what YNAB created: it skips the transactions whose
+        # import_id it already has, e.g. when IFTTT retries the action
+        created = created_transactions(r)
+        if created is None:
+            for account_id in set(t["account_id"] for t in transactions):
+                invalidate_balance(budget, account_id)
+        else:
+            for transaction in created:
+                apply_balance_change(budget, transaction["account_id"],
+                                     transaction["amount"],
+                                     response_knowledge(r))
+        publish_knowledge(budget, response_knowledge(r))
 
     return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
 
@@ -558,21 +1231,21 @@ def ifttt_adjust_balance_action(default):
 def ifttt_account_updated():
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[account_updated] ERROR: invalid IFTTT service key!")
+        log("account_updated").error("invalid IFTTT service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
 
     try:
         data = request.get_json()
-        print("[account_updated] input: {}".format(json.dumps(data)))
+        log_payload(log("account_updated"), "input", data)
 
         if "triggerFields" not in data or\
                 "budget" not in data["triggerFields"]:
-            print("[account_updated] ERROR: budget field missing!")
+            log("account_updated").error("budget field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         budget = data["triggerFields"]["budget"]
 
         if "trigger_identity" not in data:
-            print("[account_updated] ERROR: trigger_identity field missing!")
+            log("account_updated").error("trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         triggerid = data["trigger_identity"]
 
@@ -580,16 +1253,23 @@ def ifttt_account_updated():
         if "limit" in data:
             limit = data["limit"]
 
+        try:
+            cursor = feed_cursor(data)
+        except ValueError:
+            log("account_updated").error("invalid cursor!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         timezone = "UTC"
         if "user" in data and "timezone" in data["user"]:
             timezone = data["user"]["timezone"]
 
+        etag = None
         if budget == "TEST#TEST":
             results = ifttt_account_updated_test()
         else:
-            entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+            entity = ds_get(ds_key("budget", budget))
             if entity is None:
-                print("[account_updated] WARNING: unknown budget "+budget)
+                log("account_updated").warning("unknown budget "+budget)
                 results = []
             else:
                 data = json.loads(entity["accounts"])
@@ -598,24 +1278,26 @@ def ifttt_account_updated():
                 else:
                     triggers = data["triggers"]
                 if triggerid not in triggers:
-                    print("Adding new trigger: "+triggerid)
+                    log("account_updated").info("Adding new trigger: %s",
+                                                triggerid)
                     triggers.append(triggerid)
                     data["triggers"] = triggers
-                    entity["accounts"] = json.dumps(data)
-                    DSCLIENT.put(entity)
+                    queue_update(entity.key,
+                                 trigger_update("accounts", triggerid))
 
-                results = data["changed"]
+                etag = poll_etag(entity, data)
+                if etag_matches(etag):
+                    return json_response(None, etag)
 
-        for result in results:
-            result["created_at"] = arrow.get(result["created_at"])\
-                                   .to(timezone).isoformat()
+                results = feed_changes(budget, "accounts", data, limit,
+                                       cursor=cursor)
 
-        print("[account_updated] Found {} updates".format(len(results)))
-        return json.dumps({"data": results[:limit]})
+        log("account_updated").info("Found %d updates", len(results))
+        return json_response(feed_response(results, limit, timezone), etag)
 
     except:
         traceback.print_exc()
-        print("[account_updated] ERROR: cannot retrieve transactions")
+        log("account_updated").error("cannot retrieve transactions")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve transactions"}]}), 400
 
@@ -647,21 +1329,21 @@ def ifttt_account_updated_test():
 def ifttt_category_updated():
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[category_updated] ERROR: invalid IFTTT service key!")
+        log("category_updated").error("invalid IFTTT service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
 
     try:
         data = request.get_json()
-        print("[category_updated] input: {}".format(json.dumps(data)))
+        log_payload(log("category_updated"), "input", data)
 
         if "triggerFields" not in data or\
                 "budget" not in data["triggerFields"]:
-            print("[category_updated] ERROR: budget field missing!")
+            log("category_updated").error("budget field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         budget = data["triggerFields"]["budget"]
 
         if "trigger_identity" not in data:
-            print("[category_updated] ERROR: trigger_identity field missing!")
+            log("category_updated").error("trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         triggerid = data["trigger_identity"]
 
@@ -669,16 +1351,23 @@ def ifttt_category_updated():
         if "limit" in data:
             limit = data["limit"]
 
+        try:
+            cursor = feed_cursor(data)
+        except ValueError:
+            log("category_updated").error("invalid cursor!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         timezone = "UTC"
         if "user" in data and "timezone" in data["user"]:
             timezone = data["user"]["timezone"]
 
+        etag = None
         if budget == "TEST#TEST":
             results = ifttt_category_updated_test()
         else:
-            entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+            entity = ds_get(ds_key("budget", budget))
             if entity is None:
-                print("[category_updated] WARNING: unknown budget "+budget)
+                log("category_updated").warning("unknown budget "+budget)
                 results = []
             else:
                 data = json.loads(entity["categories"])
@@ -687,24 +1376,26 @@ def ifttt_category_updated():
                 else:
                     triggers = data["triggers"]
                 if triggerid not in triggers:
-                    print("Adding new trigger: "+triggerid)
+                    log("category_updated").info("Adding new trigger: %s",
+                                                 triggerid)
                     triggers.append(triggerid)
                     data["triggers"] = triggers
-                    entity["categories"] = json.dumps(data)
-                    DSCLIENT.put(entity)
+                    queue_update(entity.key,
+                                 trigger_update("categories", triggerid))
 
-                results = data["changed"]
+                etag = poll_etag(entity, data)
+                if etag_matches(etag):
+                    return json_response(None, etag)
 
-        for result in results:
-            result["created_at"] = arrow.get(result["created_at"])\
-                                   .to(timezone).isoformat()
+                results = feed_changes(budget, "categories", data, limit,
+                                       cursor=cursor)
 
-        print("[category_updated] Found {} updates".format(len(results)))
-        return json.dumps({"data": results[:limit]})
+        log("category_updated").info("Found %d updates", len(results))
+        return json_response(feed_response(results, limit, timezone), etag)
 
     except:
         traceback.print_exc()
-        print("[category_updated] ERROR: cannot retrieve transactions")
+        log("category_updated").error("cannot retrieve transactions")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve transactions"}]}), 400
 
@@ -750,32 +1441,32 @@ def ifttt_category_month_updated_default():
 def ifttt_category_month_updated_implementation(default):
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[cat_month_updated] ERROR: invalid IFTTT service key!")
+        log("cat_month_updated").error("invalid IFTTT service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
 
     try:
         data = request.get_json()
-        print("[cat_month_updated] input: {}".format(json.dumps(data)))
+        log_payload(log("cat_month_updated"), "input", data)
 
         if default:
             budget = get_default_budget()
         else:
             if "triggerFields" not in data or\
                     "budget" not in data["triggerFields"]:
-                print("[cat_month_updated] ERROR: budget field missing!")
+                log("cat_month_updated").error("budget field missing!")
                 return json.dumps({"errors": [{"message": "Invalid data"}]}),\
                        400
             budget = data["triggerFields"]["budget"]
 
         if "triggerFields" not in data or\
                 "category" not in data["triggerFields"]:
-            print("[cat_month_updated] ERROR: category field missing!")
+            log("cat_month_updated").error("category field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}),\
                    400
         category = data["triggerFields"]["category"]
 
         if "trigger_identity" not in data:
-            print("[cat_month_updated] ERROR: trigger_identity field missing!")
+            log("cat_month_updated").error("trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         triggerid = data["trigger_identity"]
 
@@ -783,64 +1474,67 @@ def ifttt_category_month_updated_implementation(default):
         if "limit" in data:
             limit = data["limit"]
 
+        try:
+            cursor = feed_cursor(data)
+        except ValueError:
+            log("cat_month_updated").error("invalid cursor!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         timezone = "UTC"
         if "user" in data and "timezone" in data["user"]:
             timezone = data["user"]["timezone"]
 
+        etag = None
         if category == "TEST#TEST":
             results = ifttt_category_month_updated_test()
         else:
-            entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+            entity = ds_get(ds_key("budget", budget))
             if entity is None:
-                print("[cat_month_updated] WARNING: unknown budget "+budget)
+                log("cat_month_updated").warning("unknown budget "+budget)
                 results = []
             else:
-                cats = json.loads(entity["categories"])
+                data = json.loads(entity["month_categories"])
                 if category != "":
-                    if category not in cats["data"]:
-                        for cat in cats["data"]:
-                            catdata = cats["data"][cat]
-                            if category == catdata[1] + " - " + catdata[0]:
-                                category = cat
-                    if category not in cats["data"]:
-                        for cat in cats["data"]:
-                            if category == cats["data"][cat][0]:
-                                category = cat
-                    if category not in cats["data"]:
-                        print("[cat_month_updated] ERROR: category not found!")
+                    if "lookup" in data:
+                        lookup = data["lookup"]
+                    else:
+                        lookup = category_lookup(
+                            json.loads(entity["categories"]))
+                    if category not in lookup:
+                        log("cat_month_updated").error("category not found!")
                         return json.dumps({"errors": [{"message":\
                                         "Invalid data"}]}), 400
+                    category = lookup[category]
 
-                data = json.loads(entity["month_categories"])
                 if "triggers" not in data:
                     triggers = []
                 else:
                     triggers = data["triggers"]
                 if triggerid not in triggers:
-                    print("Adding new trigger: "+triggerid)
+                    log("cat_month_updated").info("Adding new trigger: %s",
+                                                  triggerid)
                     triggers.append(triggerid)
                     data["triggers"] = triggers
-                    entity["month_categories"] = json.dumps(data)
-                    DSCLIENT.put(entity)
+                    queue_update(entity.key,
+                                 trigger_update("month_categories", triggerid))
+
+                etag = poll_etag(entity, data)
+                if etag_matches(etag):
+                    return json_response(None, etag)
 
                 if category == "":
-                    results = data["changed"]
+                    results = feed_changes(budget, "month_categories", data,
+                                           limit, cursor=cursor)
                 else:
-                    results = []
-                    for change in data["changed"]:
-                        if change["category_id"] == category:
-                            results.append(change)
+                    results = feed_changes(budget, "month_categories", data,
+                                           limit, category, cursor)
 
-        for result in results:
-            result["created_at"] = arrow.get(result["created_at"])\
-                                   .to(timezone).isoformat()
-
-        print("[cat_month_updated] Found {} updates".format(len(results)))
-        return json.dumps({"data": results[:limit]})
+        log("cat_month_updated").info("Found %d updates", len(results))
+        return json_response(feed_response(results, limit, timezone), etag)
 
     except:
         traceback.print_exc()
-        print("[cat_month_updated] ERROR: cannot retrieve transactions")
+        log("cat_month_updated").error("cannot retrieve transactions")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve transactions"}]}), 400
 
@@ -877,21 +1571,21 @@ def ifttt_category_month_updated_test():
 def ifttt_month_updated():
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[month_updated] ERROR: invalid IFTTT service key!")
+        log("month_updated").error("invalid IFTTT service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
 
     try:
         data = request.get_json()
-        print("[month_updated] input: {}".format(json.dumps(data)))
+        log_payload(log("month_updated"), "input", data)
 
         if "triggerFields" not in data or\
                 "budget" not in data["triggerFields"]:
-            print("[month_updated] ERROR: budget field missing!")
+            log("month_updated").error("budget field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         budget = data["triggerFields"]["budget"]
 
         if "trigger_identity" not in data:
-            print("[month_updated] ERROR: trigger_identity field missing!")
+            log("month_updated").error("trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         triggerid = data["trigger_identity"]
 
@@ -899,16 +1593,23 @@ def ifttt_month_updated():
         if "limit" in data:
             limit = data["limit"]
 
+        try:
+            cursor = feed_cursor(data)
+        except ValueError:
+            log("month_updated").error("invalid cursor!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         timezone = "UTC"
         if "user" in data and "timezone" in data["user"]:
             timezone = data["user"]["timezone"]
 
+        etag = None
         if budget == "TEST#TEST":
             results = ifttt_month_updated_test()
         else:
-            entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+            entity = ds_get(ds_key("budget", budget))
             if entity is None:
-                print("[month_updated] WARNING: unknown budget "+budget)
+                log("month_updated").warning("unknown budget "+budget)
                 results = []
             else:
                 months = json.loads(entity["months"])
@@ -917,24 +1618,26 @@ def ifttt_month_updated():
                 else:
                     triggers = months["triggers"]
                 if triggerid not in triggers:
-                    print("Adding new trigger: "+triggerid)
+                    log("month_updated").info("Adding new trigger: %s",
+                                              triggerid)
                     triggers.append(triggerid)
                     months["triggers"] = triggers
-                    entity["months"] = json.dumps(months)
-                    DSCLIENT.put(entity)
-            results = months["changed"]
+                    queue_update(entity.key,
+                                 trigger_update("months", triggerid))
+
+                etag = poll_etag(entity, months)
+                if etag_matches(etag):
+                    return json_response(None, etag)
 
-        for result in results:
-            result["created_at"] = arrow.get(result["created_at"])\
-                                    .to(timezone).isoformat()
+                results = feed_changes(budget, "months", months, limit,
+                                       cursor=cursor)
 
-        print("[month_updated] Found {} updates"
-              .format(len(results)))
-        return json.dumps({"data": results[:limit]})
+        log("month_updated").info("Found %d updates", len(results))
+        return json_response(feed_response(results, limit, timezone), etag)
 
     except:
         traceback.print_exc()
-        print("[month_updated] ERROR: cannot retrieve transactions")
+        log("month_updated").error("cannot retrieve transactions")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve transactions"}]}), 400
 
@@ -964,21 +1667,21 @@ def ifttt_month_updated_test():
 def ifttt_payee_updated():
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[payee_updated] ERROR: invalid IFTTT service key!")
+        log("payee_updated").error("invalid IFTTT service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
 
     try:
         data = request.get_json()
-        print("[payee_updated] input: {}".format(json.dumps(data)))
+        log_payload(log("payee_updated"), "input", data)
 
         if "triggerFields" not in data or\
                 "budget" not in data["triggerFields"]:
-            print("[payee_updated] ERROR: budget field missing!")
+            log("payee_updated").error("budget field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         budget = data["triggerFields"]["budget"]
 
         if "trigger_identity" not in data:
-            print("[payee_updated] ERROR: trigger_identity field missing!")
+            log("payee_updated").error("trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         triggerid = data["trigger_identity"]
 
@@ -986,16 +1689,23 @@ def ifttt_payee_updated():
         if "limit" in data:
             limit = data["limit"]
 
+        try:
+            cursor = feed_cursor(data)
+        except ValueError:
+            log("payee_updated").error("invalid cursor!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         timezone = "UTC"
         if "user" in data and "timezone" in data["user"]:
             timezone = data["user"]["timezone"]
 
+        etag = None
         if budget == "TEST#TEST":
             results = ifttt_payee_updated_test()
         else:
-            entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+            entity = ds_get(ds_key("budget", budget))
             if entity is None:
-                print("[payee_updated] WARNING: unknown budget "+budget)
+                log("payee_updated").warning("unknown budget "+budget)
                 results = []
             else:
                 data = json.loads(entity["payees"])
@@ -1004,24 +1714,26 @@ def ifttt_payee_updated():
                 else:
                     triggers = data["triggers"]
                 if triggerid not in triggers:
-                    print("Adding new trigger: "+triggerid)
+                    log("payee_updated").info("Adding new trigger: %s",
+                                              triggerid)
                     triggers.append(triggerid)
                     data["triggers"] = triggers
-                    entity["payees"] = json.dumps(data)
-                    DSCLIENT.put(entity)
+                    queue_update(entity.key,
+                                 trigger_update("payees", triggerid))
 
-                results = data["changed"]
+                etag = poll_etag(entity, data)
+                if etag_matches(etag):
+                    return json_response(None, etag)
 
-        for result in results:
-            result["created_at"] = arrow.get(result["created_at"])\
-                                   .to(timezone).isoformat()
+                results = feed_changes(budget, "payees", data, limit,
+                                       cursor=cursor)
 
-        print("[payee_updated] Found {} updates".format(len(results)))
-        return json.dumps({"data": results[:limit]})
+        log("payee_updated").info("Found %d updates", len(results))
+        return json_response(feed_response(results, limit, timezone), etag)
 
     except:
         traceback.print_exc()
-        print("[payee_updated] ERROR: cannot retrieve transactions")
+        log("payee_updated").error("cannot retrieve transactions")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve transactions"}]}), 400
 
@@ -1046,38 +1758,51 @@ def ifttt_payee_updated_test():
 def ifttt_transaction_updated():
     if "IFTTT-Service-Key" not in request.headers or \
             request.headers["IFTTT-Service-Key"] != get_ifttt_key():
-        print("[transaction_updated] ERROR: invalid IFTTT service key!")
+        log("transaction_updated").error("invalid IFTTT service key!")
         return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
 
     try:
         data = request.get_json()
-        print("[transaction_updated] input: {}".format(json.dumps(data)))
+        log_payload(log("transaction_updated"), "input", data)
 
         if "triggerFields" not in data or\
                 "budget" not in data["triggerFields"]:
-            print("[transaction_updated] ERROR: budget field missing!")
+            log("transaction_updated").error("budget field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         budget = data["triggerFields"]["budget"]
 
         if "trigger_identity" not in data:
-            print("[transaction_updated] ERROR: trigger_identity field missing!")
+            log("transaction_updated").error("trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         triggerid = data["trigger_identity"]
 
+        try:
+            spec = transaction_filter(data["triggerFields"])
+        except ValueError:
+            log("transaction_updated").error("invalid amount filter!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         limit = 50
         if "limit" in data:
             limit = data["limit"]
 
+        try:
+            cursor = feed_cursor(data)
+        except ValueError:
+            log("transaction_updated").error("invalid cursor!")
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
         timezone = "UTC"
         if "user" in data and "timezone" in data["user"]:
             timezone = data["user"]["timezone"]
 
+        etag = None
         if budget == "TEST#TEST":
             results = ifttt_transaction_updated_test()
         else:
-            entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+            entity = ds_get(ds_key("budget", budget))
             if entity is None:
-                print("[transaction_updated] WARNING: unknown budget "+budget)
+                log("transaction_updated").warning("unknown budget "+budget)
                 results = []
             else:
                 data = json.loads(entity["transactions"])
@@ -1085,25 +1810,39 @@ def ifttt_transaction_updated():
                     triggers = []
                 else:
                     triggers = data["triggers"]
+                changed = False
                 if triggerid not in triggers:
-                    print("Adding new trigger: "+triggerid)
+                    log("transaction_updated").info("Adding new trigger: %s",
+                                                    triggerid)
                     triggers.append(triggerid)
                     data["triggers"] = triggers
-                    entity["transactions"] = json.dumps(data)
-                    DSCLIENT.put(entity)
+                    changed = True
+                if data.get("filters", {}).get(triggerid) != spec:
+                    log("transaction_updated").info(
+                        "Updating trigger filter: %s", triggerid)
+                    update_transaction_filter(data, triggerid, spec)
+                    changed = True
+                if changed:
+                    queue_update(entity.key, trigger_update("transactions",
+                                                            triggerid, spec))
 
-                results = data["changed"]
+                etag = poll_etag(entity, data)
+                if etag_matches(etag):
+                    return json_response(None, etag)
 
-        for result in results:
-            result["created_at"] = arrow.get(result["created_at"])\
-                                   .to(timezone).isoformat()
+                if spec is None:
+                    results = feed_changes(budget, "transactions", data,
+                                           limit, cursor=cursor)
+                else:
+                    results = feed_changes(budget, "transactions", data,
+                                           limit, triggerid, cursor)
 
-        print("[transaction_updated] Found {} updates".format(len(results)))
-        return json.dumps({"data": results[:limit]})
+        log("transaction_updated").info("Found %d updates", len(results))
+        return json_response(feed_response(results, limit, timezone), etag)
 
     except:
         traceback.print_exc()
-        print("[transaction_updated] ERROR: cannot retrieve transactions")
+        log("transaction_updated").error("cannot retrieve transactions")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve transactions"}]}), 400
 
@@ -1123,13 +1862,104 @@ def ifttt_transaction_updated_test():
         item["approved"] = True
         item["flag_color"] = "red"
         item["account"] = "Piggy bank"
+        item["account_id"] = "8d5a4bb2-5a43-4b9e-9f2c-1f6f3b0f7c11"
         item["payee"] = "Acme Market"
+        item["payee_id"] = "2f0e6c3e-8c1b-4a51-a1f4-6a7e7d5b9c22"
         item["category"] = "Supermarket"
+        item["category_id"] = "c4b1d6a9-3e2f-4f7a-8d0b-5e9a2c6f1d33"
         item["category_group"] = "Personal expenses"
         item["transfer_account"] = ""
     return [item1, item2, item3]
 
 
+# Compiled filter predicates, per trigger identity
+TRANSACTION_PREDICATES = {}
+
+def filter_options(options, field):
+    """ Flattens the options of a snapshot into one list of ids """
+    if field == "payees":
+        # snapshots stored before the payees were added have none
+        return options.get("payees", [])
+    values = []
+    for group in options[field]:
+        for value in group["values"]:
+            if field == "categories":
+                values.append({"label": "- " + group["label"] + ": " +
+                               value["alias2"], "value": value["value"]})
+            else:
+                values.append({"label": value["label"],
+                               "value": value["value"]})
+    return values
+
+def transaction_filter(fields):
+    """ Returns the filter spec from the trigger fields, None if no filter
+
+    Raises ValueError if an amount field is not a number.
+    """
+    spec = {}
+    for x in ["account", "payee", "category", "flag_color"]:
+        if fields.get(x, "").strip() not in ["", "any"]:
+            spec[x] = fields[x].strip().lower()
+    for x in ["amount_min", "amount_max"]:
+        if fields.get(x, "").strip() != "":
+            spec[x] = float(fields[x])
+    if not spec:
+        return None
+    return spec
+
+def compile_transaction_filter(spec):
+    """ Compiles a filter spec into a predicate on transaction changes """
+    tests = []
+    for x in ["account", "payee", "category"]:
+        if x in spec:
+            # the options give the id, a typed in value may be the name;
+            # changes stored before the ids were added only have the name
+            tests.append(lambda change, x=x, value=spec[x]:
+                         value in [(change.get(x + "_id") or "").lower(),
+                                   (change[x] or "").lower()])
+    if "flag_color" in spec:
+        tests.append(lambda change, value=spec["flag_color"]:
+                     (change["flag_color"] or "").lower() == value)
+    if "amount_min" in spec:
+        tests.append(lambda change, value=spec["amount_min"]:
+                     float(change["amount"]) >= value)
+    if "amount_max" in spec:
+        tests.append(lambda change, value=spec["amount_max"]:
+                     float(change["amount"]) <= value)
+
+    def predicate(change):
+        for test in tests:
+            if not test(change):
+                return False
+        return True
+    return predicate
+
+def transaction_predicate(triggerid, spec):
+    """ Returns the (cached) compiled predicate of a trigger identity """
+    if triggerid in TRANSACTION_PREDICATES and \
+            TRANSACTION_PREDICATES[triggerid][0] == spec:
+        return TRANSACTION_PREDICATES[triggerid][1]
+    predicate = compile_transaction_filter(spec)
+    TRANSACTION_PREDICATES[triggerid] = (spec, predicate)
+    return predicate
+
+def update_transaction_filter(result, triggerid, spec):
+    """ Sets (or removes) the filter of a trigger on the transaction feed """
+    filters = result.get("filters", {})
+    index = result.get("index", {})
+    if spec is None:
+        filters.pop(triggerid, None)
+        index.pop(triggerid, None)
+        TRANSACTION_PREDICATES.pop(triggerid, None)
+    else:
+        filters[triggerid] = spec
+        predicate = transaction_predicate(triggerid, spec)
+        index[triggerid] = [i for i, change in enumerate(result["changed"])
+                            if predicate(change)]
+    result["filters"] = filters
+    result["index"] = index
+
+
 ###############################################################################
 # IFTTT delete trigger method                                                 #
 ###############################################################################
@@ -1150,8 +1980,11 @@ def ifttt_transaction_updated_test():
            "trigger_identity/<triggerid>", methods=["DELETE"])
 def ifttt_delete_trigger(triggerid):
     budgets = get_ynab_budgets()
-    for budget in [b["value"] for b in budgets]:
-        entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
+    # store queued trigger registrations first, so they cannot re-add it
+    flush_writes()
+    keys = [ds_key("budget", b["value"]) for b in budgets]
+    changed = {}
+    for entity in ds_get_multi(keys).values():
         if entity is not None:
             for typ in ['accounts', 'categories', 'months', 'month_categories',
                         'payees', 'transactions']:
@@ -1165,173 +1998,444 @@ def ifttt_delete_trigger(triggerid):
                                 if trig != triggerid:
                                     newtriggers.append(trig)
                             data["triggers"] = newtriggers
+                            if triggerid in data.get("filters", {}):
+                                update_transaction_filter(data, triggerid,
+                                                          None)
                             entity[typ] = json.dumps(data)
-                            DSCLIENT.put(entity)
+                            changed[entity.key] = entity
+    if changed:
+        ds_put_multi(list(changed.values()))
+    return ""
 
 
 ###############################################################################
 # YNAB interface methods                                                      #
 ###############################################################################
 
-YNAB_BUDGETS = []
+# A sync stops processing collections after SYNC_TIME_BUDGET seconds,
+# leaving time to store its progress within the 10 minute request deadline
+# of cron and task requests. The response and the collections done are
+# checkpointed, and the next run resumes from there instead of fetching the
+# budget again.
+SYNC_TIME_BUDGET = float(os.environ.get("SYNC_TIME_BUDGET", "480"))
+SYNC_COLLECTIONS = ["accounts", "categories", "months", "month_categories",
+                    "payees", "transactions"]
+# The fields of a budget response holding the delta of each collection; a
+# collection without changes is neither decoded nor stored again. The
+# month_categories feed also stores the category lookup of its polls, so it
+# depends on the categories too.
+SYNC_DELTAS = {
+    "accounts": ["accounts"],
+    "categories": ["categories", "category_groups"],
+    "months": ["months"],
+    "month_categories": ["months", "categories", "category_groups"],
+    "payees": ["payees"],
+    "transactions": ["transactions"],
+}
+CHECKPOINT_CHUNK = 900000
 
 @app.route("/cron/ynab", methods=["GET"])
 def cron():
+    """ Enqueues a sync task for every budget that needs one """
+    lease = start_lease("cron")
+    if lease is None:
+        log("cron").info("Previous dispatch still running, skipping")
+        return ""
+    try:
+        deadline = time.time() + SYNC_TIME_BUDGET
+        tenants = [None] + list_tenants()
+        # start with another tenant every minute, and give every tenant an
+        # equal share of the time left, so one large account cannot starve
+        # the others
+        start = int(time.time() // 60) % len(tenants)
+        tenants = tenants[start:] + tenants[:start]
+        for i, tenant in enumerate(tenants):
+            if lease["lost"]:
+                log("cron").error("Lease lost, another dispatch took over")
+                break
+            share = (deadline - time.time()) / (len(tenants) - i)
+            with tenant_context(tenant):
+                dispatch_tenant(lease, time.time() + share)
+        # the syncs on local workers run within this request
+        drain_local_tasks()
+    finally:
+        end_lease(lease)
+    return ""
+
+def dispatch_tenant(lease, deadline):
+    """ Enqueues the sync tasks and delivers notifications of a tenant """
+    try:
+        if not ynab_available():
+            log("cron").warning("YNAB circuit breaker open for tenant %s, "
+                                "skipping sync", CURRENT_TENANT.get())
+            return
+        dispatch_syncs(lease, deadline)
+        # retries failed and debounced notifications
+        deliver_notifications()
+    except:
+        # a failing tenant must not keep the others from syncing
+        traceback.print_exc()
+
+def dispatch_syncs(lease, deadline):
+    """ Enqueues the sync tasks of the changed budgets """
     now = arrow.now()
-    global YNAB_BUDGETS
-    if not YNAB_BUDGETS:
-        entity = DSCLIENT.get(DSCLIENT.key("budget", "budgets"))
-        if entity is not None:
-            YNAB_BUDGETS = json.loads(entity["data"])
-        else:
-            entity = datastore.Entity(DSCLIENT.key("budget", "budgets"))
+    # the sync tasks, possibly on other instances, store the synced state of
+    # each budget in the budget list, so always read it fresh
+    entity = ds_get(ds_key("budget", "budgets"))
+    if entity is not None:
+        TENANT_CACHE["budgets"] = json.loads(entity["data"])
+    stored = TENANT_CACHE.get("budgets", [])
+    synced = {}
+    for b in stored:
+        synced[b['id']] = b['last_modified_on']
 
     budgets = get_ynab_budgets_raw()
+    listed = [(a['id'], a['name']) for a in budgets]
+    if budgets and listed != [(b['id'], b['name']) for b in stored]:
+        store_budget_list(budgets)
+
     to_process = []
     for a in budgets:
-        changed = False
-        found = False
-        for b in YNAB_BUDGETS:
-            if a['id'] == b['id']:
-                found = True
-                if a['last_modified_on'] != b['last_modified_on']:
-                    changed = True
-        if changed or not found:
-            to_process.append(a['id'])
+        if a['id'] not in synced or \
+                a['last_modified_on'] != synced[a['id']]:
+            to_process.append(a)
         elif now.minute in [0, 15, 30, 45]:
             # Process all every 15 minutes anyway as automated imports do not
             # trigger an update to last_modified_on.
-            to_process.append(a['id'])
-
-    print("Updating:", to_process)
-    triggers = []
-    for budget in to_process:
-
-        entity = DSCLIENT.get(DSCLIENT.key("budget", budget))
-        if entity is None:
-            entity = datastore.Entity(DSCLIENT.key("budget", budget),\
-                     exclude_from_indexes=['config', 'accounts', 'categories',
-                                           'months', 'month_categories',
-                                           'payees', 'transactions'])
-            entity['accounts'] = json.dumps({})
-            entity['categories'] = json.dumps({})
-            entity['months'] = json.dumps({})
-            entity['month_categories'] = json.dumps({})
-            entity['payees'] = json.dumps({})
-            entity['transactions'] = json.dumps({})
-            first = True
-        else:
-            first = False
-            knowledge = json.loads(entity['config'])['knowledge']
+            to_process.append(a)
+
+    log("cron").info("Updating: %s", [a['id'] for a in to_process])
+    for a in to_process:
+        if lease["lost"]:
+            log("cron").error("Lease lost, another dispatch took over")
+            return
+        name = "sync-{}-{}-{}".format(CURRENT_TENANT.get() or "default",
+                                      a['id'], now.format("YYYYMMDDHHmm"))
+        if not enqueue_sync(a['id'], a['last_modified_on'], name, deadline):
+            log("cron").warning("Deadline reached, leaving the other "
+                                "budgets to the next run")
+            return
+
+@app.route("/cron/ynab/<budget>", methods=["GET", "POST"])
+def cron_budget(budget):
+    """ Syncs one budget, as a task enqueued by the cron job """
+    # App Engine removes this header from requests not sent by a task queue
+    if TASK_HEADER not in request.headers:
+        return "", 403
+    return "", run_sync(budget, request.args.get("modified"),
+                        time.time() + SYNC_TIME_BUDGET)
+
+def run_sync(budget, modified, deadline):
+    """ Syncs one budget under its lease, returns the status of the task """
+    try:
+        # a sync on a local worker runs outside a request of its tenant, so
+        # before_request did not check its generation
+        check_generation()
+    except:
+        traceback.print_exc()
+    if not ynab_available():
+        # the task is retried once the circuit breaker closes
+        return 503
+    lease = start_lease("budget/" + budget)
+    if lease is None:
+        log("cron").info("Budget %s is already syncing, skipping", budget)
+        return 200
+    try:
+        sync_one(budget, modified, lease, deadline)
+    except YnabUnavailable as e:
+        log("cron").warning("Sync of budget %s failed: %s", budget, e)
+        return 503
+    except:
+        traceback.print_exc()
+        return 500
+    finally:
+        end_lease(lease)
+    return 200
 
-        url = YNAB_BASE + "/budgets/{}".format(budget)
+def sync_one(budget, modified, lease, deadline):
+    """ Syncs one budget and notifies IFTTT of its changes """
+    now = arrow.now()
+    rpcs = dict(DS_RPCS)
+    # make sure newly registered triggers are included in this run
+    flush_writes()
+    found = ds_get_multi([ds_key("budget", budget), ds_key("sync", budget),
+                          ds_key("budget", "budgets")])
+    entity = found.get(ds_key("budget", budget))
+    checkpoint = found.get(ds_key("sync", budget))
+    budgets = found.get(ds_key("budget", "budgets"))
+    knowledge = None
+    if entity is None:
+        entity = new_budget_entity(budget)
+    else:
+        knowledge = json.loads(entity['config'])['knowledge']
+    first = knowledge is None
+    if not first and budgets is not None:
+        # a sync without changes only records its knowledge in the list
+        synced = json.loads(budgets.get("synced", "{}"))
+        knowledge = max(knowledge, synced.get(budget, 0))
+
+    result = None
+    done = []
+    if checkpoint is not None and checkpoint["base"] == knowledge:
+        result = load_checkpoint(budget, checkpoint)
+    resumed = result is not None
+    if resumed:
+        log("cron").info("Resuming sync of %s after %s", budget,
+                         checkpoint["done"])
+        done = json.loads(checkpoint["done"])
+        first = checkpoint["first"]
+    else:
+        path = "/budgets/{}".format(budget)
         if not first:
-            url += "?last_knowledge_of_server={}".format(knowledge)
+            path += "?last_knowledge_of_server={}".format(knowledge)
 
-        r = requests.get(url,\
-            headers={"Authorization": "Bearer {}".format(get_ynab_key())})
+        r = ynab_get(path, YNAB_SYNC_TIMEOUT)
+        if YNAB_RECORD_DIR is not None:
+            record_response(budget, path, r)
         result = r.json()["data"]
-        data = result["budget"]
+    triggers = []
+    pageputs = []
+    pagedeletes = []
+    states = {}
+    processed = sync_budget(budget, entity, first, result, now, triggers,
+                            pageputs, pagedeletes, done, deadline, states)
+    finished = processed is not None
+
+    if lease["lost"]:
+        log("cron").error("Lease lost, another sync of %s took over", budget)
+        return
+    if not finished:
+        # the next dispatch resumes from the checkpoint
+        if resumed:
+            checkpoint["done"] = json.dumps(done)
+            puts = [checkpoint]
+        else:
+            puts = checkpoint_entities(budget, knowledge, first, done,
+                                       result)
+        pageputs.extend(puts)
+        if checkpoint is not None and not resumed:
+            # chunks of an outdated checkpoint that were not overwritten
+            keys = set(put.key for put in puts)
+            pagedeletes.extend(key for key in checkpoint_keys(
+                budget, checkpoint) if key not in keys)
+    elif checkpoint is not None:
+        pagedeletes.extend(checkpoint_keys(budget, checkpoint))
+    if processed != []:
+        pageputs.append(entity)
+    if pageputs:
+        ds_put_multi(pageputs)
+    if pagedeletes:
+        ds_delete_multi(pagedeletes)
+    checkin_states(budget, entity, states)
+    if finished:
+        commit_budget_sync(budget, result["budget"]["name"], modified,
+                           result["server_knowledge"])
 
-        config = {
-            'id': data['id'],
-            'name': data['name'],
-            'knowledge': result['server_knowledge']
-        }
-        entity['config'] = json.dumps(config)
-
-        accounts = json.loads(entity["accounts"])
-        accounts = process_accounts(accounts,
-                                    data["accounts"],
-                                    data["currency_format"],
-                                    result['server_knowledge'],
-                                    first,
-                                    triggers)
-        entity["accounts"] = json.dumps(accounts)
-
-        categories = json.loads(entity["categories"])
-        categories = process_categories(categories,
-                                        data["categories"],
-                                        data["category_groups"],
+    if triggers:
+        log("cron").info("Updating triggers: %s", triggers)
+        # queued only now, so IFTTT cannot poll before the data is stored
+        now = time.time()
+        update_notify_queue(
+            lambda state: queue_notifications(state, triggers, now))
+        deliver_notifications()
+    log("cron").info("Budget %s Datastore RPCs: %s, state cache: %s",
+                     budget, ds_rpcs_since(rpcs), state_cache_summary())
+
+def new_budget_entity(budget):
+    """ Returns the entity of a budget that was not synced before """
+    entity = datastore.Entity(ds_key("budget", budget),\
+             exclude_from_indexes=['config', 'accounts', 'categories',
+                                   'months', 'month_categories',
+                                   'payees', 'transactions'])
+    entity['accounts'] = json.dumps({})
+    entity['categories'] = json.dumps({})
+    entity['months'] = json.dumps({})
+    entity['month_categories'] = json.dumps({})
+    entity['payees'] = json.dumps({})
+    entity['transactions'] = json.dumps({})
+    return entity
+
+def checkpoint_entities(budget, base, first, done, result):
+    """ Returns the entities of a sync checkpoint
+
+    The checkpoint holds the collections done so far and the budget
+    response they came from, compressed and split over entities of at most
+    CHECKPOINT_CHUNK bytes.
+    """
+    entity = datastore.Entity(ds_key("sync", budget),
+                              exclude_from_indexes=["done"])
+    entity["base"] = base
+    entity["first"] = first
+    entity["done"] = json.dumps(done)
+    entities = [entity]
+    blob = zlib.compress(json.dumps(result).encode("utf-8"))
+    entity["chunks"] = 0
+    for i in range(0, len(blob), CHECKPOINT_CHUNK):
+        chunk = datastore.Entity(
+            ds_key("sync", budget, "chunk", str(entity["chunks"])),
+            exclude_from_indexes=["data"])
+        chunk["data"] = blob[i:i + CHECKPOINT_CHUNK]
+        entities.append(chunk)
+        entity["chunks"] += 1
+    return entities
+
+def checkpoint_keys(budget, checkpoint):
+    """ Returns the keys of a stored sync checkpoint """
+    return [ds_key("sync", budget)] + \
+           [ds_key("sync", budget, "chunk", str(i))
+            for i in range(checkpoint.get("chunks", 0))]
+
+def load_checkpoint(budget, checkpoint):
+    """ Returns the budget response of a checkpoint, None if incomplete """
+    keys = checkpoint_keys(budget, checkpoint)[1:]
+    found = ds_get_multi(keys)
+    if not keys or len(found) != len(keys):
+        return None
+    blob = b"".join(bytes(found[key]["data"]) for key in keys)
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def sync_budget(budget, entity, first, result, now, triggers, pageputs,
+                pagedeletes, done=None, deadline=None, states=None):
+    """ Processes a YNAB budget (delta) response into the budget entity
+
+    Collections in done were processed by an earlier, interrupted run and
+    are skipped, the others are added to it once processed. When deadline
+    passes, returns None before the next collection: the entity then keeps
+    its old server knowledge and the run must be resumed with done.
+    Otherwise returns the collections that changed; if none did, the entity
+    does not need to be stored.
+
+    Collections are parsed through the state cache. states receives the
+    (JSON, parsed data) of each, to be returned with checkin_states once
+    the entity is stored.
+    """
+    data = result["budget"]
+    knowledge = result['server_knowledge']
+    if done is None:
+        done = []
+    if "config" in entity:
+        config = json.loads(entity['config'])
+    else:
+        config = {'id': data['id'], 'name': data['name'], 'knowledge': None}
+    expires = config.setdefault('expires', {})
+    if states is None:
+        states = {}
+    parsed = {}
+    def current(typ):
+        if typ not in parsed:
+            parsed[typ] = checkout_state(budget, typ, entity[typ])
+            states[typ] = (entity[typ], parsed[typ])
+        return parsed[typ]
+
+    update_balances(budget, data["accounts"], knowledge)
+    processed = []
+    for typ in SYNC_COLLECTIONS:
+        if typ in done:
+            continue
+        if not first and typ in expires and \
+                not any(data[field] for field in SYNC_DELTAS[typ]) and \
+                (expires[typ] is None or expires[typ] > now.timestamp):
+            # nothing changed and no record expires yet
+            done.append(typ)
+            continue
+        # process at least one collection per run, so a sync converges
+        if processed and deadline is not None and time.time() > deadline:
+            log("cron").warning("%s deadline reached, done: %s",
+                                data["name"], done)
+            entity['config'] = json.dumps(config)
+            bound_entity(budget, entity, now, pageputs, pagedeletes)
+            return None
+        parsed[typ] = bound_feed(budget, typ, sync_collection(
+            typ, current, data, knowledge, first, triggers), now,
+            pageputs, pagedeletes)
+        entity[typ] = json.dumps(parsed[typ])
+        states[typ] = (entity[typ], parsed[typ])
+        expires[typ] = feed_expiry(parsed[typ])
+        done.append(typ)
+        processed.append(typ)
+
+    config['id'] = data['id']
+    config['name'] = data['name']
+    config['knowledge'] = knowledge
+    if not processed:
+        return processed
+    entity['config'] = json.dumps(config)
+
+    log("cron").info("%s size = %d", data["name"],
+                     len(entity["config"]) +
+                     len(entity["accounts"]) +
+                     len(entity["categories"]) +
+                     len(entity["months"]) +
+                     len(entity["month_categories"]) +
+                     len(entity["payees"]) +
+                     len(entity["transactions"]))
+    if "accounts" in processed or "categories" in processed or \
+            "payees" in processed:
+        store_options_snapshot(budget, build_options_snapshot(
+            current("accounts"), current("categories"), current("payees"),
+            knowledge), pageputs)
+    bound_entity(budget, entity, now, pageputs, pagedeletes)
+    return processed
+
+def feed_expiry(result):
+    """ Returns when cleanup_old will next drop a record, None if never """
+    stamps = [page["newest"] for page in result.get("pages", [])]
+    if len(result["changed"]) > 1 or stamps:
+        stamps.extend(change["meta"]["timestamp"]
+                      for change in result["changed"])
+    if not stamps:
+        return None
+    return min(stamps) + 86400
+
+def sync_collection(typ, current, data, knowledge, first, triggers):
+    """ Processes one collection of a budget response, returns its result """
+    if typ == "accounts":
+        return process_accounts(current("accounts"),
+                                data["accounts"],
+                                data["currency_format"],
+                                knowledge,
+                                first,
+                                triggers)
+    if typ == "categories":
+        return process_categories(current("categories"),
+                                  data["categories"],
+                                  data["category_groups"],
+                                  data["currency_format"],
+                                  knowledge,
+                                  first,
+                                  triggers)
+    if typ == "months":
+        return process_months(current("months"),
+                              data["months"],
+                              data["first_month"],
+                              data["currency_format"],
+                              knowledge,
+                              first,
+                              triggers)
+    if typ == "month_categories":
+        return process_month_categories(current("month_categories"),
+                                        current("categories"),
+                                        data["months"],
+                                        data["first_month"],
                                         data["currency_format"],
-                                        result['server_knowledge'],
+                                        knowledge,
                                         first,
                                         triggers)
-        entity["categories"] = json.dumps(categories)
-
-        months = json.loads(entity["months"])
-        months = process_months(months,
-                                data["months"],
-                                data["first_month"],
+    if typ == "payees":
+        return process_payees(current("payees"),
+                              data["payees"],
+                              knowledge,
+                              first,
+                              triggers)
+    return process_transactions(current("transactions"),
+                                current("accounts"),
+                                current("categories"),
+                                current("payees"),
+                                data["transactions"],
                                 data["currency_format"],
-                                result['server_knowledge'],
+                                knowledge,
                                 first,
                                 triggers)
-        entity["months"] = json.dumps(months)
-
-        month_categories = json.loads(entity["month_categories"])
-        month_categories = process_month_categories(month_categories,
-                                                    categories,
-                                                    data["months"],
-                                                    data["first_month"],
-                                                    data["currency_format"],
-                                                    result['server_knowledge'],
-                                                    first,
-                                                    triggers)
-        entity["month_categories"] = json.dumps(month_categories)
-
-        payees = json.loads(entity["payees"])
-        payees = process_payees(payees,
-                                data["payees"],
-                                result['server_knowledge'],
-                                first,
-                                triggers)
-        entity["payees"] = json.dumps(payees)
-
-        transactions = json.loads(entity["transactions"])
-        transactions = process_transactions(transactions,
-                                            accounts,
-                                            categories,
-                                            payees,
-                                            data["transactions"],
-                                            data["currency_format"],
-                                            result['server_knowledge'],
-                                            first,
-                                            triggers)
-        entity["transactions"] = json.dumps(transactions)
-
-        print(data["name"] + " size = " + str(len(entity["config"]) +
-                                              len(entity["accounts"]) +
-                                              len(entity["categories"]) +
-                                              len(entity["months"]) +
-                                              len(entity["month_categories"]) +
-                                              len(entity["payees"]) +
-                                              len(entity["transactions"])))
-        DSCLIENT.put(entity)
-
-    if to_process:
-        YNAB_BUDGETS = budgets
-        entity = datastore.Entity(DSCLIENT.key("budget", "budgets"),
-                                  exclude_from_indexes=["data"])
-        entity["data"] = json.dumps(YNAB_BUDGETS)
-        DSCLIENT.put(entity)
-
-    if triggers:
-        print("Updating triggers: " + json.dumps(triggers))
-        data = {"data": []}
-        for triggerid in triggers:
-            data["data"].append({"trigger_identity": triggerid})
-        headers = {
-            "IFTTT-Channel-Key": get_ifttt_key(),
-            "IFTTT-Service-Key": get_ifttt_key(),
-            "X-Request-ID": uuid.uuid4().hex,
-            "Content-Type": "application/json"
-        }
-        res = requests.post("https://realtime.ifttt.com/v1/notifications",
-                            headers=headers, data=json.dumps(data))
-        print(res.text)
-
-    return ""
 
 def process_accounts(old, data, curfmt, knowledge, first, triggers):
     if first:
@@ -1366,7 +2470,8 @@ def process_accounts(old, data, curfmt, knowledge, first, triggers):
                     change_type = None
             else:
                 change_type = "new"
-            result["data"][item["id"]] = [item["name"], fieldhash]
+            result["data"][item["id"]] = [item["name"], fieldhash,
+                                          item["on_budget"], item["closed"]]
 
         if not first and change_type is not None:
             change = {
@@ -1387,7 +2492,7 @@ def process_accounts(old, data, curfmt, knowledge, first, triggers):
                     "timestamp": now.timestamp
                 }
             }
-            result["changed"].insert(0, change)
+            add_change(result, change)
 
     if data and "triggers" in result:
         for trig in result["triggers"]:
@@ -1416,7 +2521,8 @@ def process_categories(old, data, groupdata, curfmt, knowledge, first,
         if item["category_group_id"] in result["groups"]:
             group = result["groups"][item["category_group_id"]]
         elif not item["deleted"]:
-            print("Error: group not found: "+item["category_group_id"])
+            log("cron").error("group not found: %s",
+                              item["category_group_id"])
 
         fieldhash = hashlib.md5("{}|{}|{}|{}|{}|{}|{}|{}|{}|{}|{}|{}".format(
             item["category_group_id"],
@@ -1474,7 +2580,7 @@ def process_categories(old, data, groupdata, curfmt, knowledge, first,
                     "timestamp": now.timestamp
                 }
             }
-            result["changed"].insert(0, change)
+            add_change(result, change)
 
     if data and "triggers" in result:
         for trig in result["triggers"]:
@@ -1511,7 +2617,7 @@ def process_months(old, data, first_month, curfmt, knowledge, first, triggers):
                 "timestamp": now.timestamp
             }
         }
-        result["changed"].insert(0, item)
+        add_change(result, item)
 
     if data and "triggers" in result:
         for trig in result["triggers"]:
@@ -1523,7 +2629,7 @@ def process_month_categories(old, categories, data, first_month, curfmt,
                              knowledge, first, triggers):
     if first:
         # for months we only keep changes, so no need to process further
-        return {"changed": []}
+        return {"changed": [], "lookup": category_lookup(categories)}
     result = old
 
     now = arrow.utcnow()
@@ -1541,7 +2647,8 @@ def process_month_categories(old, categories, data, first_month, curfmt,
             if item["category_group_id"] in categories["groups"]:
                 group = categories["groups"][item["category_group_id"]]
             elif not item["deleted"]:
-                print("Error: group not found: "+item["category_group_id"])
+                log("cron").error("group not found: %s",
+                                  item["category_group_id"])
 
             if item["goal_target"] is None:
                 goal_target = ""
@@ -1572,12 +2679,13 @@ def process_month_categories(old, categories, data, first_month, curfmt,
                         "timestamp": now.timestamp
                     }
                 }
-                result["changed"].insert(0, change)
+                add_change(result, change)
 
     if data and "triggers" in result:
         for trig in result["triggers"]:
             triggers.append(trig)
 
+    result["lookup"] = category_lookup(categories)
     return cleanup_old(result, now)
 
 def process_payees(old, data, knowledge, first, triggers):
@@ -1614,7 +2722,7 @@ def process_payees(old, data, knowledge, first, triggers):
                     "timestamp": now.timestamp
                 }
             }
-            result["changed"].insert(0, change)
+            add_change(result, change)
 
     if data and "triggers" in result:
         for trig in result["triggers"]:
@@ -1630,6 +2738,7 @@ def process_transactions(old, accounts, categories, payees, data, curfmt,
 
     result = old
     now = arrow.utcnow()
+    changes = []
 
     for item in data:
 
@@ -1670,8 +2779,11 @@ def process_transactions(old, accounts, categories, payees, data, curfmt,
                 "approved": item["approved"],
                 "flag_color": item["flag_color"],
                 "account": account,
+                "account_id": item["account_id"],
                 "payee": payee,
+                "payee_id": item["payee_id"],
                 "category": category,
+                "category_id": item["category_id"],
                 "category_group": category_group,
                 "transfer_account": transfer_account,
                 "meta": {
@@ -1679,14 +2791,36 @@ def process_transactions(old, accounts, categories, payees, data, curfmt,
                     "timestamp": now.timestamp
                 }
             }
-            result["changed"].insert(0, change)
+            add_change(result, change)
+            changes.append(change)
 
     if data and "triggers" in result:
+        filters = result.get("filters", {})
         for trig in result["triggers"]:
-            triggers.append(trig)
+            if trig not in filters:
+                triggers.append(trig)
+            else:
+                predicate = transaction_predicate(trig, filters[trig])
+                for change in changes:
+                    if predicate(change):
+                        triggers.append(trig)
+                        break
 
     return cleanup_old(result, now)
 
+def category_lookup(categories):
+    """ Maps category ids, names and aliases to the category id """
+    lookup = {}
+    for cat in categories["data"]:
+        lookup[categories["data"][cat][0]] = cat
+    for cat in categories["data"]:
+        catdata = categories["data"][cat]
+        lookup[catdata[1] + "|" + catdata[0]] = cat
+        lookup[catdata[1] + " - " + catdata[0]] = cat
+    for cat in categories["data"]:
+        lookup[cat] = cat
+    return lookup
+
 def convert_amount(amount, curfmt):
     digits = curfmt["decimal_digits"]
     if digits == 0:
@@ -1697,32 +2831,47 @@ def convert_amount(amount, curfmt):
         return "{:.2f}".format((amount // 10) / 100)
     return "{:.3f}".format(amount / 1000)
 
+def add_change(result, change):
+    """ Adds a change record to the front of a feed
+
+    Each feed numbers its records, so the records are ordered newest first by
+    their seq as well and trigger polls can continue after a cursor.
+    """
+    result["seq"] = result.get("seq", 0) + 1
+    change["seq"] = result["seq"]
+    result["changed"].insert(0, change)
+
 def cleanup_old(result, now):
     result2 = {"changed": [], "triggers": []}
-    if "triggers" in result:
-        result2["triggers"] = result["triggers"]
-    if "data" in result:
-        result2["data"] = result["data"]
-    if "groups" in result:
-        result2["groups"] = result["groups"]
-    # only keep records younger than 1 day
+    for key in result:
+        if key != "changed":
+            result2[key] = result[key]
+    # only keep records younger than 1 day, bound_feed archives the others
+    aged = []
     for change in result["changed"]:
         if change["meta"]["timestamp"] > now.timestamp - 86400:
             result2["changed"].append(change)
+        else:
+            aged.append(change)
     # but always keep the last record
     if not result2["changed"] and result["changed"]:
-        result2["changed"].append(result["changed"][0])
+        result2["changed"].append(aged.pop(0))
+    if aged:
+        result2["aged"] = aged
 
     return result2
 
 def get_ynab_budgets_raw():
     budgets = []
     if get_ynab_key() is not None:
-        r = requests.get(YNAB_BASE + "/budgets", \
-            headers={"Authorization": "Bearer {}".format(get_ynab_key())})
+        try:
+            r = ynab_get("/budgets")
+        except YnabUnavailable:
+            return last_good("budgets")
         budgets = r.json()["data"]["budgets"]
         budgets = sorted(budgets, key=lambda x: x["last_modified_on"],
                          reverse=True)
+        YNAB_LAST_GOOD["budgets"] = budgets
     return budgets
 
 def get_ynab_budgets():
@@ -1732,12 +2881,71 @@ def get_ynab_budgets():
         data.append({"label": b["name"], "value": b["id"]})
     return data
 
+def get_ynab_accounts_raw(budget):
+    try:
+        r = ynab_get("/budgets/{}/accounts".format(budget))
+    except YnabUnavailable:
+        return last_good("accounts/" + budget)
+    data = r.json()["data"]
+    update_balances(budget, data["accounts"], data["server_knowledge"])
+    YNAB_LAST_GOOD["accounts/" + budget] = data["accounts"]
+    return data["accounts"]
+
+def get_ynab_categories_raw(budget):
+    try:
+        r = ynab_get("/budgets/{}/categories".format(budget))
+    except YnabUnavailable:
+        return last_good("categories/" + budget)
+    groups = r.json()["data"]["category_groups"]
+    YNAB_LAST_GOOD["categories/" + budget] = groups
+    return groups
+
+def find_ynab_account(accounts, account):
+    """ Returns the account matching the given id or name, or None """
+    found = None
+    for a in accounts:
+        if a["id"] == account or a["name"] == account:
+            found = a
+    return found
+
+def find_ynab_category(groups, category):
+    """ Returns the id of the category matching the given id or name """
+    category_id = None
+    for g in groups:
+        for c in g["categories"]:
+            if c["id"] == category or c["name"] == category:
+                category_id = c["id"]
+    return category_id
+
+def find_category_id(budget, category):
+    """ Returns the id of the category matching the given id or name
+
+    Looks the category up in the synced categories first, so only unknown
+    categories and budgets that are not synced (yet) need a YNAB request.
+    Raises YnabUnavailable if YNAB cannot be reached for those.
+    """
+    lookup = None
+    options = get_options_snapshot(budget)
+    if options is not None:
+        lookup = options.get("lookup")
+    if lookup is not None and category in lookup:
+        return lookup[category]
+    try:
+        return find_ynab_category(get_ynab_categories_raw(budget), category)
+    except YnabUnavailable:
+        if lookup is None:
+            raise
+        # only a category added since the last sync is not found then
+        return None
+
 def get_ynab_accounts(budget=None):
     if budget is None:
         budget = get_default_budget()
-    r = requests.get(YNAB_BASE + "/budgets/{}/accounts".format(budget), \
-        headers={"Authorization": "Bearer {}".format(get_ynab_key())})
-    results = r.json()["data"]["accounts"]
+    results = get_ynab_accounts_raw(budget)
+    return account_options(results)
+
+def account_options(results):
+    """ Groups the account options in budget, tracking and closed """
     data1 = []
     data2 = []
     data3 = []
@@ -1763,13 +2971,8 @@ def get_ynab_accounts(budget=None):
 def get_ynab_categories(budget=None, trigger=False):
     if budget is None:
         budget = get_default_budget()
-    r = requests.get(YNAB_BASE + "/budgets/{}/categories".format(budget), \
-        headers={"Authorization": "Bearer {}".format(get_ynab_key())})
-    results = r.json()["data"]["category_groups"]
-    if trigger:
-        data = [{"label": "(all categories)", "value": ""}]
-    else:
-        data = [{"label": "(automatic)", "value": ""}]
+    results = get_ynab_categories_raw(budget)
+    data = []
     for g in results:
         groupvalues = []
         for c in g["categories"]:
@@ -1777,64 +2980,1630 @@ def get_ynab_categories(budget=None, trigger=False):
                                 "alias1": g["name"] + "|" + c["name"],
                                 "alias2": c["name"]})
         if g["name"] == "Internal Master Category":
-            data.insert(1, {"label": g["name"], "values": groupvalues})
+            data.insert(0, {"label": g["name"], "values": groupvalues})
         else:
             data.append({"label": g["name"], "values": groupvalues})
-    return data
+    return category_options(data, trigger)
+
+def category_options(groups, trigger):
+    """ Prepends the empty choice to the grouped category options """
+    if trigger:
+        return [{"label": "(all categories)", "value": ""}] + groups
+    return [{"label": "(automatic)", "value": ""}] + groups
+
+
+###############################################################################
+# YNAB request handling                                                       #
+###############################################################################
+
+# (connect, read) timeouts in seconds; the budget sync gets a longer read
+# timeout as a first sync returns the complete budget
+YNAB_TIMEOUT = (3.05, 15)
+YNAB_SYNC_TIMEOUT = (3.05, 60)
+
+# After BREAKER_THRESHOLD consecutive failures, no YNAB requests are made for
+# BREAKER_RESET seconds. Lookups are then served from the last good data.
+BREAKER_THRESHOLD = 3
+BREAKER_RESET = 60
+YNAB_BREAKER = TenantDict("breaker", lambda: {"failures": 0, "opened": 0})
+
+# Last successful response per lookup, served while YNAB is unavailable
+YNAB_LAST_GOOD = TenantDict("last_good")
+
+class YnabUnavailable(Exception):
+    """ YNAB did not respond (in time) or the circuit breaker is open """
+
+class YnabUncertain(YnabUnavailable):
+    """ A YNAB write failed after it was sent, so it may have been applied """
+
+def ynab_available():
+    """ Returns False while the circuit breaker is open """
+    return YNAB_BREAKER["failures"] < BREAKER_THRESHOLD or \
+           YNAB_BREAKER["opened"] < time.time() - BREAKER_RESET
+
+def ynab_request(method, path, timeout=YNAB_TIMEOUT, **kwargs):
+    """ Executes a YNAB API request, guarded by the circuit breaker
+
+    Raises YnabUnavailable on timeouts, connection errors, rate limiting and
+    server errors, and without a request while the breaker is open. For a
+    write that YNAB may have received, it raises YnabUncertain instead, as
+    retrying that could apply the write twice.
+    """
+    if not ynab_available():
+        raise YnabUnavailable("circuit breaker open")
+    try:
+        r = requests.request(method, YNAB_BASE + path, headers={
+            "Authorization": "Bearer {}".format(get_ynab_key())
+        }, timeout=timeout, **kwargs)
+    except requests.RequestException as e:
+        ynab_failure()
+        if method != "GET" and request_sent(e):
+            raise YnabUncertain(str(e))
+        raise YnabUnavailable(str(e))
+    if r.status_code == 429 or r.status_code >= 500:
+        ynab_failure()
+        # a rate limited request is refused before it is processed
+        if method != "GET" and r.status_code != 429:
+            raise YnabUncertain("{} {}".format(r.status_code, r.text[:200]))
+        raise YnabUnavailable("{} {}".format(r.status_code, r.text[:200]))
+    YNAB_BREAKER["failures"] = 0
+    return r
+
+def ynab_get(path, timeout=YNAB_TIMEOUT):
+    return ynab_request("GET", path, timeout)
+
+def ynab_post(path, body, timeout=YNAB_TIMEOUT):
+    return ynab_request("POST", path, timeout, json=body)
+
+def request_sent(e):
+    """ Returns False if a request failed before it was sent to YNAB """
+    # imported here to keep it out of the cold start, requests has loaded
+    # it by now
+    import urllib3
+    if isinstance(e, requests.ConnectTimeout):
+        return False
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return not isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def ynab_failure():
+    YNAB_BREAKER["failures"] += 1
+    if YNAB_BREAKER["failures"] >= BREAKER_THRESHOLD:
+        log("ynab").warning("YNAB circuit breaker open after %d failures",
+                            YNAB_BREAKER["failures"])
+        YNAB_BREAKER["opened"] = time.time()
+
+def last_good(name):
+    """ Returns the last good data of a lookup, or re-raises if none """
+    if name not in YNAB_LAST_GOOD:
+        raise YnabUnavailable("no cached data for " + name)
+    log("ynab").warning("Serving stale %s as YNAB is unavailable", name)
+    return YNAB_LAST_GOOD[name]
+
+
+###############################################################################
+# YNAB response recording                                                     #
+###############################################################################
+
+# When YNAB_RECORD_DIR is set, every budget (delta) response of the cron job
+# is written to <dir>/<budget>/<time>.json.gz, for tools/replay.py to feed
+# through the sync offline. Only the response data is kept: no headers, and
+# the configured keys are redacted should they appear anywhere.
+YNAB_RECORD_DIR = os.environ.get("YNAB_RECORD_DIR")
+
+def record_response(budget, path, r):
+    """ Writes a budget response to the record directory """
+    try:
+        record = json.dumps({
+            "path": path,
+            "recorded": time.time(),
+            "data": r.json()["data"],
+        }, separators=(",", ":"))
+        for secret in [get_ynab_key(), get_ifttt_key()]:
+            if secret:
+                record = record.replace(secret, "REDACTED")
+        directory = os.path.join(YNAB_RECORD_DIR, budget)
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory,
+                                "{:.6f}.json.gz".format(time.time()))
+        with gzip.open(filename, "wt", encoding="utf-8") as f:
+            f.write(record)
+    except:
+        traceback.print_exc()
+
+
+###############################################################################
+# Response compression and conditional requests                               #
+###############################################################################
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+def json_response(payload, etag=None):
+    """ Returns payload as JSON response, compressed if the client accepts it
+
+    If the etag matches the If-None-Match header of the request, an empty
+    304 response is returned instead (payload may then be None).
+    """
+    if etag_matches(etag):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(json.dumps(payload))
+        resp.headers["Content-Type"] = "application/json; charset=utf-8"
+        resp.headers["Vary"] = "Accept-Encoding"
+        encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+        if encoding is not None and len(resp.data) >= COMPRESS_MIN_BYTES:
+            if encoding == "gzip":
+                resp.data = gzip.compress(resp.data)
+            else:
+                resp.data = zlib.compress(resp.data)
+            resp.headers["Content-Encoding"] = encoding
+    if etag is not None:
+        resp.set_etag(etag)
+    return resp
+
+def etag_matches(etag):
+    """ Returns whether the request already has the response with etag """
+    return etag is not None and request.if_none_match.contains(etag)
+
+def poll_etag(entity, feed):
+    """ Returns the ETag of a trigger poll on the given feed
+
+    The ETag depends on the server knowledge of the budget, the newest record
+    and size of the feed (records also expire without a knowledge change) and
+    on the request fields that influence the response.
+    """
+    data = request.get_json()
+    newest = ""
+    if feed["changed"]:
+        newest = feed["changed"][0]["meta"]["id"]
+    return hashlib.md5("{}|{}|{}|{}|{}|{}|{}|{}|{}".format(
+        request.path,
+        json.loads(entity["config"])["knowledge"],
+        newest,
+        len(feed["changed"]),
+        len(feed.get("pages", [])),
+        json.dumps(data.get("triggerFields"), sort_keys=True),
+        data.get("limit", 50),
+        data.get("cursor"),
+        data.get("user", {}).get("timezone", "UTC"),
+    ).encode("utf-8")).hexdigest()
+
+def options_etag(options):
+    """ Returns the ETag of an options response from a snapshot """
+    return hashlib.md5("{}|{}|{}".format(
+        request.path,
+        get_default_budget(),
+        options["version"],
+    ).encode("utf-8")).hexdigest()
+
+
+###############################################################################
+# IFTTT field option snapshots                                                #
+###############################################################################
+
+# Dropdown options per budget, prebuilt by the cron job from the synced
+# accounts and categories, so the options endpoints need no YNAB request.
+YNAB_OPTIONS = TenantDict("options")
+
+def build_options_snapshot(accounts, categories, payees, knowledge):
+    """ Builds the dropdown options from the synced data """
+    results = []
+    for account_id in accounts["data"]:
+        account = accounts["data"][account_id]
+        # entries stored before the flags were added count as open budget
+        # accounts until the account changes
+        on_budget = account[2] if len(account) > 2 else True
+        closed = account[3] if len(account) > 3 else False
+        results.append({"id": account_id, "name": account[0],
+                        "on_budget": on_budget, "closed": closed})
+
+    values = {}
+    for cat in categories["data"]:
+        catdata = categories["data"][cat]
+        values.setdefault(catdata[1], []).append({
+            "label": "- " + catdata[0],
+            "value": cat,
+            "alias1": catdata[1] + "|" + catdata[0],
+            "alias2": catdata[0]})
+
+    groups = []
+    for group in categories["groups"].values():
+        groupvalues = values.get(group, [])
+        if group == "Internal Master Category":
+            groups.insert(0, {"label": group, "values": groupvalues})
+        else:
+            groups.append({"label": group, "values": groupvalues})
+
+    payeevalues = [{"label": "- " + payees["data"][payee], "value": payee}
+                   for payee in payees["data"]]
+    payeevalues = sorted(payeevalues, key=lambda x: x["label"])
+
+    return {
+        "version": knowledge,
+        "accounts": account_options(results),
+        "categories": groups,
+        "payees": payeevalues,
+        "lookup": category_lookup(categories),
+    }
+
+def store_options_snapshot(budget, options, puts):
+    """ Caches the snapshot and adds it to puts if the options changed """
+    old = YNAB_OPTIONS.get(budget)
+    YNAB_OPTIONS[budget] = options
+    if old is not None and old["accounts"] == options["accounts"] and \
+            old["categories"] == options["categories"] and \
+            old.get("payees") == options["payees"]:
+        return
+    entity = datastore.Entity(ds_key("options", budget),
+                              exclude_from_indexes=["data"])
+    entity["data"] = json.dumps(options)
+    puts.append(entity)
+
+def get_options_snapshot(budget):
+    """ Returns the options snapshot of a budget, or None if not synced """
+    if budget not in YNAB_OPTIONS:
+        entity = ds_get(ds_key("options", budget))
+        if entity is None:
+            return None
+        YNAB_OPTIONS[budget] = json.loads(entity["data"])
+    return YNAB_OPTIONS[budget]
+
+def get_budget_options():
+    """ Returns the budget options from the budget list of the cron job """
+    if not TENANT_CACHE.get("budgets"):
+        entity = ds_get(ds_key("budget", "budgets"))
+        if entity is None:
+            return get_ynab_budgets()
+        TENANT_CACHE["budgets"] = json.loads(entity["data"])
+    return [{"label": b["name"], "value": b["id"]}
+            for b in TENANT_CACHE["budgets"]]
+
+
+###############################################################################
+# Account balance cache                                                       #
+###############################################################################
+
+# Account names and balances (in milliunits) per budget, kept current from
+# the account deltas of the cron job, full account retrievals and the
+# transactions we create ourselves. Each account remembers the server
+# knowledge of its balance, so an older delta never overwrites a newer one.
+# Transactions on an account are serialized by a lock within the instance and
+# by an "account/<budget>/<id>" lease across instances. The lease records the
+# instance that wrote to the account last; when that was another one, the
+# cached balance is read from YNAB again before it is adjusted.
+YNAB_BALANCES = TenantDict("balances")
+BALANCE_MAX_AGE = 900
+BALANCES_LOCK = threading.Lock()
+ACCOUNT_LOCKS = TenantDict("account_locks")
+ACCOUNT_LEASE_WAIT = 10
+
+def update_balances(budget, accounts, knowledge):
+    """ Stores the balances of a (full or delta) YNAB accounts list """
+    with BALANCES_LOCK:
+        cache = YNAB_BALANCES.setdefault(budget, {"accounts": {}})
+        for a in accounts:
+            cached = cache["accounts"].get(a["id"])
+            if cached is not None and cached["balance"] is not None and \
+                    cached["knowledge"] > knowledge:
+                continue
+            if a["deleted"]:
+                cache["accounts"].pop(a["id"], None)
+            else:
+                cache["accounts"][a["id"]] = {
+                    "name": a["name"],
+                    "balance": a["balance"],
+                    "knowledge": knowledge,
+                }
+        cache["knowledge"] = max(cache.get("knowledge", 0), knowledge)
+        cache["updated"] = time.time()
+
+def find_cached_account(budget, account):
+    """ Returns the id of the account matching the given id or name
+
+    Returns None if the account is unknown or the cache is too old.
+    """
+    with BALANCES_LOCK:
+        cache = YNAB_BALANCES.get(budget)
+        if cache is None or cache["updated"] < time.time() - BALANCE_MAX_AGE:
+            return None
+        account_id = None
+        for a in cache["accounts"]:
+            if a == account or cache["accounts"][a]["name"] == account:
+                account_id = a
+        return account_id
+
+def get_cached_balance(budget, account_id):
+    """ Returns the cached balance of an account, or None """
+    with BALANCES_LOCK:
+        cache = YNAB_BALANCES.get(budget)
+        if cache is None or cache["updated"] < time.time() - BALANCE_MAX_AGE \
+                or account_id not in cache["accounts"]:
+            return None
+        # None if invalidated
+        return cache["accounts"][account_id]["balance"]
+
+def apply_balance_change(budget, account_id, amount, knowledge):
+    """ Adds the amount of a transaction we created to the cached balance """
+    with BALANCES_LOCK:
+        cache = YNAB_BALANCES.get(budget)
+        if cache is not None and account_id in cache["accounts"] and \
+                cache["accounts"][account_id]["balance"] is not None:
+            cached = cache["accounts"][account_id]
+            cached["balance"] += amount
+            cached["knowledge"] = max(cached["knowledge"], knowledge)
+            cache["knowledge"] = max(cache.get("knowledge", 0), knowledge)
+
+def account_lock(budget, account_id):
+    """ Returns the lock serializing the transactions on an account """
+    with BALANCES_LOCK:
+        return ACCOUNT_LOCKS.setdefault((budget, account_id),
+                                        threading.Lock())
+
+def invalidate_balance(budget, account_id):
+    """ Makes the next adjustment read the balance of an account from YNAB """
+    with BALANCES_LOCK:
+        cache = YNAB_BALANCES.get(budget)
+        if cache is not None and account_id in cache["accounts"]:
+            cache["accounts"][account_id]["balance"] = None
+
+@contextlib.contextmanager
+def account_lease(budget, account_id):
+    """ Serializes the transactions on an account across instances
+
+    Yields whether the account is held; False if another instance did not
+    release it within ACCOUNT_LEASE_WAIT seconds. If another instance wrote
+    to the account last, the cached balance may miss its transactions and
+    is invalidated.
+    """
+    with account_lock(budget, account_id):
+        name = "account/{}/{}".format(budget, account_id)
+        owner = uuid.uuid4().hex
+        waited = time.time() + ACCOUNT_LEASE_WAIT
+        previous = acquire_lease(name, owner)
+        while previous is False and time.time() < waited:
+            time.sleep(random.uniform(0.05, 0.25))
+            previous = acquire_lease(name, owner)
+        if previous is False:
+            log("lease").error("Account %s is busy", name)
+            yield False
+            return
+        try:
+            if previous.get("instance") != INSTANCE_ID:
+                invalidate_balance(budget, account_id)
+            yield True
+        finally:
+            release_lease(name, owner)
+
+def response_knowledge(r):
+    """ Returns the server knowledge of a YNAB write response, or 0 """
+    try:
+        return r.json()["data"]["server_knowledge"]
+    except:
+        return 0
+
+def created_transactions(r):
+    """ Returns the transactions a YNAB bulk create response created
+
+    Returns None if the response does not list them.
+    """
+    try:
+        return r.json()["data"]["transactions"]
+    except:
+        return None
+
+
+###############################################################################
+# Change feed storage                                                         #
+###############################################################################
+
+# Datastore rejects entities larger than 1 MiB. Each change feed keeps at most
+# inline_bytes of records in the budget entity itself; older records spill
+# into "feed_page" entities of up to page_bytes each, and at most max_pages
+# pages are retained per feed. Indexed feeds also store the positions of the
+# records per key (the category id for month_categories, the trigger identity
+# of filtered triggers for transactions), so filtered polls can seek directly
+# to the matching records.
+ENTITY_MAX_BYTES = 1000000
+
+FEED_POLICIES = {
+    "accounts": {"inline_bytes": 50000, "page_bytes": 500000,
+                 "max_pages": 2},
+    "categories": {"inline_bytes": 100000, "page_bytes": 500000,
+                   "max_pages": 4},
+    "months": {"inline_bytes": 50000, "page_bytes": 500000,
+               "max_pages": 2},
+    "month_categories": {"inline_bytes": 200000, "page_bytes": 500000,
+                         "max_pages": 8, "index": "category_id"},
+    "payees": {"inline_bytes": 50000, "page_bytes": 500000,
+               "max_pages": 2},
+    "transactions": {"inline_bytes": 200000, "page_bytes": 500000,
+                     "max_pages": 8, "index": "filters"},
+}
+
+def feed_page_key(budget, typ, page):
+    return ds_key("feed_page", "{}/{}/{}".format(budget, typ, page))
+
+def bound_feed(budget, typ, result, now, pageputs, pagedeletes,
+               inline_bytes=None):
+    """ Spill the oldest records of a change feed into overflow pages
+
+    The new page entities are appended to pageputs and the keys of expired
+    pages to pagedeletes, so the caller can write them together with the
+    budget entity. Records that age out of the feed or its pages are moved
+    to the history archive. Returns the (modified) feed.
+    """
+    policy = FEED_POLICIES[typ]
+    if inline_bytes is None:
+        inline_bytes = policy["inline_bytes"]
+    pages = result.get("pages", [])
+
+    sizes = [len(json.dumps(change)) for change in result["changed"]]
+    size = sum(sizes)
+    if size > inline_bytes and len(result["changed"]) > 1:
+        # spill down to half the budget, so we do not spill on every run
+        spilled = []
+        while len(result["changed"]) > 1 and size > inline_bytes // 2:
+            spilled.insert(0, result["changed"].pop())
+            size -= sizes.pop()
+
+        newpages = []
+        records = []
+        recordsize = 0
+        for change in reversed(spilled):
+            changesize = len(json.dumps(change))
+            if records and recordsize + changesize > policy["page_bytes"]:
+                newpages.insert(0, records)
+                records = []
+                recordsize = 0
+            records.insert(0, change)
+            recordsize += changesize
+        if records:
+            newpages.insert(0, records)
+
+        nextpage = result.get("next_page", 0)
+        for records in reversed(newpages):
+            entity = datastore.Entity(feed_page_key(budget, typ, nextpage),
+                                      exclude_from_indexes=["records",
+                                                            "index"])
+            entity["records"] = json.dumps(records)
+            if "index" in policy:
+                entity["index"] = json.dumps(feed_index(typ, result, records))
+            pageputs.append(entity)
+            pages.insert(0, {
+                "id": nextpage,
+                "count": len(records),
+                "bytes": len(entity["records"]),
+                "newest": records[0]["meta"]["timestamp"],
+                "oldest": records[-1]["meta"]["timestamp"],
+                "newest_seq": records[0].get("seq", 0),
+                "oldest_seq": records[-1].get("seq", 0),
+            })
+            nextpage += 1
+        result["next_page"] = nextpage
+        log("cron").info("Spilled %d %s records of %s into overflow pages",
+                         len(spilled), typ, budget)
+
+    # pages follow the same one day retention as the inline records
+    keep = []
+    aged = result.pop("aged", [])
+    expired = []
+    for page in pages:
+        if len(keep) < policy["max_pages"] and \
+                page["newest"] > now.timestamp - 86400:
+            keep.append(page)
+        else:
+            key = feed_page_key(budget, typ, page["id"])
+            spilled = [e for e in pageputs if e.key == key]
+            if spilled:
+                aged += json.loads(spilled[0]["records"])
+            else:
+                expired.append(key)
+            pageputs[:] = [e for e in pageputs if e.key != key]
+            pagedeletes.append(key)
+    result["pages"] = keep
+    if expired:
+        for entity in ds_get_multi(expired).values():
+            aged += json.loads(entity["records"])
+    archive_changes(budget, typ, aged, now, pageputs, pagedeletes)
+    result["bytes"] = size
+    if "index" in policy:
+        result["index"] = feed_index(typ, result, result["changed"])
+
+    return result
+
+def feed_match(typ, result, key):
+    """ Returns the predicate selecting the records of an index key """
+    if FEED_POLICIES[typ]["index"] == "filters":
+        return transaction_predicate(key, result["filters"][key])
+    field = FEED_POLICIES[typ]["index"]
+    return lambda change: change[field] == key
+
+def feed_index(typ, result, records):
+    """ Maps each index key of a feed to the positions of its records """
+    index = {}
+    if FEED_POLICIES[typ]["index"] == "filters":
+        for key in result.get("filters", {}):
+            match = feed_match(typ, result, key)
+            index[key] = [i for i, change in enumerate(records)
+                          if match(change)]
+    else:
+        field = FEED_POLICIES[typ]["index"]
+        for position, change in enumerate(records):
+            index.setdefault(change[field], []).append(position)
+    return index
+
+def bound_entity(budget, entity, now, pageputs, pagedeletes):
+    """ Spill whole feeds if the budget entity still exceeds the limit """
+    def entity_size():
+        return sum([len(entity[typ]) for typ in entity])
+
+    typs = sorted(FEED_POLICIES, key=lambda typ: len(entity[typ]),
+                  reverse=True)
+    for typ in typs:
+        if entity_size() <= ENTITY_MAX_BYTES:
+            break
+        log("cron").warning("%s entity too large, spilling %s", budget, typ)
+        result = json.loads(entity[typ])
+        if "changed" in result:
+            result = bound_feed(budget, typ, result, now, pageputs,
+                                pagedeletes, 0)
+            entity[typ] = json.dumps(result)
+
+def feed_changes(budget, typ, result, limit, key=None, cursor=None):
+    """ Returns up to limit records of a change feed, newest first
+
+    If key is given, only the records of that index key (see FEED_POLICIES)
+    are returned. If cursor is given, only records older than the record
+    with that seq are. Overflow pages are only read when the inline records
+    do not fill the requested limit, and pages holding only records newer
+    than the cursor are skipped.
+    """
+    def select(records, index):
+        count = limit - len(changes)
+        if key is None:
+            start = seek_feed(records, cursor, feed_seq)
+            return records[start:start + count]
+        if index is not None and key in index:
+            positions = index[key]
+            start = seek_feed(positions, cursor,
+                              lambda i: feed_seq(records[i]))
+            return [records[i] for i in positions[start:start + count]]
+        if index is not None and FEED_POLICIES[typ]["index"] != "filters":
+            return []
+        # not indexed yet, e.g. a page written before the filter was set
+        match = feed_match(typ, result, key)
+        records = records[seek_feed(records, cursor, feed_seq):]
+        return [c for c in records if match(c)][:count]
+
+    changes = []
+    changes += select(result["changed"], result.get("index"))
+
+    pages = result.get("pages", [])
+    start = seek_feed(pages, cursor, lambda page: page.get("oldest_seq", 0))
+    for page in pages[start:]:
+        if len(changes) >= limit:
+            break
+        entity = ds_get(feed_page_key(budget, typ, page["id"]))
+        if entity is not None:
+            index = None
+            if "index" in entity:
+                index = json.loads(entity["index"])
+            changes += select(json.loads(entity["records"]), index)
+
+    return changes
+
+def feed_seq(change):
+    """ Returns the seq of a change record, 0 for records without one """
+    return change.get("seq", 0)
+
+def seek_feed(items, cursor, seq):
+    """ Returns the position of the first item older than the cursor
+
+    items are ordered newest first, so a binary search on seq finds it.
+    """
+    if cursor is None:
+        return 0
+    low, high = 0, len(items)
+    while low < high:
+        middle = (low + high) // 2
+        if seq(items[middle]) >= cursor:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def feed_cursor(data):
+    """ Returns the seq of the cursor of a trigger poll, None if there is none
+
+    Raises ValueError if the cursor was not issued by feed_response.
+    """
+    cursor = data.get("cursor")
+    if cursor is None or cursor == "":
+        return None
+    if not isinstance(cursor, str) or not cursor.isdigit():
+        raise ValueError("invalid cursor")
+    return int(cursor)
+
+def feed_response(results, limit, timezone):
+    """ Returns the response payload of a trigger poll
+
+    Only the records of the requested page are converted. A full page gets
+    the cursor of its last record, from where the next poll continues.
+    """
+    results = results[:limit]
+    payload = {"data": results}
+    if results and len(results) == limit and "seq" in results[-1]:
+        payload["cursor"] = str(results[-1]["seq"])
+    for result in results:
+        result.pop("seq", None)
+        result["created_at"] = arrow.get(result["created_at"])\
+                               .to(timezone).isoformat()
+    return payload
+
+
+###############################################################################
+# Change history archive                                                      #
+###############################################################################
+
+# Records that age out of a change feed are appended to a history archive,
+# partitioned by budget and (UTC) day. Records are stored in
+# "history_segment" entities of at most HISTORY_SEGMENT_RECORDS records of
+# one feed and day, as compressed columns: small integer columns as deltas,
+# repetitive columns as a dictionary and codes. created_at is not stored, it
+# is rebuilt from the timestamp. Each sync appends to the last segment of its
+# feed and day until that is full, so a day has few segments however often
+# the cron job runs. A "history" entity per budget and day indexes the
+# segments of the day with their time range, so a query only reads the
+# segments overlapping the requested range; the "history" entity of the
+# budget only lists the days. Days older than HISTORY_DAYS are dropped, which
+# keeps all index entities small.
+HISTORY_DAYS = int(os.environ.get("HISTORY_DAYS", "30"))
+HISTORY_SEGMENT_RECORDS = 1000
+HISTORY_MAX_LIMIT = 1000
+
+def history_key(budget, day=None):
+    if day is None:
+        return ds_key("history", budget)
+    return ds_key("history", "{}/{}".format(budget, day))
+
+def history_segment_key(budget, segment):
+    return ds_key("history_segment", "{}/{}".format(budget, segment))
+
+def queued_entity(key, pageputs):
+    """ Returns the entity of key as queued in pageputs, else as stored """
+    for entity in pageputs:
+        if entity.key == key:
+            return entity
+    return ds_get(key)
+
+def queue_entity(entity, pageputs):
+    """ Queues entity in pageputs, replacing an earlier one of its key """
+    pageputs[:] = [e for e in pageputs if e.key != entity.key] + [entity]
+
+def history_index(key, pageputs, initial):
+    """ Returns the history index entity of key, queued for an update """
+    entity = queued_entity(key, pageputs)
+    if entity is None:
+        entity = datastore.Entity(key, exclude_from_indexes=["index"])
+        entity["index"] = json.dumps(initial)
+    queue_entity(entity, pageputs)
+    return entity
+
+def archive_changes(budget, typ, records, now, pageputs, pagedeletes):
+    """ Appends records that aged out of a feed to the history archive
+
+    Like bound_feed, the new entities are appended to pageputs and the keys
+    of expired entities to pagedeletes.
+    """
+    if not records:
+        return
+    root = history_index(history_key(budget), pageputs,
+                         {"next": 0, "days": []})
+    index = json.loads(root["index"])
+
+    records = sorted(records, key=lambda change: (
+        change["meta"]["timestamp"], feed_seq(change)))
+    days = collections.OrderedDict()
+    for change in records:
+        day = arrow.get(change["meta"]["timestamp"]).format("YYYY-MM-DD")
+        days.setdefault(day, []).append(change)
+    for day, changes in days.items():
+        if day not in index["days"]:
+            index["days"] = sorted(index["days"] + [day])
+        day_entity = history_index(history_key(budget, day), pageputs,
+                                   {"segments": []})
+        segments = json.loads(day_entity["index"])["segments"]
+        segmentid = None
+        ours = [segment for segment in segments if segment[1] == typ]
+        if ours and ours[-1][2] < HISTORY_SEGMENT_RECORDS:
+            # continue the last segment of the feed instead of adding one
+            segments.remove(ours[-1])
+            segmentid = ours[-1][0]
+            segment = queued_entity(history_segment_key(budget, segmentid),
+                                    pageputs)
+            if segment is not None:
+                count, columns = decode_columns(segment["columns"])
+                changes = column_records(columns, 0, count, "UTC") + changes
+        for i in range(0, len(changes), HISTORY_SEGMENT_RECORDS):
+            chunk = changes[i:i + HISTORY_SEGMENT_RECORDS]
+            if segmentid is None:
+                segmentid = index["next"]
+                index["next"] += 1
+            segment = datastore.Entity(history_segment_key(budget, segmentid),
+                                       exclude_from_indexes=["columns"])
+            segment["columns"] = encode_columns(chunk)
+            queue_entity(segment, pageputs)
+            segments.append([segmentid, typ, len(chunk),
+                             chunk[0]["meta"]["timestamp"],
+                             chunk[-1]["meta"]["timestamp"]])
+            segmentid = None
+        day_entity["index"] = json.dumps({"segments": segments})
+
+    cutoff = now.to("UTC").shift(days=-HISTORY_DAYS).format("YYYY-MM-DD")
+    expired = [history_key(budget, day) for day in index["days"]
+               if day < cutoff]
+    if expired:
+        found = ds_get_multi(expired)
+        for key in expired:
+            pageputs[:] = [e for e in pageputs if e.key != key]
+            pagedeletes.append(key)
+            if key in found:
+                pagedeletes.extend(
+                    history_segment_key(budget, segment[0]) for segment in
+                    json.loads(found[key]["index"])["segments"])
+        index["days"] = [day for day in index["days"] if day >= cutoff]
+    root["index"] = json.dumps(index)
+    log("cron").info("Archived %d %s records of %s", len(records), typ,
+                     budget)
+
+def encode_columns(records):
+    """ Returns records as compressed columns, see decode_columns """
+    columns = {}
+    for position, change in enumerate(records):
+        for field, value in change.items():
+            if field == "created_at":
+                continue
+            if field == "meta":
+                for name in value:
+                    columns.setdefault("meta." + name, [None] * len(records))\
+                        [position] = value[name]
+            else:
+                columns.setdefault(field, [None] * len(records))\
+                    [position] = value
+    encoded = {}
+    for field, values in columns.items():
+        if all(type(value) is int for value in values):
+            encoded[field] = {"deltas": [b - a for a, b in
+                                         zip([0] + values, values)]}
+            continue
+        codes = {}
+        for value in values:
+            codes.setdefault(json.dumps(value), len(codes))
+        if len(codes) * 2 <= len(values):
+            encoded[field] = {"dict": [json.loads(value) for value in codes],
+                              "codes": [codes[json.dumps(value)]
+                                        for value in values]}
+        else:
+            encoded[field] = {"values": values}
+    return zlib.compress(json.dumps({"count": len(records),
+                                     "columns": encoded}).encode("utf-8"))
+
+def decode_columns(blob):
+    """ Returns the count and the decoded columns of a history segment """
+    data = json.loads(zlib.decompress(bytes(blob)).decode("utf-8"))
+    columns = {}
+    for field, column in data["columns"].items():
+        if "deltas" in column:
+            columns[field] = list(itertools.accumulate(column["deltas"]))
+        elif "dict" in column:
+            columns[field] = [column["dict"][code]
+                              for code in column["codes"]]
+        else:
+            columns[field] = column["values"]
+    return data["count"], columns
+
+def column_records(columns, start, stop, timezone):
+    """ Returns the records at positions start to stop of decoded columns """
+    records = []
+    for position in range(start, stop):
+        change = {"meta": {}}
+        for field, values in columns.items():
+            if field.startswith("meta."):
+                change["meta"][field[len("meta."):]] = values[position]
+            elif values[position] is not None or field != "seq":
+                change[field] = values[position]
+        change["created_at"] = arrow.get(change["meta"]["timestamp"])\
+                               .to(timezone).isoformat()
+        records.append(change)
+    return records
+
+def history_changes(budget, typ, start, end, limit, cursor, timezone):
+    """ Returns up to limit archived records, oldest first, and a cursor
+
+    Only records with a timestamp from start to end are returned. cursor is
+    the (segment, position) to continue from; the returned cursor is None
+    unless the page is full.
+    """
+    entity = ds_get(history_key(budget))
+    if entity is None:
+        return [], None
+    first_day = arrow.get(start).format("YYYY-MM-DD")
+    last_day = arrow.get(end).format("YYYY-MM-DD")
+    keys = [history_key(budget, day) for day in
+            json.loads(entity["index"])["days"]
+            if first_day <= day <= last_day]
+    found = ds_get_multi(keys)
+    segments = [segment for key in keys if key in found
+                for segment in json.loads(found[key]["index"])["segments"]
+                if segment[1] == typ and segment[4] >= start and
+                segment[3] <= end and
+                (cursor is None or segment[0] >= cursor[0])]
+
+    records = []
+    position = None
+    for segment in segments:
+        if len(records) >= limit:
+            break
+        found = ds_get(history_segment_key(budget, segment[0]))
+        if found is None:
+            continue
+        count, columns = decode_columns(found["columns"])
+        timestamps = columns["meta.timestamp"]
+        low = bisect.bisect_left(timestamps, start)
+        if cursor is not None and segment[0] == cursor[0]:
+            low = max(low, cursor[1])
+        high = min(bisect.bisect_right(timestamps, end),
+                   low + limit - len(records))
+        records += column_records(columns, low, high, timezone)
+        position = (segment[0], high)
+    if len(records) < limit:
+        return records, None
+    return records, position
+
+@app.route("/history/<budget>/<typ>", methods=["GET"])
+def history(budget, typ):
+    """ Returns archived change records of a feed, oldest first
+
+    Takes the query arguments start and end (ISO 8601 or Unix timestamps,
+    default all), limit, timezone and cursor. A full page is returned with
+    the cursor to pass for the next page.
+    """
+    if "IFTTT-Service-Key" not in request.headers or \
+            request.headers["IFTTT-Service-Key"] != get_ifttt_key():
+        log("history").error("invalid IFTTT service key!")
+        return json.dumps({"errors": [{"message": "Invalid key"}]}), 401
+    if typ not in FEED_POLICIES:
+        return json.dumps({"errors": [{"message": "Unknown feed"}]}), 404
+
+    try:
+        start = history_time(request.args.get("start"), 0)
+        end = history_time(request.args.get("end"), arrow.utcnow().timestamp)
+        limit = min(int(request.args.get("limit", 50)), HISTORY_MAX_LIMIT)
+        cursor = None
+        if request.args.get("cursor"):
+            cursor = tuple(int(part) for part in
+                           request.args["cursor"].split(":"))
+            if len(cursor) != 2:
+                raise ValueError("invalid cursor")
+        timezone = request.args.get("timezone", "UTC")
+        arrow.utcnow().to(timezone)
+    except:
+        log("history").error("invalid query arguments!")
+        return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
+    try:
+        records, position = history_changes(budget, typ, start, end, limit,
+                                            cursor, timezone)
+        payload = {"data": records}
+        if position is not None:
+            payload["cursor"] = "{}:{}".format(*position)
+        log("history").info("Found %d records", len(records))
+        return json_response(payload)
+    except:
+        traceback.print_exc()
+        log("history").error("cannot retrieve history")
+        return json.dumps({"errors": [{"message": \
+                           "Cannot retrieve history"}]}), 400
+
+def history_time(value, default):
+    """ Returns the Unix timestamp of a query argument """
+    if value is None or value == "":
+        return default
+    if value.isdigit():
+        return int(value)
+    return arrow.get(value).timestamp
+
+
+###############################################################################
+# Datastore write-behind queue                                                #
+###############################################################################
+
+# Updates on the request path that do not have to be stored before the
+# response is sent are queued, and flushed in batches by a background thread.
+# Queued updates are applied in order to the freshest stored entity at flush
+# time, in a transaction, so they never overwrite what the cron job wrote in
+# between.
+# Reads through ds_get see the queued writes. A write that keeps failing is
+# retried with backoff, and dropped after WRITE_ATTEMPTS attempts.
+WRITE_QUEUE = collections.OrderedDict()
+WRITE_QUEUE_MAX = 100
+WRITE_DELAY = 0.5
+WRITE_ATTEMPTS = 5
+WRITE_LOCK = threading.Condition()
+WRITE_THREAD = None
+
+# All Datastore access goes through the batched wrappers below, which count
+# the round trips per operation so that the cost of a cron run shows up in
+# the logs. Puts are split to stay below the commit limits of Datastore.
+DS_RPCS = collections.Counter()
+DS_RPC_LOCK = threading.Lock()
+DS_GET_MAX = 1000
+DS_PUT_MAX = 500
+DS_PUT_BYTES = 9000000
+TRANSACTION_ATTEMPTS = 3
+
+def get_dsclient():
+    """ Returns the Datastore client, constructing it on first use """
+    global DSCLIENT
+    if DSCLIENT is None:
+        with DSCLIENT_LOCK:
+            if DSCLIENT is None:
+                DSCLIENT = datastore.Client()
+    return DSCLIENT
+
+def ds_key(*path):
+    """ Returns the Datastore key of a kind/name path of the tenant """
+    return get_dsclient().key(*path, namespace=CURRENT_TENANT.get())
+
+def global_key(*path):
+    """ Returns the Datastore key of a kind/name path shared by tenants """
+    return get_dsclient().key(*path)
+
+def ds_count(op):
+    """ Counts one Datastore round trip """
+    with DS_RPC_LOCK:
+        DS_RPCS[op] += 1
+
+def ds_rpcs_since(before):
+    """ Returns a printable summary of the round trips since before """
+    with DS_RPC_LOCK:
+        return ", ".join("{}={}".format(op, DS_RPCS[op] - before.get(op, 0))
+                         for op in sorted(DS_RPCS))
+
+def ds_lookup(keys):
+    """ Returns {key: entity} of the stored keys, in batched lookups """
+    found = {}
+    for i in range(0, len(keys), DS_GET_MAX):
+        ds_count("get")
+        for entity in get_dsclient().get_multi(keys[i:i + DS_GET_MAX]):
+            found[entity.key] = entity
+    return found
+
+def ds_put_multi(entities):
+    """ Stores entities in as few commits as the Datastore limits allow """
+    batch = []
+    size = 0
+    for entity in entities:
+        esize = sum(len(v) for v in entity.values()
+                    if isinstance(v, (str, bytes)))
+        if batch and (len(batch) >= DS_PUT_MAX or
+                      size + esize > DS_PUT_BYTES):
+            ds_count("put")
+            get_dsclient().put_multi(batch)
+            batch = []
+            size = 0
+        batch.append(entity)
+        size += esize
+    if batch:
+        ds_count("put")
+        get_dsclient().put_multi(batch)
+
+def ds_delete_multi(keys):
+    """ Deletes keys in batched commits """
+    for i in range(0, len(keys), DS_PUT_MAX):
+        ds_count("delete")
+        get_dsclient().delete_multi(keys[i:i + DS_PUT_MAX])
+
+def ds_transaction(work):
+    """ Returns work(client) run in a transaction, retried on contention """
+    client = get_dsclient()
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            with client.transaction():
+                ds_count("commit")
+                return work(client)
+        except:
+            if attempt == TRANSACTION_ATTEMPTS - 1:
+                raise
+            traceback.print_exc()
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+def queue_update(key, update):
+    """ Queues update(entity), to be applied to the stored entity of key """
+    with WRITE_LOCK:
+        pending = WRITE_QUEUE.setdefault(key, {"updates": [], "attempts": 0})
+        pending["updates"].append(update)
+    write_queued()
+
+def ds_get(key):
+    """ Returns the entity of key, including any queued writes """
+    return ds_get_multi([key]).get(key)
+
+def ds_get_multi(keys):
+    """ Returns {key: entity} of keys, including any queued writes """
+    updates = {}
+    with WRITE_LOCK:
+        for key in keys:
+            if key in WRITE_QUEUE:
+                updates[key] = list(WRITE_QUEUE[key]["updates"])
+    found = ds_lookup(keys)
+    for key, entity in found.items():
+        for update in updates.get(key, []):
+            update(entity)
+    return found
+
+def write_queued():
+    """ Wakes up the writer thread, or flushes if the queue is full """
+    global WRITE_THREAD
+    with WRITE_LOCK:
+        full = len(WRITE_QUEUE) >= WRITE_QUEUE_MAX
+        if WRITE_THREAD is None:
+            WRITE_THREAD = threading.Thread(target=write_behind, daemon=True)
+            WRITE_THREAD.start()
+        WRITE_LOCK.notify()
+    if full:
+        flush_writes()
+
+def write_behind():
+    """ Writer thread: flushes the queue shortly after writes are queued """
+    failures = 0
+    while True:
+        with WRITE_LOCK:
+            while not WRITE_QUEUE:
+                WRITE_LOCK.wait()
+        # give concurrent writes a moment to coalesce into this batch, and
+        # back off while the writes fail
+        time.sleep(WRITE_DELAY * 2 ** failures)
+        if flush_writes():
+            failures = 0
+        else:
+            failures = min(failures + 1, WRITE_ATTEMPTS)
+
+def flush_writes():
+    """ Applies all queued updates in one transaction
+
+    Returns False if the writes failed and were requeued.
+    """
+    with WRITE_LOCK:
+        pending = list(WRITE_QUEUE.items())
+        WRITE_QUEUE.clear()
+    if not pending:
+        return True
+
+    try:
+        apply_updates(collections.OrderedDict(
+            (key, p["updates"]) for key, p in pending))
+    except:
+        traceback.print_exc()
+        with WRITE_LOCK:
+            for key, p in pending:
+                p["attempts"] += 1
+                if p["attempts"] >= WRITE_ATTEMPTS:
+                    log("writes").error("dropping write of %s after %d "
+                                        "attempts", key, p["attempts"])
+                    continue
+                # keep the updates queued in the meantime after these
+                if key in WRITE_QUEUE:
+                    p["updates"].extend(WRITE_QUEUE[key]["updates"])
+                WRITE_QUEUE[key] = p
+        return False
+    return True
+
+def apply_updates(updates):
+    """ Applies queued updates to the stored entities in one transaction
+
+    A sync storing one of the entities in the meantime makes the commit
+    fail, so the updates are retried on what it stored instead of
+    overwriting it.
+    """
+    def work(client):
+        ds_count("get")
+        stored = client.get_multi(list(updates))
+        for entity in stored:
+            for update in updates[entity.key]:
+                update(entity)
+        if stored:
+            client.put_multi(stored)
+    ds_transaction(work)
+
+atexit.register(flush_writes)
+
+def trigger_update(typ, triggerid, spec=None):
+    """ Returns a queued update registering a trigger on a feed """
+    def update(entity):
+        data = json.loads(entity[typ])
+        triggers = data.get("triggers", [])
+        if triggerid not in triggers:
+            triggers.append(triggerid)
+            data["triggers"] = triggers
+        if typ == "transactions" and \
+                data.get("filters", {}).get(triggerid) != spec:
+            update_transaction_filter(data, triggerid, spec)
+        entity[typ] = json.dumps(data)
+    return update
+
+
+###############################################################################
+# Parsed budget state cache                                                   #
+###############################################################################
+
+# The sync keeps the parsed collections of the budgets it synced in memory,
+# so the next sync of a budget on this instance does not parse them again.
+# An entry is only used while the collection stored in Datastore is still
+# the JSON it was parsed from: a sync on another instance or a trigger
+# registration may have changed it, and the server knowledge alone does not
+# show the latter. A sync changes the parsed data in place, so entries are
+# taken out of the cache while in use and only put back once the entity is
+# stored; a failed sync parses from storage the next time. The least
+# recently used entries are evicted beyond STATE_CACHE_BYTES of JSON.
+STATE_CACHE = collections.OrderedDict()
+STATE_CACHE_BYTES = int(os.environ.get("STATE_CACHE_BYTES", "8000000"))
+STATE_CACHE_STATS = collections.Counter()
+STATE_CACHE_LOCK = threading.Lock()
+
+def checkout_state(budget, typ, stored):
+    """ Returns the parsed collection of the stored JSON """
+    key = (CURRENT_TENANT.get(), budget, typ)
+    with STATE_CACHE_LOCK:
+        entry = STATE_CACHE.pop(key, None)
+        if entry is not None:
+            STATE_CACHE_STATS["bytes"] -= len(entry[0])
+        if entry is not None and entry[0] == stored:
+            STATE_CACHE_STATS["hits"] += 1
+            return entry[1]
+        STATE_CACHE_STATS["misses"] += 1
+    return json.loads(stored)
+
+def checkin_states(budget, entity, states):
+    """ Caches the parsed collections of a stored budget entity """
+    with STATE_CACHE_LOCK:
+        for typ, (stored, data) in states.items():
+            # bound_entity may have replaced the collection after parsing
+            if entity[typ] is not stored or \
+                    len(stored) > STATE_CACHE_BYTES:
+                continue
+            key = (CURRENT_TENANT.get(), budget, typ)
+            old = STATE_CACHE.pop(key, None)
+            if old is not None:
+                STATE_CACHE_STATS["bytes"] -= len(old[0])
+            STATE_CACHE[key] = (stored, data)
+            STATE_CACHE_STATS["bytes"] += len(stored)
+        while STATE_CACHE_STATS["bytes"] > STATE_CACHE_BYTES:
+            key, evicted = STATE_CACHE.popitem(last=False)
+            STATE_CACHE_STATS["bytes"] -= len(evicted[0])
+            STATE_CACHE_STATS["evictions"] += 1
+
+def state_cache_summary():
+    """ Returns a printable summary of the state cache use """
+    with STATE_CACHE_LOCK:
+        return "entries={}, {}".format(len(STATE_CACHE), ", ".join(
+            "{}={}".format(name, STATE_CACHE_STATS[name])
+            for name in sorted(STATE_CACHE_STATS)))
+
+
+###############################################################################
+# Datastore leases                                                            #
+###############################################################################
+
+# A lease gives one cron run exclusive use of a resource across requests and
+# instances. It expires LEASE_TTL seconds after it was last renewed, so a run
+# that died does not block the next ones for long. While held, a heartbeat
+# thread renews it every LEASE_TTL / 3 seconds; if renewing fails because
+# another run took over, the lease is marked lost and the run must not store
+# its results.
+LEASE_TTL = 120
+INSTANCE_ID = uuid.uuid4().hex
+
+def acquire_lease(name, owner):
+    """ Takes or renews a lease, returns the previous entity or False """
+    client = get_dsclient()
+    key = ds_key("lease", name)
+    try:
+        with client.transaction():
+            ds_count("commit")
+            previous = client.get(key)
+            now = time.time()
+            if previous is not None and previous["owner"] != owner and \
+                    previous["expires"] > now:
+                return False
+            entity = datastore.Entity(key)
+            entity["owner"] = owner
+            entity["instance"] = INSTANCE_ID
+            entity["expires"] = now + LEASE_TTL
+            client.put(entity)
+    except:
+        # a concurrent transaction on the lease won
+        traceback.print_exc()
+        return False
+    return previous if previous is not None else {}
+
+def start_lease(name):
+    """ Acquires a lease and starts its heartbeat, or returns None """
+    owner = uuid.uuid4().hex
+    previous = acquire_lease(name, owner)
+    if previous is False:
+        return None
+    lease = {
+        "name": name,
+        "owner": owner,
+        "previous": previous.get("instance"),
+        "lost": False,
+        "stop": threading.Event(),
+    }
+    # the heartbeat renews the lease of the same tenant
+    lease["thread"] = threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(lease_heartbeat, lease), daemon=True)
+    lease["thread"].start()
+    return lease
+
+def lease_heartbeat(lease):
+    """ Renews a lease until it is ended, or marks it lost """
+    while not lease["stop"].wait(LEASE_TTL / 3):
+        if acquire_lease(lease["name"], lease["owner"]) is False:
+            log("lease").error("Lost lease %s", lease["name"])
+            lease["lost"] = True
+            return
+
+def end_lease(lease):
+    """ Stops the heartbeat and releases a lease we still hold """
+    lease["stop"].set()
+    lease["thread"].join()
+    if not lease["lost"]:
+        release_lease(lease["name"], lease["owner"])
+
+def release_lease(name, owner):
+    """ Releases a lease if owner still holds it """
+    client = get_dsclient()
+    key = ds_key("lease", name)
+    try:
+        with client.transaction():
+            ds_count("commit")
+            entity = client.get(key)
+            if entity is not None and entity["owner"] == owner:
+                # keep the entity, so the next holder sees who ran last
+                entity["expires"] = 0
+                client.put(entity)
+    except:
+        traceback.print_exc()
+
+
+###############################################################################
+# Sync task queue                                                             #
+###############################################################################
+
+# The cron job enqueues a sync task per budget with changes, so a slow
+# budget does not hold up the others, and each budget is retried on its own.
+# TASK_QUEUE selects where the tasks go:
+# - "local" (default): an in-process queue whose TASK_WORKERS threads sync
+#   the budgets in parallel and retry failed ones, within the cron request;
+# - "inline": sync the budgets one after the other within the cron request;
+# - "projects/<project>/locations/<location>/queues/<queue>": Cloud Tasks,
+#   which requests /cron/ynab/<budget> per budget, in parallel across
+#   instances. This needs google-cloud-tasks in requirements.txt.
+TASK_QUEUE = os.environ.get("TASK_QUEUE", "local")
+TASK_HEADER = "X-AppEngine-QueueName"
+TASK_WORKERS = 4
+TASK_ATTEMPTS = 5
+TASK_BACKOFF = 1
+TASKS_CLIENT = None
+TASKS_LOCK = threading.Lock()
+LOCAL_TASKS = queue.Queue()
+LOCAL_WORKERS = []
+
+def enqueue_sync(budget, modified, name, deadline):
+    """ Enqueues the sync of a budget, name deduplicates Cloud Tasks
+
+    Returns False if the sync would run inline and the deadline of the
+    enqueuing request has passed.
+    """
+    if TASK_QUEUE == "inline":
+        if time.time() > deadline:
+            return False
+        run_sync(budget, modified, deadline)
+    elif TASK_QUEUE == "local":
+        start_local_workers()
+        LOCAL_TASKS.put((CURRENT_TENANT.get(), budget, modified, deadline))
+    else:
+        params = {"modified": modified}
+        if CURRENT_TENANT.get() is not None:
+            params["tenant"] = CURRENT_TENANT.get()
+        create_cloud_task("/cron/ynab/{}?{}".format(
+            budget, urllib.parse.urlencode(params)), name)
+    return True
+
+def local_task_worker():
+    while True:
+        tenant, budget, modified, deadline = LOCAL_TASKS.get()
+        try:
+            with tenant_context(tenant):
+                for attempt in range(TASK_ATTEMPTS):
+                    if attempt:
+                        time.sleep(TASK_BACKOFF * 2 ** (attempt - 1))
+                    if time.time() > deadline:
+                        log("tasks").warning("Deadline reached, leaving "
+                                             "budget %s to the next run",
+                                             budget)
+                        break
+                    if run_sync(budget, modified, deadline) < 500:
+                        break
+                else:
+                    log("tasks").error("Giving up sync of budget %s",
+                                       budget)
+        except:
+            traceback.print_exc()
+        finally:
+            LOCAL_TASKS.task_done()
+
+def start_local_workers():
+    with TASKS_LOCK:
+        while len(LOCAL_WORKERS) < TASK_WORKERS:
+            worker = threading.Thread(target=local_task_worker, daemon=True)
+            worker.start()
+            LOCAL_WORKERS.append(worker)
+
+def drain_local_tasks():
+    """ Waits until the local queue has run all tasks """
+    LOCAL_TASKS.join()
+
+def create_cloud_task(path, name):
+    """ Enqueues a task in the Cloud Tasks queue TASK_QUEUE """
+    global TASKS_CLIENT
+    tasks_v2 = importlib.import_module("google.cloud.tasks_v2")
+    exceptions = importlib.import_module("google.api_core.exceptions")
+    with TASKS_LOCK:
+        if TASKS_CLIENT is None:
+            TASKS_CLIENT = tasks_v2.CloudTasksClient()
+    task = {
+        "name": "{}/tasks/{}".format(TASK_QUEUE, name),
+        "app_engine_http_request": {
+            "http_method": tasks_v2.HttpMethod.GET,
+            "relative_uri": path,
+        },
+    }
+    try:
+        TASKS_CLIENT.create_task(request={"parent": TASK_QUEUE,
+                                          "task": task})
+    except exceptions.AlreadyExists:
+        log("tasks").info("Task %s was already enqueued", name)
+
+
+###############################################################################
+# IFTTT realtime notification queue                                           #
+###############################################################################
+
+# Trigger identities to notify are queued in Datastore, so a notification
+# that fails is retried with backoff by the next cron runs instead of being
+# lost. A trigger that was notified less than NOTIFY_DEBOUNCE seconds ago is
+# held back until the window has passed: the changes of several syncs are
+# announced by one notification, and none of them is dropped.
+# Sync tasks of several budgets queue notifications concurrently, so the
+# queue is only changed in transactions, and a "notify" lease makes sure one
+# request at a time delivers them. A change queued for a trigger that is
+# being delivered bumps its version, which keeps it queued for one more
+# notification.
+NOTIFY_URL = "https://realtime.ifttt.com/v1/notifications"
+NOTIFY_CHUNK = 1000
+NOTIFY_DEBOUNCE = 120
+NOTIFY_BACKOFF = 60
+NOTIFY_BACKOFF_MAX = 3600
+NOTIFY_MAX_ATTEMPTS = 10
+NOTIFY_LATENCIES = 100
+
+def notify_entity(state):
+    """ Returns the entity storing the notification queue """
+    entity = datastore.Entity(ds_key("notify", "queue"),
+                              exclude_from_indexes=["data"])
+    entity["data"] = json.dumps(state)
+    return entity
+
+def notify_state(entity):
+    """ Returns the notification queue stored in entity """
+    if entity is None:
+        return {"pending": {}, "sent": {}, "latency": []}
+    return json.loads(entity["data"])
+
+def load_notify_queue():
+    """ Returns the stored notification queue """
+    return notify_state(ds_get(ds_key("notify", "queue")))
+
+def update_notify_queue(update):
+    """ Changes the notification queue in a transaction
+
+    update(state) changes the queue in place and returns whether it did.
+    """
+    key = ds_key("notify", "queue")
+    def work(client):
+        state = notify_state(client.get(key))
+        if update(state):
+            client.put(notify_entity(state))
+        return state
+    return ds_transaction(work)
+
+def queue_notifications(state, triggers, now):
+    """ Queues trigger identities, returns whether the queue changed """
+    changed = expire_notified(state, now)
+    for triggerid in triggers:
+        changed = True
+        if triggerid in state["pending"]:
+            # the queued notification covers this change as well
+            pending = state["pending"][triggerid]
+            pending["version"] = pending.get("version", 0) + 1
+            continue
+        due = state["sent"].get(triggerid, 0) + NOTIFY_DEBOUNCE
+        state["pending"][triggerid] = {"queued": now, "due": max(now, due),
+                                       "attempts": 0, "version": 0}
+    return changed
+
+def expire_notified(state, now):
+    """ Forgets triggers notified before the debounce window """
+    changed = False
+    for triggerid, sent in list(state["sent"].items()):
+        if sent + NOTIFY_DEBOUNCE <= now:
+            del state["sent"][triggerid]
+            changed = True
+    return changed
+
+def deliver_notifications():
+    """ Notifies IFTTT of the due triggers, unless another request does """
+    now = time.time()
+    state = load_notify_queue()
+    if not any(p["due"] <= now for p in state["pending"].values()):
+        return
+    lease = start_lease("notify")
+    if lease is None:
+        return
+    try:
+        # read again, the previous holder may just have delivered them
+        results = post_due_notifications(load_notify_queue(), time.time())
+        if results["delivered"] or results["failed"]:
+            if lease["lost"]:
+                log("notify").error("Lease lost, not storing deliveries")
+                return
+            update_notify_queue(
+                lambda state: apply_deliveries(state, results))
+    finally:
+        end_lease(lease)
+
+def post_due_notifications(state, now):
+    """ Posts the due triggers, returns the delivered and failed ones """
+    due = [t for t in state["pending"] if state["pending"][t]["due"] <= now]
+    due = sorted(due, key=lambda t: state["pending"][t]["queued"])
+    results = {"now": now, "delivered": {}, "failed": []}
+    for i in range(0, len(due), NOTIFY_CHUNK):
+        chunk = due[i:i + NOTIFY_CHUNK]
+        # after a failure, back off the rest of this run as well
+        if not results["failed"] and post_notifications(chunk):
+            for triggerid in chunk:
+                results["delivered"][triggerid] = \
+                    state["pending"][triggerid].get("version", 0)
+        else:
+            results["failed"].extend(chunk)
+    return results
+
+def apply_deliveries(state, results):
+    """ Updates the queue with the results of post_due_notifications """
+    now = results["now"]
+    expire_notified(state, now)
+    latency = []
+    for triggerid, version in results["delivered"].items():
+        pending = state["pending"].get(triggerid)
+        if pending is None:
+            continue
+        state["sent"][triggerid] = now
+        if pending.get("version", 0) != version:
+            # changed again while it was delivered
+            pending["due"] = now + NOTIFY_DEBOUNCE
+            pending["attempts"] = 0
+            continue
+        del state["pending"][triggerid]
+        latency.append(round(now - pending["queued"], 1))
+    if latency:
+        log("notify").info("Notified %d triggers, latency max %ss",
+                           len(latency), max(latency))
+        state["latency"] = (state["latency"] + latency)[-NOTIFY_LATENCIES:]
+
+    for triggerid in results["failed"]:
+        pending = state["pending"].get(triggerid)
+        if pending is None:
+            continue
+        pending["attempts"] += 1
+        if pending["attempts"] >= NOTIFY_MAX_ATTEMPTS:
+            log("notify").error("Giving up notifying trigger %s", triggerid)
+            del state["pending"][triggerid]
+        else:
+            pending["due"] = now + min(
+                NOTIFY_BACKOFF * 2 ** (pending["attempts"] - 1),
+                NOTIFY_BACKOFF_MAX)
+    return True
+
+def post_notifications(triggerids):
+    """ Posts one chunk of trigger identities, returns whether it worked """
+    data = {"data": []}
+    for triggerid in triggerids:
+        data["data"].append({"trigger_identity": triggerid})
+    headers = {
+        "IFTTT-Channel-Key": get_ifttt_key(),
+        "IFTTT-Service-Key": get_ifttt_key(),
+        "X-Request-ID": uuid.uuid4().hex,
+        "Content-Type": "application/json"
+    }
+    try:
+        res = requests.post(NOTIFY_URL, headers=headers,
+                            data=json.dumps(data), timeout=YNAB_TIMEOUT)
+    except requests.RequestException:
+        traceback.print_exc()
+        return False
+    log_payload(log("notify"), "response {}".format(res.status_code),
+                res.text, res.status_code > 299)
+    return res.status_code < 300
 
 
 ###############################################################################
 # Config storage/caching                                                      #
 ###############################################################################
 
+GLOBAL_CONFIG_NAMES = ["ifttt_key", "session_key"]
+TENANT_CONFIG_NAMES = ["ynab_key", "ynab_default_budget"]
+
+def load_config():
+    """ Loads all unset config values with one batched lookup """
+    global IFTTT_SERVICE_KEY, WEB_SESSION_KEY
+    keys = [global_key("config", name) for name in GLOBAL_CONFIG_NAMES] + \
+           [ds_key("config", name) for name in TENANT_CONFIG_NAMES]
+    values = {}
+    for key, entity in ds_get_multi(keys).items():
+        values[key.name] = entity["value"]
+    if IFTTT_SERVICE_KEY is None:
+        IFTTT_SERVICE_KEY = values.get("ifttt_key")
+    if WEB_SESSION_KEY is None:
+        WEB_SESSION_KEY = values.get("session_key")
+    for name in TENANT_CONFIG_NAMES:
+        if TENANT_CACHE.get(name) is None:
+            TENANT_CACHE[name] = values.get(name)
+
 def get_ifttt_key():
     """ Returns the IFTTT service key """
-    global IFTTT_SERVICE_KEY
     try:
         if IFTTT_SERVICE_KEY is None:
-            key = DSCLIENT.key("config", "ifttt_key")
-            entity = DSCLIENT.get(key)
-            if entity is not None:
-                IFTTT_SERVICE_KEY = entity["value"]
+            load_config()
     except:
         traceback.print_exc()
     return IFTTT_SERVICE_KEY
 
 def get_ynab_key():
     """ Returns the YNAB personal access token """
-    global YNAB_ACCOUNT_KEY
     try:
-        if YNAB_ACCOUNT_KEY is None:
-            key = DSCLIENT.key("config", "ynab_key")
-            entity = DSCLIENT.get(key)
-            if entity is not None:
-                YNAB_ACCOUNT_KEY = entity["value"]
+        if TENANT_CACHE.get("ynab_key") is None:
+            load_config()
     except:
         traceback.print_exc()
-    return YNAB_ACCOUNT_KEY
+    return TENANT_CACHE.get("ynab_key")
 
 def get_default_budget():
     """ Returns the default YNAB budget uuid """
-    global YNAB_DEFAULT_BUDGET
     try:
-        if YNAB_DEFAULT_BUDGET is None:
-            key = DSCLIENT.key("config", "ynab_default_budget")
-            entity = DSCLIENT.get(key)
-            if entity is not None:
-                YNAB_DEFAULT_BUDGET = entity["value"]
+        if TENANT_CACHE.get("ynab_default_budget") is None:
+            load_config()
     except:
         traceback.print_exc()
-    return YNAB_DEFAULT_BUDGET
+    return TENANT_CACHE.get("ynab_default_budget")
 
 def get_session_key():
     """ Returns the web interface session key """
-    global WEB_SESSION_KEY
     try:
         if WEB_SESSION_KEY is None:
-            key = DSCLIENT.key("config", "session_key")
-            entity = DSCLIENT.get(key)
-            if entity is not None:
-                WEB_SESSION_KEY = entity["value"]
+            load_config()
     except:
         traceback.print_exc()
     return WEB_SESSION_KEY
@@ -1845,14 +4614,237 @@ def new_session_key():
     try:
         WEB_SESSION_KEY = secrets.token_urlsafe(32)
 
-        entity = datastore.Entity(DSCLIENT.key("config", "session_key"))
+        entity = datastore.Entity(global_key("config", "session_key"))
         entity["value"] = WEB_SESSION_KEY
-        DSCLIENT.put(entity)
+        with tenant_context(None):
+            store_config([entity])
     except:
         traceback.print_exc()
 
     return WEB_SESSION_KEY
 
+###############################################################################
+# Cross-instance cache generation                                             #
+###############################################################################
+
+# Every instance caches config and budget data in module globals. To keep
+# these coherent when more than one instance runs, each request checks (at
+# most once per GENERATION_TTL seconds per tenant, with one lookup) the
+# following entities of its tenant:
+# - "config"/"generation", a counter bumped in the same transaction as every
+#   config change, which invalidates the cached config values. The one of
+#   the default namespace also covers the config shared by all tenants;
+# - "budget"/"budgets", the budget list of the cron job, which also holds a
+#   sync counter and the server knowledge of every budget. A newer knowledge
+#   (from a sync, or a transaction created on another instance) invalidates
+#   the cached balances and options of that budget, and a sync by another
+#   instance the cached budget list.
+GENERATION_TTL = 5
+GENERATION = TenantDict("generation", lambda: {
+    "config": None, "global": None, "sync": None, "knowledge": {},
+    "checked": 0})
+GENERATION_LOCK = threading.Lock()
+
+@app.before_request
+def before_request():
+    tenant = None
+    auth = request.headers.get("Authorization", "")
+    if TASK_HEADER in request.headers:
+        # only task queues can send this header on App Engine, see Tenants
+        tenant = request.args.get("tenant")
+    elif auth.startswith("Bearer "):
+        tenant = token_tenant(auth[len("Bearer "):])
+        if tenant is False:
+            return json.dumps({"errors": [{"message": "Invalid token"}]}), \
+                   401
+    # reset on teardown, so the tenant does not leak into later work of the
+    # thread
+    request.environ[TENANT_ENVIRON] = CURRENT_TENANT.set(tenant)
+    try:
+        check_generation()
+    except:
+        traceback.print_exc()
+
+@app.teardown_request
+def teardown_request(exc):
+    token = request.environ.pop(TENANT_ENVIRON, None)
+    if token is not None:
+        CURRENT_TENANT.reset(token)
+
+def check_generation():
+    """ Drops cached data that another instance has changed """
+    global IFTTT_SERVICE_KEY, WEB_SESSION_KEY
+    with GENERATION_LOCK:
+        if GENERATION["checked"] > time.time() - GENERATION_TTL:
+            return
+        GENERATION["checked"] = time.time()
+    keys = [global_key("config", "generation"),
+            ds_key("config", "generation"), ds_key("budget", "budgets")]
+    # the first two are the same key for the default tenant
+    found = ds_get_multi(list(set(keys)))
+
+    shared = found.get(keys[0])
+    config = found.get(keys[1])
+    shared = shared["value"] if shared is not None else 0
+    value = config["value"] if config is not None else 0
+    with GENERATION_LOCK:
+        if GENERATION["global"] is not None and \
+                GENERATION["global"] != shared:
+            log("cache").info("Shared config changed, dropping it")
+            IFTTT_SERVICE_KEY = None
+            WEB_SESSION_KEY = None
+        GENERATION["global"] = shared
+        if GENERATION["config"] is not None and \
+                GENERATION["config"] != value:
+            log("cache").info("Config changed, dropping cached config")
+            for name in TENANT_CONFIG_NAMES:
+                TENANT_CACHE.pop(name, None)
+        GENERATION["config"] = value
+
+    budgets = found.get(ds_key("budget", "budgets"))
+    if budgets is None:
+        return
+    sync = budgets.get("sync", 0)
+    knowledge = json.loads(budgets.get("knowledge", "{}"))
+    with GENERATION_LOCK:
+        if GENERATION["sync"] is not None:
+            if GENERATION["sync"] != sync:
+                TENANT_CACHE["budgets"] = json.loads(budgets["data"])
+            for budget in knowledge:
+                if knowledge[budget] > GENERATION["knowledge"].get(budget, 0):
+                    invalidate_budget(budget, knowledge[budget])
+        GENERATION["sync"] = sync
+        GENERATION["knowledge"] = knowledge
+
+def invalidate_budget(budget, knowledge):
+    """ Drops the cached data of a budget older than knowledge """
+    YNAB_OPTIONS.pop(budget, None)
+    with BALANCES_LOCK:
+        cache = YNAB_BALANCES.get(budget)
+        if cache is not None and cache.get("knowledge", 0) < knowledge:
+            del YNAB_BALANCES[budget]
+
+def store_config(entities):
+    """ Stores config entities together with a new config generation """
+    client = get_dsclient()
+    key = ds_key("config", "generation")
+    with client.transaction():
+        ds_count("commit")
+        generation = client.get(key)
+        if generation is None:
+            generation = datastore.Entity(key)
+            generation["value"] = 0
+        generation["value"] += 1
+        client.put_multi(entities + [generation])
+    with GENERATION_LOCK:
+        GENERATION["config"] = generation["value"]
+        if CURRENT_TENANT.get() is None:
+            GENERATION["global"] = generation["value"]
+
+def update_budget_list(update):
+    """ Changes the budget list entity in a transaction
+
+    update(budgets, knowledge, synced) changes the list, the server
+    knowledge per budget and the knowledge synced per budget in place. Sync
+    tasks of several budgets commit concurrently, so the entity is never
+    written without reading it in the same transaction.
+    """
+    key = ds_key("budget", "budgets")
+    def work(client):
+        entity = client.get(key)
+        if entity is None:
+            entity = datastore.Entity(key)
+        entity.exclude_from_indexes.update(["data", "knowledge", "synced"])
+        budgets = json.loads(entity.get("data", "[]"))
+        knowledge = json.loads(entity.get("knowledge", "{}"))
+        synced = json.loads(entity.get("synced", "{}"))
+        update(budgets, knowledge, synced)
+        entity["data"] = json.dumps(budgets)
+        entity["knowledge"] = json.dumps(knowledge)
+        entity["synced"] = json.dumps(synced)
+        entity["sync"] = entity.get("sync", 0) + 1
+        client.put(entity)
+        return budgets
+    TENANT_CACHE["budgets"] = ds_transaction(work)
+
+def store_budget_list(budgets):
+    """ Stores the YNAB budget list, keeping what was synced per budget """
+    def update(stored, knowledge, synced):
+        modified = {}
+        for b in stored:
+            modified[b['id']] = b['last_modified_on']
+        stored[:] = [{"id": a['id'], "name": a['name'],
+                      "last_modified_on": modified.get(a['id'])}
+                     for a in budgets]
+    update_budget_list(update)
+
+def commit_budget_sync(budget, name, modified, knowledge):
+    """ Records a synced budget and its server knowledge in the budget list
+
+    A sync that changed nothing does not store the budget entity, so the
+    server knowledge it synced to is only recorded here.
+    """
+    def update(stored, known, synced):
+        for b in stored:
+            if b['id'] == budget:
+                b['name'] = name
+                b['last_modified_on'] = modified
+                break
+        else:
+            stored.append({"id": budget, "name": name,
+                           "last_modified_on": modified})
+        known[budget] = max(known.get(budget, 0), knowledge)
+        synced[budget] = knowledge
+    update_budget_list(update)
+    with GENERATION_LOCK:
+        GENERATION["knowledge"][budget] = max(
+            GENERATION["knowledge"].get(budget, 0), knowledge)
+
+def publish_knowledge(budget, knowledge):
+    """ Lets other instances know we changed a budget ourselves """
+    if not knowledge:
+        return
+    with GENERATION_LOCK:
+        GENERATION["knowledge"][budget] = max(
+            GENERATION["knowledge"].get(budget, 0), knowledge)
+    def update(entity):
+        data = json.loads(entity.get("knowledge", "{}"))
+        data[budget] = max(data.get(budget, 0), knowledge)
+        entity["knowledge"] = json.dumps(data)
+        entity.exclude_from_indexes.add("knowledge")
+    queue_update(ds_key("budget", "budgets"), update)
+
+
+###############################################################################
+# App Engine warmup                                                           #
+###############################################################################
+
+@app.route("/_ah/warmup")
+def warmup():
+    """ Preloads modules, config and caches before traffic arrives """
+    try:
+        # loads the deferred modules and builds the Datastore client
+        arrow.utcnow()
+        requests.RequestException
+        load_config()
+
+        budgets = [b["value"] for b in get_budget_options()]
+        keys = [ds_key("options", b) for b in budgets if b not in YNAB_OPTIONS]
+        for key, entity in ds_get_multi(keys).items():
+            YNAB_OPTIONS.setdefault(key.name, json.loads(entity["data"]))
+
+        # primes the account cache of the adjust balance action and the
+        # category lookup of the actions
+        budget = get_default_budget()
+        if budget is not None and get_ynab_key() is not None:
+            get_ynab_accounts_raw(budget)
+            get_ynab_categories_raw(budget)
+        log("warmup").info("Warmed up, %d budgets", len(budgets))
+    except:
+        traceback.print_exc()
+    return ""
+
+
 ###############################################################################
 # Web interface methods                                                       #
 ###############################################################################
@@ -1878,9 +4870,9 @@ def user_login():
         hashfunc = hashlib.sha256()
         hashfunc.update(request.form["password"].encode("utf-8"))
 
-        stored_hash = DSCLIENT.get(DSCLIENT.key("config", "password_hash"))
+        stored_hash = ds_get(ds_key("config", "password_hash"))
         if stored_hash is not None:
-            salt = DSCLIENT.get(DSCLIENT.key("config", "password_salt"))
+            salt = ds_get(ds_key("config", "password_salt"))
             hashfunc.update(salt["value"].encode('ascii'))
             calc_hash = base64.b64encode(hashfunc.digest()).decode('ascii')
             if calc_hash != stored_hash["value"]:
@@ -1893,12 +4885,11 @@ def user_login():
             hashfunc.update(salt.encode('ascii'))
             calc_hash = base64.b64encode(hashfunc.digest()).decode('ascii')
 
-            entity = datastore.Entity(DSCLIENT.key("config", "password_salt"))
-            entity["value"] = salt
-            DSCLIENT.put(entity)
-            entity = datastore.Entity(DSCLIENT.key("config", "password_hash"))
+            saltentity = datastore.Entity(ds_key("config", "password_salt"))
+            saltentity["value"] = salt
+            entity = datastore.Entity(ds_key("config", "password_hash"))
             entity["value"] = calc_hash
-            DSCLIENT.put(entity)
+            store_config([saltentity, entity])
 
         resp = make_response(redirect('/'))
         resp.set_cookie("session", new_session_key())
@@ -1922,9 +4913,10 @@ def ifttt_key():
 
         keyvalue = request.form["iftttkey"].strip()
         if len(keyvalue) == 64:
-            entity = datastore.Entity(key=DSCLIENT.key("config", "ifttt_key"))
+            entity = datastore.Entity(key=global_key("config", "ifttt_key"))
             entity["value"] = keyvalue
-            DSCLIENT.put(entity)
+            with tenant_context(None):
+                store_config([entity])
             IFTTT_SERVICE_KEY = None
             return redirect("/")
 
@@ -1940,7 +4932,6 @@ def ifttt_key():
 @app.route("/set_ynab_key", methods=["POST"])
 def ynab_key():
     """ Handles the submission of the YNAB key """
-    global YNAB_ACCOUNT_KEY
     try:
         cookie = request.cookies.get('session')
         if cookie is None or cookie != get_session_key():
@@ -1949,10 +4940,10 @@ def ynab_key():
 
         keyvalue = request.form["ynabkey"].strip()
         if len(keyvalue) == 64:
-            entity = datastore.Entity(key=DSCLIENT.key("config", "ynab_key"))
+            entity = datastore.Entity(key=ds_key("config", "ynab_key"))
             entity["value"] = keyvalue
-            DSCLIENT.put(entity)
-            YNAB_ACCOUNT_KEY = None
+            store_config([entity])
+            TENANT_CACHE.pop("ynab_key", None)
             return redirect("/")
 
         return render_template("message.html", msgtype="danger", msg=\
@@ -1966,7 +4957,6 @@ def ynab_key():
 
 @app.route("/make_default", methods=["GET"])
 def make_default():
-    global YNAB_DEFAULT_BUDGET
     try:
         cookie = request.cookies.get('session')
         if cookie is None or cookie != get_session_key():
@@ -1976,11 +4966,10 @@ def make_default():
         budgetid = request.args["budget"]
         uuid.UUID(budgetid) # check if valid uuid
 
-        entity = datastore.Entity(key=DSCLIENT.key("config",
-                                                   "ynab_default_budget"))
+        entity = datastore.Entity(key=ds_key("config", "ynab_default_budget"))
         entity["value"] = budgetid
-        DSCLIENT.put(entity)
-        YNAB_DEFAULT_BUDGET = budgetid
+        store_config([entity])
+        TENANT_CACHE["ynab_default_budget"] = budgetid
 
         return redirect("/")
     except:
@@ -1989,6 +4978,57 @@ def make_default():
             'Error while processing default budget. See the logs. <br><br>'\
             '<a href="/">Click here to return home</a>')
 
+@app.route("/admin/tenants", methods=["POST"])
+def admin_tenants():
+    """ Creates a tenant, or changes its YNAB token or default budget
+
+    Takes the JSON or form fields ynab_key, default_budget and, to change
+    an existing tenant, tenant. A new tenant is returned with the bearer
+    token its IFTTT requests must send, which is not stored.
+    """
+    cookie = request.cookies.get('session')
+    if CURRENT_TENANT.get() is not None or cookie is None or \
+            cookie != get_session_key():
+        return json.dumps({"errors": [{"message": "Invalid session"}]}), 401
+    try:
+        fields = request.get_json(silent=True) or request.form
+        tenant = fields.get("tenant") or None
+        ynabkey = fields.get("ynab_key", "").strip()
+        budget = fields.get("default_budget", "").strip()
+        if (tenant is None or ynabkey) and len(ynabkey) != 64:
+            return json.dumps({"errors": [{
+                "message": "Invalid YNAB token: length is not 64"}]}), 400
+        if budget:
+            uuid.UUID(budget) # check if valid uuid
+
+        result = {}
+        if tenant is None:
+            tenant = uuid.uuid4().hex
+            result["token"] = secrets.token_urlsafe(32)
+            create_tenant(tenant, result["token"])
+        elif tenant not in list_tenants():
+            return json.dumps({"errors": [{"message": "Unknown tenant"}]}), \
+                   404
+        result["tenant"] = tenant
+
+        with tenant_context(tenant):
+            entities = []
+            for name, value in [("ynab_key", ynabkey),
+                                ("ynab_default_budget", budget)]:
+                if value:
+                    entity = datastore.Entity(key=ds_key("config", name))
+                    entity["value"] = value
+                    entities.append(entity)
+                    TENANT_CACHE.pop(name, None)
+            if entities:
+                store_config(entities)
+        log("admin").info("Stored tenant %s", tenant)
+        return json.dumps({"data": result})
+    except:
+        traceback.print_exc()
+        return json.dumps({"errors": [{"message": "Unknown exception"}]}), \
+               500
+
 
 if __name__ == "__main__":
     app.run(host="localhost", port=18000, debug=True)
@@ -0,0 +1,77 @@
+""" Fixtures running the app against the stubs of tools/loadtest.py
+
+The Datastore client is replaced by the in-memory MemoryClient and the YNAB
+API by FakeYnab before the app is imported. Every test starts with an empty
+Datastore and empty caches.
+"""
+
+import argparse
+import os
+import sys
+
+import pytest
+from google.cloud import datastore
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import loadtest
+
+datastore.Client = loadtest.MemoryClient
+ARGS = argparse.Namespace(accounts=4, categories=12, payees=20, changes=5,
+                          ynab_latency=0)
+loadtest.FakeYnab(ARGS).install()
+
+import main
+
+
+@pytest.fixture
+def app():
+    """ Returns the app module with a fresh Datastore and caches """
+    main.flush_writes()
+    main.DSCLIENT = loadtest.MemoryClient()
+    with main.WRITE_LOCK:
+        main.WRITE_QUEUE.clear()
+    with main.TENANT_LOCK:
+        main.TENANT_STATE.clear()
+    main.TENANT_TOKENS.clear()
+    main.STATE_CACHE.clear()
+    return main
+
+
+class RecordingYnab(loadtest.FakeYnab):
+    """ FakeYnab that records the requests it serves """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.requests = []
+
+    def handle(self, method, url):
+        self.requests.append((method, url))
+        return super().handle(method, url)
+
+
+@pytest.fixture
+def ynab(app):
+    """ Returns a fresh stubbed YNAB API, with the app configured to use it """
+    for name, value in [("ifttt_key", loadtest.SERVICE_KEY),
+                        ("ynab_key", "x"),
+                        ("ynab_default_budget", loadtest.BUDGET_ID)]:
+        entity = datastore.Entity(app.ds_key("config", name))
+        entity["value"] = value
+        app.get_dsclient().put(entity)
+    ynab = RecordingYnab(ARGS)
+    ynab.install()
+    return ynab
+
+
+def change(seq, timestamp, size=10):
+    """ Returns a feed record of about size bytes """
+    return {
+        "created_at": "2020-01-01T00:00:00+00:00",
+        "change": "new",
+        "name": "x" * size,
+        "meta": {"id": "id-{}".format(seq), "timestamp": timestamp},
+        "seq": seq,
+    }
@@ -0,0 +1,66 @@
+""" Tests of the cached account balances """
+
+
+def account(balance, deleted=False):
+    return {"id": "a", "name": "Checking", "balance": balance,
+            "deleted": deleted}
+
+
+def test_write_after_sync(app):
+    app.update_balances("b", [account(1000)], 5)
+    app.apply_balance_change("b", "a", -100, 7)
+    assert app.get_cached_balance("b", "a") == 900
+    assert app.YNAB_BALANCES["b"]["knowledge"] == 7
+
+
+def test_older_sync_does_not_undo_a_write(app):
+    app.update_balances("b", [account(1000)], 5)
+    app.apply_balance_change("b", "a", -100, 7)
+    # a sync that fetched the budget before the write finishes after it
+    app.update_balances("b", [account(1000)], 6)
+    assert app.get_cached_balance("b", "a") == 900
+    app.update_balances("b", [account(850)], 8)
+    assert app.get_cached_balance("b", "a") == 850
+
+
+def test_equal_knowledge_sync_wins(app):
+    app.update_balances("b", [account(1000)], 5)
+    app.apply_balance_change("b", "a", -100, 7)
+    app.update_balances("b", [account(900)], 7)
+    assert app.get_cached_balance("b", "a") == 900
+    assert app.YNAB_BALANCES["b"]["accounts"]["a"]["knowledge"] == 7
+
+
+def test_invalidated_balance_is_replaced(app):
+    app.update_balances("b", [account(1000)], 5)
+    app.apply_balance_change("b", "a", -100, 7)
+    app.invalidate_balance("b", "a")
+    assert app.get_cached_balance("b", "a") is None
+    app.apply_balance_change("b", "a", -100, 8)
+    assert app.get_cached_balance("b", "a") is None
+    app.update_balances("b", [account(700)], 6)
+    assert app.get_cached_balance("b", "a") == 700
+
+
+def test_change_of_uncached_account_is_ignored(app):
+    app.apply_balance_change("b", "a", -100, 7)
+    assert app.get_cached_balance("b", "a") is None
+    app.update_balances("b", [account(1000)], 5)
+    app.apply_balance_change("b", "x", -100, 7)
+    assert app.get_cached_balance("b", "a") == 1000
+    assert app.YNAB_BALANCES["b"]["knowledge"] == 5
+
+
+def test_deleted_account(app):
+    app.update_balances("b", [account(1000)], 5)
+    app.update_balances("b", [account(1000, True)], 6)
+    assert app.get_cached_balance("b", "a") is None
+    assert app.find_cached_account("b", "Checking") is None
+
+
+def test_balances_are_per_tenant(app):
+    app.update_balances("b", [account(1000)], 5)
+    with app.tenant_context("other"):
+        assert app.get_cached_balance("b", "a") is None
+        app.update_balances("b", [account(50)], 9)
+    assert app.get_cached_balance("b", "a") == 1000
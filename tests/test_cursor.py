@@ -0,0 +1,105 @@
+""" Tests of the cursor paging of trigger polls """
+
+import arrow
+import pytest
+
+from conftest import change
+
+
+def paged_feed(app, now, count):
+    """ Returns a payees feed of count records, partly spilled into pages """
+    result = {"changed": [], "seq": 0}
+    for seq in range(1, count + 1):
+        app.add_change(result, change(seq, now.timestamp, 100))
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes, 3000)
+    app.ds_put_multi(pageputs)
+    assert result["pages"]
+    return result
+
+
+def test_seek_feed(app):
+    items = [9, 7, 7, 4, 1]
+    seq = lambda item: item
+    assert app.seek_feed(items, None, seq) == 0
+    assert app.seek_feed(items, 10, seq) == 0
+    assert app.seek_feed(items, 9, seq) == 1
+    assert app.seek_feed(items, 7, seq) == 3
+    assert app.seek_feed(items, 5, seq) == 3
+    assert app.seek_feed(items, 1, seq) == 5
+    assert app.seek_feed([], 3, seq) == 0
+
+
+def test_pages_cover_the_feed_once(app):
+    result = paged_feed(app, arrow.utcnow(), 80)
+    seqs = []
+    cursor = None
+    while True:
+        changes = app.feed_changes("b", "payees", result, 7, cursor=cursor)
+        seqs += [c["seq"] for c in changes]
+        if len(changes) < 7:
+            break
+        cursor = changes[-1]["seq"]
+    assert seqs == list(range(80, 0, -1))
+
+
+def test_cursor_skips_newer_pages(app, monkeypatch):
+    result = paged_feed(app, arrow.utcnow(), 80)
+    read = []
+    ds_get = app.ds_get
+    def counting_get(key):
+        read.append(key)
+        return ds_get(key)
+    monkeypatch.setattr(app, "ds_get", counting_get)
+
+    oldest = result["pages"][-1]
+    changes = app.feed_changes("b", "payees", result, 1,
+                               cursor=oldest["newest_seq"])
+    assert [c["seq"] for c in changes] == [oldest["newest_seq"] - 1]
+    assert read == [app.feed_page_key("b", "payees", oldest["id"])]
+
+
+def test_filtered_pages(app):
+    now = arrow.utcnow()
+    result = {"changed": [], "seq": 0}
+    for seq in range(1, 61):
+        record = change(seq, now.timestamp, 100)
+        record["category_id"] = "category-{}".format(seq % 2)
+        app.add_change(result, record)
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "month_categories", result, now, pageputs,
+                   pagedeletes, 3000)
+    app.ds_put_multi(pageputs)
+
+    seqs = []
+    cursor = None
+    while True:
+        changes = app.feed_changes("b", "month_categories", result, 4,
+                                   "category-0", cursor)
+        seqs += [c["seq"] for c in changes]
+        if len(changes) < 4:
+            break
+        cursor = changes[-1]["seq"]
+    assert seqs == list(range(60, 0, -2))
+
+
+def test_feed_cursor(app):
+    assert app.feed_cursor({}) is None
+    assert app.feed_cursor({"cursor": ""}) is None
+    assert app.feed_cursor({"cursor": "42"}) == 42
+    for cursor in ["-1", "4x", 42, [1]]:
+        with pytest.raises(ValueError):
+            app.feed_cursor({"cursor": cursor})
+
+
+def test_feed_response_cursor(app):
+    now = arrow.utcnow()
+    records = [change(seq, now.timestamp) for seq in range(5, 0, -1)]
+    payload = app.feed_response([dict(c) for c in records], 3, "UTC")
+    assert payload["cursor"] == "3"
+    assert len(payload["data"]) == 3
+    assert all("seq" not in c for c in payload["data"])
+
+    payload = app.feed_response([dict(c) for c in records], 10, "UTC")
+    assert "cursor" not in payload
+    assert len(payload["data"]) == 5
@@ -0,0 +1,124 @@
+""" Tests of the change feed overflow pages """
+
+import json
+
+import arrow
+
+from conftest import change
+
+
+def feed(now, count, size=100):
+    """ Returns a payees feed of count records, newest first """
+    return {"changed": [change(seq, now.timestamp - count + seq, size)
+                        for seq in range(count, 0, -1)],
+            "seq": count}
+
+
+def stored_records(app, budget, typ, result, pageputs):
+    """ Returns the inline records of a feed followed by those of its pages """
+    app.ds_put_multi(pageputs)
+    records = list(result["changed"])
+    for page in result["pages"]:
+        entity = app.ds_get(app.feed_page_key(budget, typ, page["id"]))
+        records += json.loads(entity["records"])
+    return records
+
+
+def test_small_feed_stays_inline(app):
+    now = arrow.utcnow()
+    result = feed(now, 5)
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes)
+    assert len(result["changed"]) == 5
+    assert result.get("pages", []) == []
+    assert pageputs == [] and pagedeletes == []
+
+
+def test_spilled_records_keep_their_order(app):
+    now = arrow.utcnow()
+    result = feed(now, 100)
+    original = json.loads(json.dumps(result["changed"]))
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes, 4000)
+
+    assert 1 <= len(result["changed"]) < 100
+    assert result["bytes"] <= 2000
+    assert result["pages"]
+    assert stored_records(app, "b", "payees", result, pageputs) == original
+    for page in result["pages"]:
+        assert page["newest_seq"] >= page["oldest_seq"]
+    seqs = [page["oldest_seq"] for page in result["pages"]]
+    assert seqs == sorted(seqs, reverse=True)
+
+
+def test_pages_are_split_by_page_bytes(app, monkeypatch):
+    monkeypatch.setitem(app.FEED_POLICIES, "payees", {
+        "inline_bytes": 1000, "page_bytes": 3000, "max_pages": 100})
+    now = arrow.utcnow()
+    result = feed(now, 100)
+    original = json.loads(json.dumps(result["changed"]))
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes)
+
+    assert len(result["pages"]) > 1
+    for entity in pageputs:
+        records = json.loads(entity["records"])
+        assert len(records) == 1 or len(entity["records"]) <= 3000
+    assert stored_records(app, "b", "payees", result, pageputs) == original
+
+
+def test_later_spills_add_newer_pages(app):
+    now = arrow.utcnow()
+    result = feed(now, 50)
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes, 4000)
+    first = [page["id"] for page in result["pages"]]
+
+    for seq in range(51, 101):
+        app.add_change(result, change(seq, now.timestamp, 100))
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes, 4000)
+    ids = [page["id"] for page in result["pages"]]
+    assert ids[len(ids) - len(first):] == first
+    assert ids == sorted(ids, reverse=True)
+    records = stored_records(app, "b", "payees", result, pageputs)
+    assert [c["seq"] for c in records] == list(range(100, 0, -1))
+
+
+def test_old_pages_expire_into_the_archive(app):
+    now = arrow.utcnow()
+    old = now.shift(days=-2)
+    result = feed(old, 50)
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, old, pageputs, pagedeletes, 4000)
+    app.ds_put_multi(pageputs)
+    spilled = [page["id"] for page in result["pages"]]
+    count = sum(page["count"] for page in result["pages"])
+
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "payees", result, now, pageputs, pagedeletes)
+    assert result["pages"] == []
+    assert set(pagedeletes) >= set(app.feed_page_key("b", "payees", page)
+                                   for page in spilled)
+    app.ds_put_multi(pageputs)
+    records, cursor = app.history_changes(
+        "b", "payees", 0, now.timestamp, 1000, None, "UTC")
+    assert len(records) == count
+    assert cursor is None
+
+
+def test_indexed_pages_list_their_keys(app):
+    now = arrow.utcnow()
+    result = {"changed": [], "seq": 0}
+    for seq in range(1, 61):
+        record = change(seq, now.timestamp, 100)
+        record["category_id"] = "category-{}".format(seq % 3)
+        app.add_change(result, record)
+    pageputs, pagedeletes = [], []
+    app.bound_feed("b", "month_categories", result, now, pageputs,
+                   pagedeletes, 4000)
+    app.ds_put_multi(pageputs)
+
+    changes = app.feed_changes("b", "month_categories", result, 100,
+                               "category-1")
+    assert [c["seq"] for c in changes] == \
+        [seq for seq in range(60, 0, -1) if seq % 3 == 1]
@@ -0,0 +1,108 @@
+""" Tests of the change history archive """
+
+import json
+
+import arrow
+
+from conftest import change
+
+
+def archive(app, records, now):
+    pageputs, pagedeletes = [], []
+    app.archive_changes("b", "payees", records, now, pageputs, pagedeletes)
+    app.ds_put_multi(pageputs)
+    app.ds_delete_multi(pagedeletes)
+
+
+def segments(app, day):
+    entity = app.ds_get(app.history_key("b", day))
+    return json.loads(entity["index"])["segments"]
+
+
+def query(app, start=0, end=None, limit=1000, cursor=None):
+    if end is None:
+        end = arrow.utcnow().timestamp
+    return app.history_changes("b", "payees", start, end, limit, cursor,
+                               "UTC")
+
+
+def test_records_round_trip(app):
+    now = arrow.get("2020-03-02T12:00:00+00:00")
+    records = [change(seq, now.timestamp - 10 + seq)
+               for seq in range(5, 0, -1)]
+    archive(app, records, now)
+
+    found, cursor = query(app)
+    assert cursor is None
+    assert [c["seq"] for c in found] == [1, 2, 3, 4, 5]
+    for record in found:
+        original = records[5 - record["seq"]]
+        assert record["meta"] == original["meta"]
+        assert record["name"] == original["name"]
+        assert arrow.get(record["created_at"]).timestamp == \
+            original["meta"]["timestamp"]
+
+
+def test_records_are_partitioned_by_day(app):
+    now = arrow.get("2020-03-02T12:00:00+00:00")
+    records = [change(1, now.shift(days=-1).timestamp),
+               change(2, now.timestamp)]
+    archive(app, records, now)
+
+    root = json.loads(app.ds_get(app.history_key("b"))["index"])
+    assert root["days"] == ["2020-03-01", "2020-03-02"]
+    found, cursor = query(app, now.floor("day").timestamp)
+    assert [c["seq"] for c in found] == [2]
+
+
+def test_later_runs_continue_the_segment(app):
+    now = arrow.get("2020-03-02T12:00:00+00:00")
+    archive(app, [change(1, now.timestamp)], now)
+    archive(app, [change(2, now.timestamp + 1)], now)
+
+    assert [s[2] for s in segments(app, "2020-03-02")] == [2]
+    found, cursor = query(app)
+    assert [c["seq"] for c in found] == [1, 2]
+
+
+def test_full_segments_are_not_continued(app, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_SEGMENT_RECORDS", 4)
+    now = arrow.get("2020-03-02T12:00:00+00:00")
+    archive(app, [change(seq, now.timestamp + seq)
+                  for seq in range(6, 0, -1)], now)
+    archive(app, [change(seq, now.timestamp + seq)
+                  for seq in range(9, 6, -1)], now)
+
+    assert [s[2] for s in segments(app, "2020-03-02")] == [4, 4, 1]
+    seqs = []
+    cursor = None
+    while True:
+        found, cursor = query(app, limit=3, cursor=cursor)
+        seqs += [c["seq"] for c in found]
+        if cursor is None:
+            break
+    assert seqs == list(range(1, 10))
+
+
+def test_time_range(app):
+    now = arrow.get("2020-03-02T12:00:00+00:00")
+    archive(app, [change(seq, now.timestamp + seq)
+                  for seq in range(10, 0, -1)], now)
+    found, cursor = query(app, now.timestamp + 3, now.timestamp + 6)
+    assert [c["seq"] for c in found] == [3, 4, 5, 6]
+
+
+def test_old_days_expire(app):
+    now = arrow.get("2020-03-02T12:00:00+00:00")
+    old = now.shift(days=-app.HISTORY_DAYS - 1)
+    archive(app, [change(1, old.timestamp)], old)
+    old_day = old.format("YYYY-MM-DD")
+    segment = segments(app, old_day)[0][0]
+
+    archive(app, [change(2, now.timestamp)], now)
+    root = json.loads(app.ds_get(app.history_key("b"))["index"])
+    assert root["days"] == ["2020-03-02"]
+    assert app.ds_get(app.history_key("b", old_day)) is None
+    assert app.ds_get(app.history_segment_key("b", segment)) is None
+    found, cursor = query(app)
+    assert [c["seq"] for c in found] == [2]
@@ -0,0 +1,85 @@
+""" Tests of the deadline-aware, resumable budget sync """
+
+import json
+import time
+
+from loadtest import BUDGET_ID
+
+
+def sync(app, deadline):
+    app.sync_one(BUDGET_ID, "1", {"lost": False}, deadline)
+
+
+def budget_fetches(ynab):
+    return [url for method, url in ynab.requests
+            if method == "GET" and url.split("?")[0].endswith(BUDGET_ID)]
+
+
+def checkpoint(app):
+    entity = app.ds_get(app.ds_key("sync", BUDGET_ID))
+    if entity is None:
+        return None
+    return json.loads(entity["done"])
+
+
+def stored_config(app):
+    return json.loads(app.ds_get(app.ds_key("budget", BUDGET_ID))["config"])
+
+
+def test_sync_within_deadline(app, ynab):
+    sync(app, time.time() + 60)
+    assert len(budget_fetches(ynab)) == 1
+    assert checkpoint(app) is None
+    assert stored_config(app)["knowledge"] == ynab.knowledge
+
+
+def test_interrupted_sync_resumes(app, ynab):
+    sync(app, 0)
+    assert len(budget_fetches(ynab)) == 1
+    assert checkpoint(app) == ["accounts"]
+    assert stored_config(app)["knowledge"] is None
+
+    # the resumed run is interrupted as well, but keeps its progress
+    sync(app, 0)
+    assert len(budget_fetches(ynab)) == 1
+    assert checkpoint(app) == ["accounts", "categories"]
+
+    sync(app, time.time() + 60)
+    assert len(budget_fetches(ynab)) == 1
+    assert checkpoint(app) is None
+    assert app.ds_get(app.ds_key("sync", BUDGET_ID, "chunk", "0")) is None
+    assert stored_config(app)["knowledge"] == ynab.knowledge
+    entity = app.ds_get(app.ds_key("budget", BUDGET_ID))
+    for typ in app.SYNC_COLLECTIONS:
+        assert "changed" in json.loads(entity[typ])
+
+
+def test_resumed_sync_matches_a_full_sync(app, ynab):
+    for typ in app.SYNC_COLLECTIONS:
+        sync(app, 0)
+    assert checkpoint(app) is None
+    resumed = app.ds_get(app.ds_key("budget", BUDGET_ID))
+
+    # the same budget synced in one run, into an empty Datastore
+    config = [app.ds_get(app.ds_key("config", name)) for name in
+              ["ifttt_key", "ynab_key", "ynab_default_budget"]]
+    app.DSCLIENT = None
+    app.STATE_CACHE.clear()
+    app.ds_put_multi(config)
+    sync(app, time.time() + 60)
+    full = app.ds_get(app.ds_key("budget", BUDGET_ID))
+    assert len(budget_fetches(ynab)) == 2
+    for typ in app.SYNC_COLLECTIONS:
+        assert json.loads(resumed[typ]) == json.loads(full[typ])
+
+
+def test_outdated_checkpoint_is_ignored(app, ynab):
+    sync(app, 0)
+    entity = app.ds_get(app.ds_key("sync", BUDGET_ID))
+    entity["base"] = 12345
+    app.get_dsclient().put(entity)
+
+    sync(app, time.time() + 60)
+    assert len(budget_fetches(ynab)) == 2
+    assert checkpoint(app) is None
+    assert stored_config(app)["knowledge"] == ynab.knowledge
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+""" Checks the import time of the app against a cold start budget
+
+Imports app/main.py in a fresh interpreter, as a cold App Engine instance
+does, and fails when the import takes longer than the budget or when one of
+the modules that should be loaded lazily was loaded during the import.
+
+Usage: python tools/importtime.py [--budget 0.5] [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "app")
+
+# modules only needed once a request uses Datastore, YNAB or dates
+DEFERRED = ["google.api_core", "google.auth", "grpc", "urllib3", "dateutil"]
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r
+                                                 if m in sys.modules]}))
+""" % DEFERRED
+
+
+def measure():
+    """ Returns the import time and loaded deferred modules of one run """
+    output = subprocess.run([sys.executable, "-c", MEASURE], cwd=APP_DIR,
+                            check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    # the last line is ours, the app may log during the import
+    return json.loads(output.strip().split("\n")[-1])
+
+def main_importtime():
+    results = [measure() for i in range(ARGS.runs)]
+    best = min(r["seconds"] for r in results)
+    loaded = sorted(set(m for r in results for m in r["loaded"]))
+    print("import main: {:.3f}s (best of {}), budget {:.3f}s".format(
+        best, ARGS.runs, ARGS.budget))
+    failed = False
+    if loaded:
+        print("Loaded during import: " + ", ".join(loaded))
+        failed = True
+    if best > ARGS.budget:
+        print("Import time exceeds the budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--budget", type=float, default=0.5,
+                        help="maximum import time in seconds (default 0.5)")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of imports, the best is used")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    main_importtime()
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+""" Load test for the IFTTT poll and action endpoints
+
+Runs the Flask app in-process with an in-memory Datastore and a stubbed YNAB
+API, builds up change feeds for a synthetic budget with a number of cron
+runs, and then fires a realistic mix of IFTTT trigger polls and actions at
+the app from a number of threads. Reports latency percentiles and
+throughput per endpoint.
+
+Usage: python tools/loadtest.py [--threads 8] [--duration 20] ...
+"""
+
+import argparse
+import contextlib
+import copy
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+from google.cloud import datastore
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "app")
+
+BUDGET_ID = "0a1b2c3d-0000-4000-8000-000000000001"
+SERVICE_KEY = "loadtest-service-key"
+TIMEZONES = ["UTC", "Europe/Amsterdam", "America/New_York", "Asia/Tokyo",
+             "Australia/Sydney"]
+LIMITS = [None, None, 1, 5, 50]
+
+
+###############################################################################
+# In-memory Datastore                                                         #
+###############################################################################
+
+class MemoryTransaction():
+    """ Transaction stand-in: applies puts directly, under the client lock """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __enter__(self):
+        self.client.lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.client.lock.release()
+        return False
+
+    def put(self, entity):
+        self.client.store[self.client.path(entity.key)] = copy.copy(entity)
+
+
+class MemoryClient():
+    """ In-memory stand-in for datastore.Client """
+
+    def __init__(self, *args, **kwargs):
+        self.project = "loadtest"
+        self.store = {}
+        self.lock = threading.RLock()
+
+    def key(self, *path, **kwargs):
+        return datastore.Key(*path, project=self.project,
+                             namespace=kwargs.get("namespace"))
+
+    def path(self, key):
+        return (key.namespace, key.flat_path)
+
+    def get(self, key, **kwargs):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys, **kwargs):
+        with self.lock:
+            return [copy.copy(self.store[self.path(k)]) for k in keys
+                    if self.path(k) in self.store]
+
+    def put(self, entity, **kwargs):
+        self.put_multi([entity])
+
+    def put_multi(self, entities, **kwargs):
+        with self.lock:
+            for entity in entities:
+                self.store[self.path(entity.key)] = copy.copy(entity)
+
+    def delete(self, key, **kwargs):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys, **kwargs):
+        with self.lock:
+            for key in keys:
+                self.store.pop(self.path(key), None)
+
+    def transaction(self, **kwargs):
+        return MemoryTransaction(self)
+
+
+###############################################################################
+# Stubbed YNAB API                                                            #
+###############################################################################
+
+class FakeYnab():
+    """ Serves a synthetic budget, with new changes after every sync """
+
+    def __init__(self, args):
+        self.args = args
+        self.knowledge = 1
+        self.lock = threading.Lock()
+        self.accounts = [{
+            "id": "account-{}".format(i),
+            "name": "Account {}".format(i),
+            "type": "checking",
+            "on_budget": i % 4 != 3,
+            "closed": False,
+            "note": None,
+            "balance": 1000000,
+            "cleared_balance": 1000000,
+            "uncleared_balance": 0,
+            "deleted": False,
+        } for i in range(args.accounts)]
+        self.groups = [{"id": "group-{}".format(i),
+                        "name": "Group {}".format(i),
+                        "hidden": False, "deleted": False}
+                       for i in range(max(1, args.categories // 6))]
+        self.categories = [{
+            "id": "category-{}".format(i),
+            "category_group_id": self.groups[i % len(self.groups)]["id"],
+            "name": "Category {}".format(i),
+            "hidden": False,
+            "note": None,
+            "budgeted": 100000,
+            "activity": 0,
+            "balance": 100000,
+            "goal_type": None,
+            "goal_creation_month": None,
+            "goal_target": None,
+            "goal_target_month": None,
+            "goal_percentage_complete": None,
+            "deleted": False,
+        } for i in range(args.categories)]
+        self.payees = [{"id": "payee-{}".format(i),
+                        "name": "Payee {}".format(i), "deleted": False}
+                       for i in range(args.payees)]
+        self.transactions = []
+
+    def sync(self):
+        """ Simulates activity in the budget for the next cron run """
+        with self.lock:
+            self.knowledge += 1
+            self.transactions = []
+            for i in range(self.args.changes):
+                account = random.choice(self.accounts)
+                category = random.choice(self.categories)
+                amount = -random.randint(1, 20000) * 10
+                account["balance"] += amount
+                category["activity"] += amount
+                self.transactions.append({
+                    "id": "tx-{}-{}".format(self.knowledge, i),
+                    "date": time.strftime("%Y-%m-%d"),
+                    "amount": amount,
+                    "memo": "Load test",
+                    "cleared": "uncleared",
+                    "approved": False,
+                    "flag_color": random.choice([None, "red", "blue"]),
+                    "account_id": account["id"],
+                    "payee_id": random.choice(self.payees)["id"],
+                    "category_id": category["id"],
+                    "transfer_account_id": None,
+                    "deleted": False,
+                })
+
+    def budget(self):
+        month = {"month": time.strftime("%Y-%m-01"), "income": 0,
+                 "budgeted": 0, "activity": 0, "to_be_budgeted": 0,
+                 "age_of_money": None, "categories": self.categories}
+        return {"data": {"server_knowledge": self.knowledge, "budget": {
+            "id": BUDGET_ID,
+            "name": "Load test",
+            "currency_format": {"decimal_digits": 2},
+            "first_month": "2020-01-01",
+            "accounts": self.accounts,
+            "categories": self.categories,
+            "category_groups": self.groups,
+            "months": [month],
+            "payees": self.payees,
+            "transactions": self.transactions,
+        }}}
+
+    def handle(self, method, url):
+        """ Returns (status, payload) for a YNAB API request """
+        if self.args.ynab_latency:
+            time.sleep(self.args.ynab_latency / 1000)
+        with self.lock:
+            path = url.split("/v1", 1)[-1].split("?")[0]
+            if method == "POST":
+                return 201, {"data": {"transaction_ids": ["x"],
+                                      "server_knowledge": self.knowledge}}
+            if path == "/budgets":
+                return 200, {"data": {"budgets": [{
+                    "id": BUDGET_ID, "name": "Load test",
+                    "last_modified_on": str(self.knowledge)}]}}
+            if path.endswith("/accounts"):
+                return 200, {"data": {"accounts": self.accounts,
+                                      "server_knowledge": self.knowledge}}
+            if path.endswith("/categories"):
+                groups = []
+                for g in self.groups:
+                    group = dict(g)
+                    group["categories"] = [
+                        c for c in self.categories
+                        if c["category_group_id"] == g["id"]]
+                    groups.append(group)
+                return 200, {"data": {"category_groups": groups,
+                                      "server_knowledge": self.knowledge}}
+            return 200, json.loads(json.dumps(self.budget()))
+
+    def install(self):
+        """ Routes the requests library through this stub """
+        def request(method, url, **kwargs):
+            if "realtime.ifttt.com" in url:
+                status, payload = 200, {}
+            else:
+                status, payload = self.handle(method.upper(), url)
+            response = requests.models.Response()
+            response.status_code = status
+            response._content = json.dumps(payload).encode("utf-8")
+            response.headers["Content-Type"] = "application/json"
+            response.url = url
+            return response
+        requests.request = request
+        requests.get = lambda url, **kwargs: request("GET", url, **kwargs)
+        requests.post = lambda url, **kwargs: request("POST", url, **kwargs)
+
+
+###############################################################################
+# Request mix                                                                 #
+###############################################################################
+
+def poll(path, fields, ynab):
+    """ Returns a trigger poll request generator """
+    def make(rnd):
+        body = {"triggerFields": dict(fields(rnd, ynab)),
+                "trigger_identity": "{}-{}".format(
+                    path, rnd.randrange(ARGS.triggers)),
+                "user": {"timezone": rnd.choice(TIMEZONES)}}
+        limit = rnd.choice(LIMITS)
+        if limit is not None:
+            body["limit"] = limit
+        return "/ifttt/v1/triggers/" + path, body
+    return make
+
+def action(path, fields, ynab):
+    """ Returns an action request generator """
+    def make(rnd):
+        return "/ifttt/v1/actions/" + path, {
+            "actionFields": fields(rnd, ynab),
+            "user": {"timezone": rnd.choice(TIMEZONES)}}
+    return make
+
+def budget_fields(rnd, ynab):
+    return {"budget": BUDGET_ID}
+
+def category_month_fields(rnd, ynab):
+    return {"budget": BUDGET_ID,
+            "category": rnd.choice(ynab.categories)["name"]}
+
+def transaction_fields(rnd, ynab):
+    fields = {"budget": BUDGET_ID, "account": "", "payee": "",
+              "category": "", "amount_min": "", "amount_max": "",
+              "flag_color": ""}
+    # a quarter of the triggers filter on an account or amount
+    kind = rnd.randrange(8)
+    if kind == 0:
+        fields["account"] = rnd.choice(ynab.accounts)["name"]
+    elif kind == 1:
+        fields["amount_max"] = "-100"
+    return fields
+
+def create_fields(rnd, ynab):
+    return {"budget": BUDGET_ID,
+            "account": rnd.choice(ynab.accounts)["name"],
+            "date": rnd.choice(["today", "yesterday", ""]),
+            "amount": "-{:.2f}".format(rnd.randint(100, 10000) / 100),
+            "payee": rnd.choice(ynab.payees)["name"],
+            "category": rnd.choice(ynab.categories)["name"],
+            "memo": "Load test", "cleared": "", "approved": "false",
+            "flag_color": "", "import_id": ""}
+
+def adjust_fields(rnd, ynab):
+    return {"budget": BUDGET_ID,
+            "account": rnd.choice(ynab.accounts)["name"],
+            "date": "today",
+            "new_balance": "{:.2f}".format(rnd.randint(0, 100000) / 100),
+            "payee": "Adjustment", "category": "", "memo": "",
+            "cleared": "", "approved": "false", "flag_color": ""}
+
+def bulk_fields(rnd, ynab):
+    lines = []
+    for i in range(rnd.randint(2, 20)):
+        lines.append("today,-{:.2f},{},{},Load test".format(
+            rnd.randint(100, 10000) / 100, rnd.choice(ynab.payees)["name"],
+            rnd.choice(ynab.categories)["name"]))
+    return {"budget": BUDGET_ID,
+            "account": rnd.choice(ynab.accounts)["name"],
+            "transactions": "\n".join(lines), "cleared": "",
+            "approved": "false", "flag_color": "", "import_id": ""}
+
+def request_mix(ynab):
+    """ Returns [(weight, name, generator)], polls dominate like on IFTTT """
+    return [
+        (30, "transaction_updated",
+         poll("ynab_transaction_updated", transaction_fields, ynab)),
+        (10, "account_updated",
+         poll("ynab_account_updated", budget_fields, ynab)),
+        (10, "category_updated",
+         poll("ynab_category_updated", budget_fields, ynab)),
+        (10, "category_month_updated",
+         poll("ynab_category_month_updated", category_month_fields, ynab)),
+        (5, "month_updated",
+         poll("ynab_month_updated", budget_fields, ynab)),
+        (5, "payee_updated",
+         poll("ynab_payee_updated", budget_fields, ynab)),
+        (15, "create", action("ynab_create", create_fields, ynab)),
+        (5, "adjust_balance",
+         action("ynab_adjust_balance", adjust_fields, ynab)),
+        (2, "create_bulk", action("ynab_create_bulk", bulk_fields, ynab)),
+    ]
+
+
+###############################################################################
+# Runner                                                                      #
+###############################################################################
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return 0
+    index = max(0, math.ceil(pct / 100 * len(values)) - 1)
+    return values[index]
+
+def worker(app, mix, deadline, seed, results):
+    rnd = random.Random(seed)
+    client = app.test_client()
+    weights = [w for w, _, _ in mix]
+    headers = {"IFTTT-Service-Key": SERVICE_KEY}
+    while time.time() < deadline:
+        _, name, make = rnd.choices(mix, weights)[0]
+        path, body = make(rnd)
+        start = time.perf_counter()
+        response = client.post(path, json=body, headers=headers)
+        elapsed = time.perf_counter() - start
+        results.append((name, elapsed, response.status_code))
+
+def setup(main, ynab):
+    """ Stores the config and runs cron until the feeds are populated """
+    for name, value in [("ifttt_key", SERVICE_KEY), ("ynab_key", "x"),
+                        ("ynab_default_budget", BUDGET_ID)]:
+        entity = datastore.Entity(main.ds_key("config", name))
+        entity["value"] = value
+        main.get_dsclient().put(entity)
+    client = main.app.test_client()
+    for i in range(ARGS.syncs):
+        client.get("/cron/ynab")
+        ynab.sync()
+    client.get("/cron/ynab")
+
+def report(results, duration):
+    by_endpoint = {}
+    for name, elapsed, status in results:
+        by_endpoint.setdefault(name, []).append((elapsed, status))
+    rows = []
+    for name in sorted(by_endpoint) + ["total"]:
+        if name == "total":
+            samples = [(e, s) for _, e, s in results]
+        else:
+            samples = by_endpoint[name]
+        times = sorted(e * 1000 for e, _ in samples)
+        errors = len([s for _, s in samples if s >= 500])
+        rows.append({"endpoint": name, "requests": len(samples),
+                     "errors": errors,
+                     "rps": round(len(samples) / duration, 1),
+                     "p50": round(percentile(times, 50), 2),
+                     "p95": round(percentile(times, 95), 2),
+                     "p99": round(percentile(times, 99), 2),
+                     "max": round(times[-1], 2) if times else 0})
+    return rows
+
+def main_loadtest():
+    sys.path.insert(0, APP_DIR)
+    datastore.Client = MemoryClient
+    ynab = FakeYnab(ARGS)
+    ynab.install()
+    out = sys.stdout if ARGS.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(out):
+        import main
+        setup(main, ynab)
+        mix = request_mix(ynab)
+        results = []
+        threads = []
+        start = time.time()
+        deadline = start + ARGS.duration
+        for i in range(ARGS.threads):
+            thread = threading.Thread(target=worker, args=(
+                main.app, mix, deadline, ARGS.seed + i, results))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+        main.flush_writes()
+
+    rows = report(results, duration)
+    if ARGS.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print("{} threads, {:.1f}s, YNAB latency {}ms".format(
+        ARGS.threads, duration, ARGS.ynab_latency))
+    print("{:<24}{:>9}{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}".format(
+        "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms",
+        "p99 ms", "max ms"))
+    for row in rows:
+        print("{endpoint:<24}{requests:>9}{errors:>8}{rps:>9}{p50:>9}"
+              "{p95:>9}{p99:>9}{max:>9}".format(**row))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", type=int, default=8,
+                        help="concurrent clients (default 8)")
+    parser.add_argument("--duration", type=float, default=20,
+                        help="seconds to run (default 20)")
+    parser.add_argument("--triggers", type=int, default=200,
+                        help="trigger identities per trigger (default 200)")
+    parser.add_argument("--accounts", type=int, default=12)
+    parser.add_argument("--categories", type=int, default=60)
+    parser.add_argument("--payees", type=int, default=300)
+    parser.add_argument("--changes", type=int, default=40,
+                        help="transactions per simulated sync (default 40)")
+    parser.add_argument("--syncs", type=int, default=10,
+                        help="cron runs before the test (default 10)")
+    parser.add_argument("--ynab-latency", type=float, default=0,
+                        help="simulated YNAB API latency in ms")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the app")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    main_loadtest()
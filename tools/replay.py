@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+""" Replays recorded YNAB budget responses through the sync offline
+
+Record responses by running the app with YNAB_RECORD_DIR set; every budget
+(delta) response of the cron job is then written to
+<dir>/<budget>/<time>.json.gz. This tool feeds the recordings of a budget
+in order through sync_budget, with an in-memory Datastore and the clock
+frozen at the time of each recording, so runs are deterministic.
+
+It reports the time spent per sync function and a digest of the resulting
+Datastore contents. Pass --expect with a digest from an earlier run to
+check that a change to the sync code did not change its output.
+
+Usage: python tools/replay.py <dir>/<budget> [--repeat 5] [--expect DIGEST]
+"""
+
+import argparse
+import contextlib
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+
+import arrow
+from google.cloud import datastore
+
+from loadtest import APP_DIR, MemoryClient
+
+TIMED = ["process_accounts", "process_categories", "process_months",
+         "process_month_categories", "process_payees", "process_transactions",
+         "bound_feed", "bound_entity", "store_options_snapshot"]
+
+
+def load_recordings(directory):
+    """ Returns the recordings of a budget, oldest first """
+    recordings = []
+    for filename in sorted(glob.glob(os.path.join(directory, "*.json.gz"))):
+        with gzip.open(filename, "rt", encoding="utf-8") as f:
+            recordings.append(json.load(f))
+    return recordings
+
+def timed(main, name, timings):
+    """ Replaces main.<name> with a wrapper that adds up its run time """
+    func = getattr(main, name)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name] = timings.get(name, 0) + \
+                            time.perf_counter() - start
+    setattr(main, name, wrapper)
+
+def digest(client):
+    """ Returns a digest of everything stored in the Datastore stand-in """
+    h = hashlib.sha256()
+    for path in sorted(client.store, key=repr):
+        entity = client.store[path]
+        h.update(repr(path).encode("utf-8"))
+        h.update(json.dumps(dict(entity), sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def replay(main, budget, recordings, timings):
+    """ Feeds the recordings through sync_budget, returns the digest """
+    main.DSCLIENT = MemoryClient()
+    main.YNAB_OPTIONS.clear()
+    main.YNAB_BALANCES.clear()
+    main.TRANSACTION_PREDICATES.clear()
+    entity = main.new_budget_entity(budget)
+    first = True
+    if "last_knowledge_of_server" in recordings[0]["path"]:
+        print("Warning: first recording is a delta, not a full budget",
+              file=sys.stderr)
+    triggers = []
+    utcnow = arrow.utcnow
+    try:
+        for record in recordings:
+            frozen = arrow.get(record["recorded"])
+            arrow.utcnow = lambda: frozen
+            pageputs = []
+            pagedeletes = []
+            start = time.perf_counter()
+            main.sync_budget(budget, entity, first, record["data"],
+                             frozen.to("local"), triggers, pageputs,
+                             pagedeletes)
+            timings["sync_budget"] = timings.get("sync_budget", 0) + \
+                                     time.perf_counter() - start
+            main.get_dsclient().put_multi(pageputs + [entity])
+            main.get_dsclient().delete_multi(pagedeletes)
+            first = False
+    finally:
+        arrow.utcnow = utcnow
+    return digest(main.get_dsclient())
+
+def main_replay():
+    directory = ARGS.directory.rstrip("/")
+    budget = os.path.basename(directory)
+    recordings = load_recordings(directory)
+    if not recordings:
+        print("No recordings in " + directory, file=sys.stderr)
+        sys.exit(2)
+
+    sys.path.insert(0, APP_DIR)
+    datastore.Client = MemoryClient
+    out = sys.stdout if ARGS.verbose else open(os.devnull, "w")
+    best = {}
+    digests = set()
+    with contextlib.redirect_stdout(out):
+        import main
+        timings = {}
+        for name in TIMED:
+            timed(main, name, timings)
+        for i in range(ARGS.repeat):
+            timings.clear()
+            digests.add(replay(main, budget, recordings, timings))
+            for name, seconds in timings.items():
+                best[name] = min(best.get(name, seconds), seconds)
+
+    print("{} recordings, best of {} runs".format(len(recordings),
+                                                  ARGS.repeat))
+    print("{:<28}{:>12}".format("function", "total ms"))
+    for name in ["sync_budget"] + TIMED:
+        if name in best:
+            print("{:<28}{:>12.2f}".format(name, best[name] * 1000))
+    if len(digests) != 1:
+        print("Replay is not deterministic: " + ", ".join(sorted(digests)))
+        sys.exit(1)
+    result = digests.pop()
+    print("digest " + result)
+    if ARGS.expect is not None and ARGS.expect != result:
+        print("Digest differs from expected " + ARGS.expect)
+        sys.exit(1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory",
+                        help="recording directory of one budget")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of replays, best time is reported")
+    parser.add_argument("--expect", help="digest the replay must produce")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the app")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    main_replay()